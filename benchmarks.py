@@ -0,0 +1,498 @@
+"""benchmarks.py: benchmarks for the hot paths of the robot's code - run python benchmarks.py for the suite (latency percentiles
+and allocations of each hot path, optionally written to a JSON file and compared with an earlier one), or with --compare for the
+old vs new comparisons of the optimizations (see python benchmarks.py --help)"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+from time import perf_counter, perf_counter_ns, sleep
+from timeit import repeat
+import numpy as np
+from PIL import Image
+from create import AsyncCreate, Create, SENSORS, PASSIVE_MODE, DRIVEDIRECT, toTwosComplement2Bytes, queryLayout
+from filters import Histogram, Pyramid
+from replay import read_log, SOURCES, RECEIVED
+from sensors import LIDAR, SCIPParser
+from simulator import World, encode_scan, check_summed
+
+def decode_per_reading(lidar, block, depth_limit = 'S'):
+    """the old way of decoding a scan's data block: split it into lines, then decode each reading's bytes separately"""
+    size = 2 if depth_limit == 'S' else 3
+    data = b''.join(line[:-1] for line in block.rstrip(b'\n').split(b'\n'))
+    return [lidar.decode(data[j:j + size]) for j in range(0, len(data), size)]
+
+def benchmark_lidar_decode(readings = 682, number = 200):
+    """compares decoding a whole scan one reading at a time (LIDAR.decode) with decoding it in one go (LIDAR.decode_block)"""
+    lidar = LIDAR(23, None)
+    depths = np.random.default_rng(0).integers(20, 4085, readings)
+
+    for depth_limit in ('S', 'D'):
+        block = encode_scan(depths, depth_limit)
+
+        def per_reading():
+            return decode_per_reading(lidar, block, depth_limit)
+
+        def whole_block():
+            return lidar.decode_block(block, depth_limit)
+
+        assert np.array_equal(per_reading(), whole_block())
+
+        old = min(repeat(per_reading, number=number, repeat=5)) / number
+        new = min(repeat(whole_block, number=number, repeat=5)) / number
+        print('LIDAR decode (' + depth_limit + ', ' + str(readings) + ' readings): ' + str(round(old * 1e6, 1)) + 'us per scan one reading at a time, '
+              + str(round(new * 1e6, 1)) + 'us per scan in one go (' + str(round(old / new, 1)) + 'x faster)')
+
+class EmulatedCreate():
+    """stands in for the Create's serial port: QUERY_LIST (149) is answered with zeros (apart from SONG_NUMBER, so that the
+    motion scripts finish at once - see Create._runMotionScript), and reading the reply takes as long as the query and reply
+    would take on the wire (10 bits per byte at the baudrate) plus the robot's turnaround time and the latency of the (USB)
+    serial adapter"""
+
+    def __init__(self, baudrate = 57600, turnaround = 0.001, latency = 0.004):
+        self.byte_time = 10 / baudrate
+        self.turnaround = turnaround
+        self.latency = latency
+        self.sizes = {ord(sensor.ID): sensor.size for sensor in SENSORS.values()}
+        self.reply = b''
+        self.wire_time = 0
+        self.song = 0 #the song last played
+
+    def isOpen(self):
+        return True
+
+    def inWaiting(self):
+        return len(self.reply)
+
+    def write(self, data):
+        self.wire_time += len(data) * self.byte_time
+        if data[0] == 149:
+            self.reply += b''.join(bytes([self.song]) if packet == ord(SENSORS['SONG_NUMBER'].ID) else bytes(self.sizes[packet])
+                                   for packet in data[2:2 + data[1]])
+            self.wire_time += self.turnaround
+
+        #a motion script that's run straight away (ending with playing its song) is done as soon as it's sent
+        elif data[0] == 152 and data[-1] == 153:
+            self.song = data[-2]
+
+    def read(self, n):
+        reply, self.reply = self.reply[:n], self.reply[n:]
+        sleep(self.wire_time + len(reply) * self.byte_time + self.latency)
+        self.wire_time = 0
+        return reply
+
+    async def serve(self, reader, writer):
+        """serves an AsyncCreate over an asyncio stream: the robot works through the commands one at a time, but the adapter's
+        latency only delays each reply on its way back, so it overlaps with the robot answering the next query"""
+        loop = asyncio.get_running_loop()
+        lengths = {137: 4, 145: 4}
+        while True:
+            try:
+                opcode = (await reader.readexactly(1))[0]
+                if opcode == 149:
+                    count = (await reader.readexactly(1))[0]
+                    packets = await reader.readexactly(count)
+                    await asyncio.sleep((2 + count) * self.byte_time + self.turnaround)
+                    reply = bytes(sum(self.sizes[packet] for packet in packets))
+                    await asyncio.sleep(len(reply) * self.byte_time)
+                    loop.call_later(self.latency, writer.write, reply)
+                else:
+                    await reader.readexactly(lengths.get(opcode, 0))
+            except asyncio.IncompleteReadError:
+                writer.close()
+                return
+
+def benchmark_get_sensors(sensors = ('DISTANCE', 'ANGLE', 'USER_ANALOG_INPUT', 'BUMPS_AND_WHEEL_DROPS', 'VOLTAGE', 'CURRENT'), number = 20):
+    """compares reading several sensors one query at a time (Create.getSensor) with a single query (Create.getSensors),
+        against an emulated robot at 57600 baud"""
+    with redirect_stdout(StringIO()): #the Create is rather chatty when connecting
+        robot = Create(EmulatedCreate(), PASSIVE_MODE)
+
+    def one_at_a_time():
+        return {name: robot.getSensor(name) for name in sensors}
+
+    def all_at_once():
+        return robot.getSensors(sensors)
+
+    assert one_at_a_time() == all_at_once()
+
+    old = min(repeat(one_at_a_time, number=number, repeat=3)) / number
+    new = min(repeat(all_at_once, number=number, repeat=3)) / number
+    print('Create sensors (' + str(len(sensors)) + ' sensors): ' + str(round(old * 1e3, 2)) + 'ms one query at a time, '
+          + str(round(new * 1e3, 2)) + 'ms in one query (' + str(round(old / new, 1)) + 'x faster)')
+
+def benchmark_async_create(sensors = ('DISTANCE', 'ANGLE', 'USER_ANALOG_INPUT', 'BUMPS_AND_WHEEL_DROPS'), number = 50):
+    """compares reading the sensors (while driving) with the Create, which waits for each reply before sending anything else,
+        with the AsyncCreate, which pipelines the queries, against an emulated robot (over a local socket for the AsyncCreate)"""
+    emulated = EmulatedCreate()
+    with redirect_stdout(StringIO()):
+        robot = Create(emulated, PASSIVE_MODE)
+
+    start = perf_counter()
+    for i in range(number):
+        robot.go(10, 0)
+        robot.getSensors(sensors)
+    old = (perf_counter() - start) / number
+
+    async def pipelined():
+        server = await asyncio.start_server(emulated.serve, '127.0.0.1', 0)
+        async_robot = await AsyncCreate.connect('sim', PASSIVE_MODE, sim_port=server.sockets[0].getsockname()[1])
+        await async_robot.getSensors(sensors)
+
+        async def driving():
+            for i in range(number):
+                await async_robot.go(10, 0)
+                await asyncio.sleep(0)
+
+        start = perf_counter()
+        replies = (await asyncio.gather(driving(), *(async_robot.getSensors(sensors) for i in range(number))))[1:]
+        elapsed = perf_counter() - start
+
+        await async_robot.close()
+        server.close()
+        await server.wait_closed()
+        assert all(reply == robot.getSensors(sensors) for reply in replies)
+        return elapsed / number
+
+    new = asyncio.run(pipelined())
+    print('Create sensors while driving (' + str(number) + ' queries): ' + str(round(old * 1e3, 2)) + 'ms per query waiting on each, '
+          + str(round(new * 1e3, 2)) + 'ms per query pipelined (' + str(round(old / new, 1)) + 'x faster)')
+
+class CountingSerial():
+    """stands in for the Create's serial port, counting the writes and bytes sent to it"""
+
+    def __init__(self):
+        self.writes = 0
+        self.sent = 0
+
+    def isOpen(self):
+        return True
+
+    def write(self, data):
+        self.writes += 1
+        self.sent += len(data)
+
+    def read(self, n):
+        return b''
+
+def benchmark_commands(number = 20000):
+    """compares sending the drive direct command built from chr() strings (re-encoded on every send) with sending it built
+        as bytes, and counts the writes it takes to send a song"""
+    port = CountingSerial()
+    with redirect_stdout(StringIO()):
+        robot = Create(port, PASSIVE_MODE)
+
+    #the old way: a string of chr()s, encoded as Latin-1 on the way out
+    def from_string():
+        leftHighVal, leftLowVal = toTwosComplement2Bytes(int(20.5 * 10))
+        rightHighVal, rightLowVal = toTwosComplement2Bytes(int(-12 * 10))
+        byteList = ''
+        for char in (rightHighVal, rightLowVal, leftHighVal, leftLowVal):
+            byteList += chr(char)
+        port.write(bytes(DRIVEDIRECT + byteList, encoding = 'Latin-1'))
+
+    def from_bytes():
+        robot.driveDirect(20.5, -12)
+
+    old = min(repeat(from_string, number=number, repeat=5)) / number
+    new = min(repeat(from_bytes, number=number, repeat=5)) / number
+    print('Create drive direct command: ' + str(round(old * 1e6, 2)) + 'us built from a string, ' + str(round(new * 1e6, 2))
+          + 'us built as bytes (' + str(round(old / new, 1)) + 'x faster)')
+
+    port.writes = port.sent = 0
+    robot.setSong(0, [(60, 8), (64, 8), (67, 8), (72, 8)])
+    print('Create song of 4 notes: ' + str(port.sent) + ' bytes in ' + str(port.writes) + ' write (was 3 + 2 per note = 11 writes)')
+
+def logaddexp_move(histogram, move):
+    """the old way of moving log probabilities: a log-sum-exp (np.logaddexp) of the whole window for every shift of the
+        kernel, rather than taking the exp of the window once and moving it as (linear) probabilities"""
+    turns, shifts, weights = histogram.motion_kernel(move)
+    height, width = histogram.map.shape
+    new_probability = np.full(histogram.p.shape, -np.inf)
+    (row_start, row_stop), (col_start, col_stop) = histogram.belief_window(histogram.p)
+    source = histogram.p[:, row_start:row_stop, col_start:col_stop]
+    with np.errstate(divide='ignore'):
+        weights = np.log(weights)
+
+    rotated = np.full_like(source, -np.inf)
+    for shift, probability in turns:
+        rotated = np.logaddexp(rotated, np.log(probability) + np.roll(source, shift, axis=0))
+
+    for (row, col), weight in zip(shifts, weights.T):
+        rows_to = slice(max(row_start + row, 0), min(row_stop + row, height))
+        cols_to = slice(max(col_start + col, 0), min(col_stop + col, width))
+        if rows_to.start >= rows_to.stop or cols_to.start >= cols_to.stop:
+            continue
+        moved = rotated[:, rows_to.start - row - row_start:rows_to.stop - row - row_start, cols_to.start - col - col_start:cols_to.stop - col - col_start]
+        new_probability[:, rows_to, cols_to] = np.logaddexp(new_probability[:, rows_to, cols_to], weight[:, np.newaxis, np.newaxis] + moved)
+
+    new_probability[:, histogram.map != 0] = -np.inf
+    return new_probability
+
+def benchmark_log_space(sizes = (100, 500), number = 20):
+    """compares the histogram filter's move and cycle with log probabilities against its (linear) probabilities, on synthetic
+        maps, along with the old log-sum-exp move - the log probabilities should only cost a little more, for the exp and
+        log of the window the move takes"""
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            fp = synthetic_map(size, directory)
+            histograms = [Histogram(None, None, None, fp = fp, drive = False, log_space = log_space) for log_space in (False, True)]
+            dense, log = histograms
+            assert np.allclose(np.exp(log.move([1, 1])), dense.move([1, 1]), rtol = 0, atol = 1e-12)
+            assert np.allclose(np.exp(logaddexp_move(log, [1, 1])), np.exp(log.move([1, 1])), rtol = 0, atol = 1e-12)
+
+            old = min(repeat(lambda: logaddexp_move(log, [1, 1]), number=number, repeat=5)) / number
+            for name, step in (('move', lambda histogram: histogram.move([1, 1])), ('cycle', filter_cycle)):
+                dense, log = (min(repeat(lambda: step(histogram), number=number, repeat=5)) / number for histogram in histograms)
+                print('Histogram ' + name + ' (' + str(size) + 'x' + str(size) + '): ' + str(round(dense * 1e6, 1)) + 'us with probabilities, '
+                      + str(round(log * 1e6, 1)) + 'us with log probabilities (' + str(round(log / dense, 2)) + 'x the time'
+                      + (', the log-sum-exp move took ' + str(round(old * 1e6, 1)) + 'us)' if name == 'move' else ')'))
+
+def measure(name, function, number = 100, **params):
+    """times number calls of function (after a warm up call), and traces the memory allocated by a few more, returning the
+        per call latency percentiles (in microseconds) and allocations (the peak bytes and the number of blocks still allocated)"""
+    function()
+
+    times = np.empty(number)
+    for i in range(number):
+        start = perf_counter_ns()
+        function()
+        times[i] = perf_counter_ns() - start
+    times /= 1e3
+
+    #allocations are traced separately (tracing slows everything down)
+    traced = max(1, min(number, 5))
+    tracemalloc.start()
+    peak, blocks = 0, 0
+    for i in range(traced):
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        size = tracemalloc.get_traced_memory()[0]
+        result = function()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - size)
+        blocks += sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(before, 'filename'))
+        del result
+    tracemalloc.stop()
+
+    return {'name': name, 'params': params, 'calls': number, 'mean_us': float(times.mean()),
+            'p50_us': float(np.percentile(times, 50)), 'p90_us': float(np.percentile(times, 90)), 'p99_us': float(np.percentile(times, 99)),
+            'alloc_peak_bytes': int(peak), 'alloc_blocks': blocks // traced}
+
+def synthetic_map(size, directory, seed = 0, walls = 0.3):
+    """writes a random size x size map (a border of walls, with walls scattered inside) as an image, returning its path"""
+    grid = np.random.default_rng(seed).random((size, size)) < walls
+    grid[[0, -1], :] = grid[:, [0, -1]] = True
+
+    fp = os.path.join(directory, 'map_' + str(size) + '.png')
+    Image.fromarray(np.where(grid, 0, 255).astype(np.uint8)).convert('RGBA').save(fp)
+    return fp
+
+def lidar_frames(log = None, number = 20, depth_limit = 'S'):
+    """returns the (timestamp, data block) of the scans in a recorded log (see replay.py), or if there's no log, of scans
+        simulated along the hallway"""
+    parser = SCIPParser(682, depth_limit)
+    if log is not None:
+        frames = []
+        for timestamp, source, direction, data in read_log(log):
+            if source == SOURCES['lidar'] and direction == RECEIVED:
+                frames += parser.feed(data)
+        return frames
+
+    world = World()
+    stream = b''
+    for i in range(number):
+        world.heading += 2 * np.pi / number
+        stream += b'MS0044072501000\n' + check_summed(b'99') + check_summed(b'0000') + encode_scan(world.scan(np.arange(44, 726)), depth_limit)
+    return parser.feed(stream)
+
+def filter_cycle(histogram, sensor_sees = [1, 0, 1]):
+    """one sense -> move -> normalize step of the histogram filter (as in its drive(), without the robot)"""
+    histogram.p = histogram.sense(sensor_sees)
+    histogram.p = histogram.normalize(histogram.move(histogram.convert_to_command(sensor_sees)))
+
+def pyramid_cycle(pyramid, depths, sensor_sees = [1, 0, 1]):
+    """one sense -> move step of the coarse-to-fine filter, first concentrating its coarse probabilities on a single cell
+        (in the middle of the map) whenever it has no refined cells"""
+    if pyramid.p is None:
+        cells = np.argwhere(pyramid.coarse.map == 0)
+        pyramid.coarse.p[:] = 0
+        pyramid.coarse.p[(0,) + tuple(cells[len(cells) // 2])] = 1
+        pyramid.p = pyramid.refine()
+
+    pyramid.update_sense(sensor_sees, depths)
+    pyramid.update_move(pyramid.convert_to_command(sensor_sees))
+
+def loop_step(histogram, lidar, parser, responses):
+    """one pass of the robot's loop, from the bytes of a lidar scan coming in (the next of the responses) to the robot being
+        told how to move: parsing and decoding the scan, reducing it to the sectors, the filter's sense, sending the move
+        to the robot (and waiting for it to be done), then the filter's move"""
+    timestamp, data = parser.feed(next(responses))[-1]
+    depths = lidar.decode_block(data)
+    sensor_sees = lidar.sectors.obstacles(depths).tolist()
+    histogram.update_sense(sensor_sees)
+    move_command = histogram.convert_to_command(sensor_sees)
+    histogram.move_robot(move_command)
+    histogram.update_move(move_command)
+
+def run_suite(sizes = (10, 100, 500, 2000), number = 100, log = None):
+    """benchmarks the hot paths: loading the map, the histogram filter's sense (of the lidar's sectors or its full scan),
+        move and normalize and the building of its sense map (on synthetic maps of each size), decoding the lidar's scans (recorded or simulated), the whole loop (see loop_step) and decoding the Create's sensors"""
+    results = []
+    depths = World().scan(np.arange(44, 726)) #a full scan (along the hallway) for the likelihood field
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            #fewer calls on the bigger maps, so the suite doesn't take forever
+            calls = max(5, min(number, number * 100 // size))
+            fp = synthetic_map(size, directory)
+            histogram = Histogram(None, None, None, fp = fp, drive = False)
+            print('map ' + str(size) + 'x' + str(size) + ' ...')
+
+            #compiling the map from its image (the first time it's loaded), and loading it from the cache after that
+            results.append(measure('Filter.compile_map', lambda: histogram.compile_map(fp), max(5, calls // 10), size = size))
+            results.append(measure('Filter.load_map', lambda: histogram.load_map(fp), calls, size = size))
+
+            results.append(measure('Histogram.sense', lambda: histogram.sense([1, 0, 1]), calls, size = size))
+            results.append(measure('Histogram.sense_scan', lambda: histogram.sense([1, 0, 1], depths), calls, size = size))
+            results.append(measure('Histogram.move', lambda: histogram.move([1, 1]), calls, size = size))
+            p = histogram.p.copy()
+            results.append(measure('Histogram.normalize', lambda: histogram.normalize(p), calls, size = size))
+            results.append(measure('Histogram.create_sense_options', lambda: histogram.create_sense_options(histogram.map), calls, size = size))
+            results.append(measure('Histogram cycle', lambda: filter_cycle(histogram), calls, size = size))
+
+            #once it's localized (all the probability on one cell, in the middle of the map), only the window around it moves
+            cells = np.argwhere(histogram.map == 0)
+            histogram.p = np.zeros_like(histogram.p)
+            histogram.p[(0,) + tuple(cells[len(cells) // 2])] = 1
+            results.append(measure('Histogram.move', lambda: histogram.move([1, 1]), calls, size = size, localized = True))
+            del histogram, p
+
+            #the same with log probabilities (where normalizing is mostly skipped)
+            histogram = Histogram(None, None, None, fp = fp, drive = False, log_space = True)
+            results.append(measure('Histogram.sense', lambda: histogram.sense([1, 0, 1]), calls, size = size, log_space = True))
+            results.append(measure('Histogram.move', lambda: histogram.move([1, 1]), calls, size = size, log_space = True))
+            results.append(measure('Histogram cycle', lambda: filter_cycle(histogram), calls, size = size, log_space = True))
+            del histogram
+
+            #more headings (with motion noise), on the smaller maps
+            if size <= 500:
+                histogram = Histogram(None, None, None, fp = fp, drive = False, headings = 16)
+                histogram.turn_noise, histogram.move_noise = 0.5, 0.1
+                results.append(measure('Histogram.move', lambda: histogram.move([1, 1]), calls, size = size, headings = 16))
+                results.append(measure('Histogram cycle', lambda: filter_cycle(histogram), calls, size = size, headings = 16))
+                del histogram
+
+            #the coarse-to-fine filter, taking the map to be at 5cm per pixel (with 1m coarse cells), once it has localized
+            if size >= 100:
+                pyramid = Pyramid(None, None, None, fp = fp, drive = False)
+                results.append(measure('Pyramid cycle', lambda: pyramid_cycle(pyramid, depths), calls, size = size))
+                del pyramid
+
+    frames = lidar_frames(log)
+    lidar = LIDAR(23, None)
+    source = 'recorded' if log is not None else 'simulated'
+    results.append(measure('LIDAR.decode_block', lambda: [lidar.decode_block(data) for timestamp, data in frames], number, frames = len(frames), source = source))
+    results.append(measure('LIDAR.decode per reading', lambda: [decode_per_reading(lidar, data) for timestamp, data in frames], number,
+                           frames = len(frames), source = source))
+    responses = [b'MS0044072501000\n' + check_summed(b'99') + timestamp + bytes([(sum(timestamp) & 0x3f) + 0x30]) + b'\n' + data + b'\n'
+                 for timestamp, data in frames]
+    stream = b''.join(responses)
+    results.append(measure('SCIPParser.feed', lambda: SCIPParser(682).feed(stream), number, frames = len(frames), source = source))
+
+    #the whole loop on the hallway, against the emulated robot (so the time on the wire is included)
+    with redirect_stdout(StringIO()):
+        robot = Create(EmulatedCreate(), PASSIVE_MODE)
+    histogram = Histogram(robot, None, None, fp = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hallway.png'), drive = False)
+    parser, scans = SCIPParser(682), itertools.cycle(responses)
+    results.append(measure('loop: scan -> filter -> command', lambda: loop_step(histogram, lidar, parser, scans), max(5, number // 10), source = source))
+
+    with redirect_stdout(StringIO()):
+        robot = Create(CountingSerial(), PASSIVE_MODE)
+    for name in ('DISTANCE', 'BUMPS_AND_WHEEL_DROPS', 'VOLTAGE'):
+        raw = [0x12] * SENSORS[name].size
+        results.append(measure('Create._interpretSensor', lambda: robot._interpretSensor(name, raw), number * 10, sensor = name))
+    layout = queryLayout(('DISTANCE', 'ANGLE', 'USER_ANALOG_INPUT', 'BUMPS_AND_WHEEL_DROPS', 'VOLTAGE', 'CURRENT'))
+    reply = bytes(layout.size)
+    results.append(measure('SensorLayout.unpack_from', lambda: layout.unpack_from(reply), number * 10, sensors = len(layout.names)))
+
+    return results
+
+def describe(result):
+    """a one line summary of a result"""
+    params = ', '.join(key + '=' + str(value) for key, value in result['params'].items())
+    return (result['name'] + ' (' + params + ')').ljust(60) + ('p50 ' + format(result['p50_us'], '.1f') + 'us').rjust(16) + \
+        ('p99 ' + format(result['p99_us'], '.1f') + 'us').rjust(16) + (format(result['alloc_peak_bytes'] / 1024, '.1f') + 'KiB peak').rjust(18) + \
+        (str(result['alloc_blocks']) + ' blocks').rjust(14)
+
+def key(result):
+    return result['name'] + json.dumps(result['params'], sort_keys = True)
+
+def environment():
+    """where the results came from (so results can be compared across commits)"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'benchmarks the hot paths of the robot\'s code')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10, 100, 500, 2000], help = 'the sizes of the synthetic maps')
+    parser.add_argument('--number', type = int, default = 100, help = 'the number of calls to time (fewer on the bigger maps)')
+    parser.add_argument('--log', help = 'a recorded log (see replay.py) to take the lidar frames from')
+    parser.add_argument('--json', help = 'write the results to this file')
+    parser.add_argument('--baseline', help = 'compare with the results in this (earlier) file')
+    parser.add_argument('--compare', action = 'store_true', help = 'run the old vs new comparisons of the optimizations instead')
+    parser.add_argument('--ci', action = 'store_true', help = 'for continuous integration: run the tests, then the suite on the small maps '
+                        '(10 and 100) with fewer calls, failing if a test fails or anything is slower than --tolerance times the --baseline')
+    parser.add_argument('--tolerance', type = float, default = 2.0, help = 'how many times slower than the baseline (p50) counts as a regression')
+    args = parser.parse_args()
+
+    if args.ci:
+        tests = subprocess.run([sys.executable, '-m', 'pytest', '-q'], cwd = os.path.dirname(os.path.abspath(__file__)))
+        if tests.returncode != 0:
+            sys.exit(tests.returncode)
+        args.sizes, args.number = [10, 100], 20
+
+    if args.compare:
+        benchmark_lidar_decode()
+        benchmark_get_sensors()
+        benchmark_async_create()
+        benchmark_commands()
+        benchmark_log_space()
+    else:
+        results = run_suite(args.sizes, args.number, args.log)
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = {key(result): result for result in json.load(f)['results']}
+
+        regressions = []
+        for result in results:
+            line = describe(result)
+            if key(result) in baseline:
+                ratio = result['p50_us'] / baseline[key(result)]['p50_us']
+                line += ('  ' + format(ratio, '.2f') + 'x baseline').rjust(20)
+                if ratio > args.tolerance:
+                    regressions.append(line)
+            print(line)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'environment': environment(), 'results': results}, f, indent = 1)
+
+        if args.ci and regressions:
+            print('\n' + str(len(regressions)) + ' regression(s), more than ' + str(args.tolerance) + 'x the baseline:')
+            print('\n'.join(regressions))
+            sys.exit(1)
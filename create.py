@@ -38,17 +38,43 @@
 
 # v2.3 Added ability to retry getting sensor data.
 
+# v2.4 Added sensor streaming (opcode 148): a reader thread validates the streamed packets
+# and caches the latest values, so getSensor() doesn't need a round trip.
+
+# v2.5 Added getSensors() to read several sensors with a single QUERY_LIST. PORT can
+# also be an already open serial-like object (anything with read/write/inWaiting).
+
+# v2.6 Sensors are decoded with precompiled structs: each SensorModule carries its own
+# struct.Struct (and bit unpacker), and multi-sensor replies decode in one unpack_from.
+
+# v2.7 Added AsyncCreate, an asyncio version of the Create over a serial port or the
+# simulator socket: commands are pipelined and replies are matched to the waiting queries.
+
+# v2.8 Commands are built as whole bytes packets (with struct) and each is sent in a
+# single write, rather than as strings re-encoded on every send() or byte by byte.
+
+# v2.9 Added moveDistance() and turn(): each move is run on the robot as a script (using its
+# own odometry to wait for the distance/angle), ending with a silent marker song whose number
+# the host waits for - so nothing is polled while the robot moves.
+
+# v2.10 Added the record argument to the constructor, logging the serial traffic (see replay.py)
+# so a run can be replayed without the robot, by passing a ReplaySerial as the PORT.
+
 # v3.0 (TODO: rename shutdown as disconnect)
 
 
 
-version = 2.3
+version = '2.10'
 
 import serial
 import socket
 import math
 import time
 import select
+import struct
+import asyncio
+from collections import deque
+from replay import RecordingSerial
 import _thread # thread libs needed to lock serial port during transmissions
 from threading import *
 
@@ -161,11 +187,71 @@ INTERNAL_CHARGER = 1
 MIN_SENSOR_RETRIES = 2 # 1 s
 RETRY_SLEEP_TIME = 0.5 # 50ms
 
+# For sensor streaming: the header byte of each streamed packet, and the sensors
+# that report the change since they were last read (so the streamed values add up)
+STREAM_HEADER = 19
+ACCUMULATED_SENSORS = ("DISTANCE", "ANGLE")
+# how long to wait after pausing the stream for the last packets (sent every 15 ms) to arrive
+STREAM_SETTLE_TIME = 0.05
+
+# For the motion scripts: the (silent) songs played at the end of each script, alternately,
+# so that the SONG_NUMBER sensor changes once the script has finished
+MOTION_SONGS = (14, 15)
+
+# The struct format (big endian) each interpretation is decoded with
+SENSOR_FORMATS = {
+"ONE_BYTE_UNPACK":"B",
+"ONE_BYTE_SIGNED":"b",
+"ONE_BYTE_UNSIGNED":"B",
+"TWO_BYTE_SIGNED":"h",
+"TWO_BYTE_UNSIGNED":"H"
+}
+
 class SensorModule:
-        def __init__(self, packetID, parseMode, packetSize):
+        def __init__(self, packetID, parseMode, packetSize, bits = (4, 3, 2, 1, 0)):
                 self.ID =packetID
                 self.interpret = parseMode
                 self.size = packetSize
+                # how to decode it, worked out once here rather than on every reading:
+                # the struct format, and for the packed sensors which bits to unpack
+                self.format = SENSOR_FORMATS.get(parseMode, str(packetSize) + "s")
+                self.struct = struct.Struct(">" + self.format)
+                self.decoder = None
+                if parseMode == "ONE_BYTE_UNPACK":
+                        self.decoder = lambda byte: [(byte >> bit) & 0x01 for bit in bits]
+                elif parseMode == "NO_HANDLING":
+                        self.decoder = list
+
+        def unpack_from(self, buffer, offset = 0):
+                """ decodes the sensor's value from buffer (bytes) at offset """
+                value = self.struct.unpack_from(buffer, offset)[0]
+                return value if self.decoder is None else self.decoder(value)
+
+class SensorLayout:
+        """ a precompiled decoder for a reply holding several sensors one after another
+        (optionally each preceded by its packet ID, as in streamed packets), so the
+        whole reply is decoded in a single unpack_from """
+        def __init__(self, sensorNames, packetIDs = False):
+                self.names = tuple(sensorNames)
+                modules = [SENSORS[name] for name in self.names]
+                self.IDs = bytes("".join(module.ID for module in modules), encoding = 'Latin-1')
+                # the whole QUERY_LIST command for the sensors
+                self.query = bytes([ord(QUERYLIST), len(modules)]) + self.IDs
+                self.struct = struct.Struct(">" + "".join(("B" if packetIDs else "") + module.format for module in modules))
+                self.size = self.struct.size
+                self.decoders = [module.decoder for module in modules]
+                self.packetIDs = packetIDs
+
+        def unpack_from(self, buffer, offset = 0):
+                """ returns a list of the (sensor name, value) in buffer (bytes) at offset,
+                or None if the packet IDs in it don't match the sensors """
+                values = self.struct.unpack_from(buffer, offset)
+                if self.packetIDs:
+                        if bytes(values[0::2]) != self.IDs:
+                                return None
+                        values = values[1::2]
+                return [(name, value if decoder is None else decoder(value))
+                        for name, value, decoder in zip(self.names, values, self.decoders)]
 
 # Sensor codes are used to ask for data along with a QUERY command.
 SENSORS = {
@@ -178,7 +264,7 @@ SENSORS = {
 "VIRTUAL_WALL":SensorModule(chr(13),"ONE_BYTE_UNSIGNED",1),
 "OVERCURRENTS":SensorModule(chr(14),"ONE_BYTE_UNPACK",1),
 "IR_BYTE":SensorModule(chr(17),"ONE_BYTE_UNSIGNED",1),
-"BUTTONS":SensorModule(chr(18),"ONE_BYTE_UNPACK",1),
+"BUTTONS":SensorModule(chr(18),"ONE_BYTE_UNPACK",1,(2,0)),
 "DISTANCE":SensorModule(chr(19),"TWO_BYTE_SIGNED",2),
 "ANGLE":SensorModule(chr(20),"TWO_BYTE_SIGNED",2),
 "CHARGING_STATE":SensorModule(chr(21),"ONE_BYTE_UNSIGNED",1),
@@ -205,16 +291,15 @@ SENSORS = {
 "LEFT_VELOCITY":SensorModule(chr(42),"TWO_BYTE_SIGNED",2)
 }
 
-# Interpretation codes are used to tell how to deal with the raw data from a sensor query
-# Note a negative value implies one byte of data is being dealt with (also includes 0), a positive implies 2 bytes
-INTERPRET = {
-"ONE_BYTE_UNPACK":-1,
-"ONE_BYTE_SIGNED":-2,
-"ONE_BYTE_UNSIGNED":-3,
-"NO_HANDLING":0,
-"TWO_BYTE_SIGNED":1,
-"TWO_BYTE_UNSIGNED":2
-}
+# The layout of each list of sensors queried with getSensors(), compiled the first
+# time the list is used
+QUERY_LAYOUTS = {}
+
+def queryLayout(sensorsToRead):
+        """ returns the (cached) SensorLayout of the query for a tuple of sensors """
+        if sensorsToRead not in QUERY_LAYOUTS:
+                QUERY_LAYOUTS[sensorsToRead] = SensorLayout(sensorsToRead)
+        return QUERY_LAYOUTS[sensorsToRead]
 
 # some module-level functions for dealing with bits and bytes
 #
@@ -294,6 +379,87 @@ def toTwosComplement2Bytes( value ):
     
         return ( (eqBitVal >> 8) & 0xFF, eqBitVal & 0xFF )
 
+def goToDrive( cmPerSec, degPerSec ):
+        """ returns the (velocity mm/s, radius mm, turn direction) of the
+        drive command that gives the robot a linear velocity of cmPerSec
+        and an angular velocity of degPerSec """
+        if cmPerSec == 0:
+            # just handle rotation
+            # convert to radians
+            radPerSec = math.radians(degPerSec)
+            # make sure the direction is correct
+            if radPerSec >= 0:  dirstr = 'CCW'
+            else: dirstr = 'CW'
+            # compute the velocity, given that the robot's
+            # radius is 258mm/2.0
+            velMmSec = math.fabs(radPerSec) * (258.0/2.0)
+            return velMmSec, 0, dirstr
+        
+        elif degPerSec == 0:
+            # just handle forward/backward translation
+            velMmSec = 10.0*cmPerSec
+            bigRadius = 32767
+            return velMmSec, bigRadius, 'CCW'
+        
+        else:
+            # move in the appropriate arc
+            radPerSec = math.radians(degPerSec)
+            velMmSec = 10.0*cmPerSec
+            radiusMm = velMmSec / radPerSec
+            # check for extremes
+            if radiusMm > 32767: radiusMm = 32767
+            if radiusMm < -32767: radiusMm = -32767
+            return velMmSec, radiusMm, 'CCW'
+
+# The layouts of the commands with 16 bit arguments, for packing them into bytes
+DRIVE_PACKET = struct.Struct(">BHH")     # opcode, two 16 bit values
+WAIT_PACKET = struct.Struct(">BH")       # opcode, one 16 bit value
+
+def drivePacket( roombaMmSec, roombaRadiusMm, turnDir='CCW' ):
+        """ returns the drive command as bytes,
+        capping the velocity and radius at the robot's limits """
+        # first, they should be ints
+        #   in case they're being generated mathematically
+        if type(roombaMmSec) != type(42):
+            roombaMmSec = int(roombaMmSec)
+        if type(roombaRadiusMm) != type(42):
+            roombaRadiusMm = int(roombaRadiusMm)
+        
+        # we check that the inputs are within limits
+        # if not, we cap them there
+        if roombaMmSec < -500:
+            roombaMmSec = -500
+        if roombaMmSec > 500:
+            roombaMmSec = 500
+        
+        # if the radius is beyond the limits, we go straight
+        # it doesn't really seem to go straight, however...
+        if roombaRadiusMm < -2000:
+            roombaRadiusMm = 32768
+        if roombaRadiusMm > 2000:
+            roombaRadiusMm = 32768
+        
+        # note the special cases
+        if roombaRadiusMm == 0:
+            if turnDir == 'CW':
+                roombaRadiusMm = -1
+            else: # default is 'CCW' (turning left)
+                roombaRadiusMm = 1
+        
+        # masking with 0xFFFF gives the two's complement of negative values
+        return DRIVE_PACKET.pack( ord(DRIVE), roombaMmSec & 0xFFFF, roombaRadiusMm & 0xFFFF )
+
+def driveDirectPacket( leftCmSec, rightCmSec ):
+        """ returns the drive direct command as bytes,
+        capping the wheel velocities at +- 50 cm/sec """
+        if leftCmSec < -50: leftCmSec = -50
+        if leftCmSec > 50:  leftCmSec = 50
+        if rightCmSec < -50: rightCmSec = -50
+        if rightCmSec > 50: rightCmSec = 50
+        
+        # convert to mm/sec, ensure we have integers
+        return DRIVE_PACKET.pack( ord(DRIVEDIRECT), int(rightCmSec*10) & 0xFFFF, int(leftCmSec*10) & 0xFFFF )
+
 def displayVersion():
     print("pycreate version", version)
 
@@ -324,9 +490,10 @@ class Create:
         
     # TODO: check if we can start in other modes...
 #======================== Starting up and Shutting Down================    
-    def __init__(self, PORT, startingMode=SAFE_MODE, sim_mode = False):
+    def __init__(self, PORT, startingMode=SAFE_MODE, sim_mode = False, record = None):
         """ the constructor which tries to open the
             connection to the robot at port PORT
+            (if record is the path of a log, the serial traffic is recorded into it)
         """
         # to do: find the shortest safe serial timeout value...
         # to do: use the timeout to do more error checking than
@@ -343,12 +510,27 @@ class Create:
         self.sim_host = '127.0.0.1'
         self.sim_port = 65000
         self.maxSensorRetries = MIN_SENSOR_RETRIES 
+
+        # fields for sensor streaming
+        self.streaming = False
+        self.streamThread = None
+        self.streamLock = Lock()             # guards the cache below
+        self.streamUpdated = Condition(self.streamLock) # notified after every streamed packet
+        self.sensorCache = {}                # latest value of each streamed sensor
+        self.sensorTimes = {}                # time.time() each streamed sensor was last updated
+        self.streamErrors = 0                # streamed packets dropped (bad checksum or length)
+
+        # fields for the motion scripts
+        self.motionSongsDefined = False      # whether the marker songs are stored on the robot yet
         
         # if PORT is the string 'simulated' (or any string for the moment)
         # we use our SRSerial class
         self.comPort = PORT   #we want to keep track of the port number for reconnect() calls
         print('PORT is', PORT)
-        if type(PORT) == type('string'):
+        if hasattr(PORT, 'read'):
+            # an already open serial-like object (e.g. an emulated robot)
+            self.ser = PORT
+        elif type(PORT) == type('string'):
             if PORT == 'sim':
                 self.init_sim_mode()
                 self.ser = None
@@ -368,6 +550,10 @@ class Create:
             except serial.SerialException:
                 print("unable to access the serial port - please cycle the robot's power")
 
+        # record everything sent and received, if asked to
+        if record is not None and self.ser is not None:
+            self.ser = RecordingSerial(self.ser, record, 'create')
+
         # did the serial port actually open?
         if self.in_sim_mode:
             print("In simulator mode")
@@ -400,24 +586,48 @@ class Create:
         #self.setLEDs(80,255,0,0) # MB: was 100, want more yellowish        
 
     def send(self, bytes1):
+        """ sends bytes1 (bytes, or a string of chr()s) in a single write """
+        if type(bytes1) == str:
+            bytes1 = bytes(bytes1, encoding = 'Latin-1')
         if self.in_sim_mode:
             if self.ser:
-                self.ser.write( (bytes(bytes1, encoding = 'Latin-1')) )
+                self.ser.write( bytes1 )
             #print(bytes1)
-            print (bytes(bytes1, encoding = 'Latin-1'))
-            self.sim_sock.send( (bytes(bytes1, encoding = 'Latin-1')) )
+            print (bytes1)
+            self.sim_sock.send( bytes1 )
         else:
-            self.ser.write( (bytes(bytes1, encoding = 'Latin-1')) )
+            self.ser.write( bytes1 )
 
     def read(self, bytes):
-        message = ""
+        return str(self.readBytes(bytes), encoding='Latin-1');
+
+    def readBytes(self, bytes):
+        message = b""
         if self.in_sim_mode:
             if self.ser:
                 self.ser.read( bytes )
             message = self.sim_sock.recv( bytes )
         else:
             message = self.ser.read( bytes )
-        return str(message, encoding='Latin-1');
+        return message
+
+    def readAvailable(self):
+        """ returns whatever bytes have arrived, waiting (up to the timeout) for at least one """
+        if self.in_sim_mode:
+            ready, _, _ = select.select([self.sim_sock], [], [], timeout)
+            return self.sim_sock.recv(4096) if ready else b""
+        return self.ser.read( max(1, self.ser.inWaiting()) )
+
+    def discardInput(self):
+        """ throws away whatever bytes have arrived but haven't been read yet
+            (reading them, rather than resetting the port's buffer, so the
+            traffic is still recorded, and works on replayed ports too) """
+        if self.in_sim_mode:
+            while select.select([self.sim_sock], [], [], 0)[0] and self.sim_sock.recv(4096):
+                pass
+        else:
+            while self.ser.inWaiting():
+                self.ser.read(self.ser.inWaiting())
 
     def init_sim_mode(self):
         print('In simulated mode, connecting to simulator socket')
@@ -432,6 +642,8 @@ class Create:
         '''
         # Just in case it was stuck moving somewhere, stop the Create:
         self.stop()
+        if self.streaming:
+            self.stopStream()
         # Close the connection:
         self._close()
         # Reestablish the serial connection to the Create:
@@ -465,6 +677,8 @@ class Create:
         stopping the Create and putting the Create into passive mode.
         '''
         self.stop()
+        if self.streaming:
+            self.stopStream()
         
         self.__sendmsg(COMMANDS["MODE_PASSIVE"],'')
 
@@ -529,6 +743,23 @@ class Create:
         self.serialLock.release()
 #unlock
 
+    def __sendpacket(self, packet):
+        '''
+        Sends a whole command (opcode and data) already built as bytes, in a
+        single write.
+        '''
+#lock
+        self.serialLock.acquire()       #note: blocking
+        successful = False
+        while not successful:
+            try:
+                self.send(packet)
+                successful = True
+            except select.error:
+                pass
+        self.serialLock.release()
+#unlock
+
     def __sendOpCode(self, opcode):
         '''
         This method functions as the base of the protocol, sending a message
@@ -572,6 +803,29 @@ class Create:
 #unlock
         return favor
 
+    def __query(self, packet, numBytes):
+        '''
+        Sends a query and receives its numBytes reply (as a string), holding
+        the lock for both, so no other thread's query or reply can come in
+        between them.
+        '''
+#lock
+        self.serialLock.acquire()
+        try:
+            self.send(packet)
+            # MB: Added ability to retry in case a user is querying the sensors
+            # while the robot is executing a wait command. Serial receive
+            # appears to block for 0.5 sec, so we don't need to sleep
+            msg = self.read(numBytes)
+            nRetries = 0
+            while len(msg) < numBytes and nRetries < self.maxSensorRetries:
+                msg += self.read(numBytes - len(msg))
+                nRetries += 1
+        finally:
+            self.serialLock.release()
+#unlock
+        return msg
+
     def __sendAndRecvMsg(self,opcode,dataSendBytes,numBytesExpected):
 #lock
         self.serialLock.acquire()
@@ -609,35 +863,8 @@ class Create:
                degPerSec degrees per second
             go() is equivalent to go(0,0)
         """
-        if cmPerSec == 0:
-            # just handle rotation
-            # convert to radians
-            radPerSec = math.radians(degPerSec)
-            # make sure the direction is correct
-            if radPerSec >= 0:  dirstr = 'CCW'
-            else: dirstr = 'CW'
-            # compute the velocity, given that the robot's
-            # radius is 258mm/2.0
-            velMmSec = math.fabs(radPerSec) * (258.0/2.0)
-            # send it off to the robot
-            self.drive( velMmSec, 0, dirstr )
-        
-        elif degPerSec == 0:
-            # just handle forward/backward translation
-            velMmSec = 10.0*cmPerSec
-            bigRadius = 32767
-            # send it off to the robot
-            self.drive( velMmSec, bigRadius )
-        
-        else:
-            # move in the appropriate arc
-            radPerSec = math.radians(degPerSec)
-            velMmSec = 10.0*cmPerSec
-            radiusMm = velMmSec / radPerSec
-            # check for extremes
-            if radiusMm > 32767: radiusMm = 32767
-            if radiusMm < -32767: radiusMm = -32767
-            self.drive( velMmSec, radiusMm )
+        # send it off to the robot
+        self.drive( *goToDrive( cmPerSec, degPerSec ) )
         return
  
     def driveDirect( self, leftCmSec=0, rightCmSec=0 ):
@@ -650,27 +877,8 @@ class Create:
                left_cm_sec:  left  wheel velocity in cm/sec (capped at +- 50)
                right_cm_sec: right wheel velocity in cm/sec (capped at +- 50)
         """
-        if leftCmSec < -50: leftCmSec = -50
-        if leftCmSec > 50:  leftCmSec = 50
-        if rightCmSec < -50: rightCmSec = -50
-        if rightCmSec > 50: rightCmSec = 50
-        
-        # convert to mm/sec, ensure we have integers
-        leftHighVal, leftLowVal = toTwosComplement2Bytes( int(leftCmSec*10) )
-        rightHighVal, rightLowVal = toTwosComplement2Bytes( int(rightCmSec*10) )
         # send these bytes and set the stored velocities
-        byteList = (rightHighVal,rightLowVal,leftHighVal,leftLowVal)
-        if type(byteList) in (list, tuple, set):
-            temp = ''
-            for char in byteList:
-                temp += chr(char)
-        byteList = temp
-        self.__sendmsg(DRIVEDIRECT,byteList)
-        #self.send( DRIVEDIRECT )
-        #self.send( chr(rightHighVal) )
-        #self.send( chr(rightLowVal) )
-        #self.send( chr(leftHighVal) )
-        #self.send( chr(leftLowVal) )
+        self.__sendpacket(driveDirectPacket( leftCmSec, rightCmSec ))
         return
         
     def waitTime(self,seconds):
@@ -690,17 +898,14 @@ class Create:
     def waitDistance(self,centimeters):
         """ robot waits for the specified distance before executing the next command (CAB)"""
         distInMm = 10*centimeters
-        distHighVal, distLowVal=toTwosComplement2Bytes( int(distInMm) )
         
         #Send the command to the Create:
-        self.__sendmsg(WAITDIST,chr(distHighVal)+chr(distLowVal))
+        self.__sendpacket(WAIT_PACKET.pack(ord(WAITDIST), int(distInMm) & 0xFFFF))
          
     def waitAngle(self,degrees):
         """ robot waits for the specified angle before executing the next command (CAB)"""
-        anglHighVal, anglLowVal=toTwosComplement2Bytes( int(degrees) )
-       
         # Send the command for data to the Create:
-        self.__sendmsg(WAITANGLE,chr(anglHighVal)+chr(anglLowVal))
+        self.__sendpacket(WAIT_PACKET.pack(ord(WAITANGLE), int(degrees) & 0xFFFF))
 
     def drive (self, roombaMmSec, roombaRadiusMm, turnDir='CCW'):
         """ implements the drive command as specified
@@ -709,57 +914,75 @@ class Create:
             used if roombaRadiusMm == 0 (or rounds down to 0)
             other drive-related calls are available
         """
-        # first, they should be ints
-        #   in case they're being generated mathematically
-        if type(roombaMmSec) != type(42):
-            roombaMmSec = int(roombaMmSec)
-        if type(roombaRadiusMm) != type(42):
-            roombaRadiusMm = int(roombaRadiusMm)
-        
-        # we check that the inputs are within limits
-        # if not, we cap them there
-        if roombaMmSec < -500:
-            roombaMmSec = -500
-        if roombaMmSec > 500:
-            roombaMmSec = 500
-        
-        # if the radius is beyond the limits, we go straight
-        # it doesn't really seem to go straight, however...
-        if roombaRadiusMm < -2000:
-            roombaRadiusMm = 32768
-        if roombaRadiusMm > 2000:
-            roombaRadiusMm = 32768
-        
-        # get the two bytes from the velocity
-        # these come back as numbers, so we will chr them
-        velHighVal, velLowVal = toTwosComplement2Bytes( roombaMmSec )
-        
-        # get the two bytes from the radius in the same way
-        # note the special cases
-        if roombaRadiusMm == 0:
-            if turnDir == 'CW':
-                roombaRadiusMm = -1
-            else: # default is 'CCW' (turning left)
-                roombaRadiusMm = 1
-        radiusHighVal, radiusLowVal = toTwosComplement2Bytes( roombaRadiusMm )
-        
-        #print 'bytes are', velHighVal, velLowVal, radiusHighVal, radiusLowVal
-        
         # send these bytes and set the stored velocities
-        byteList = (velHighVal,velLowVal,radiusHighVal,radiusLowVal)
-        if type(byteList) in (list, tuple, set):
-            temp = ''
-            for char in byteList:
-                temp += chr(char)        
-        byteList = temp
-        self.__sendmsg(DRIVE,byteList)
-        #self.send( DRIVE )
-        #self.send( chr(velHighVal) )
-        #self.send( chr(velLowVal) )
-        #self.send( chr(radiusHighVal) )
-        #self.send( chr(radiusLowVal) )
+        self.__sendpacket(drivePacket( roombaMmSec, roombaRadiusMm, turnDir ))
 
           
+#========================== MOTION SCRIPTS ==============================
+
+    def moveDistance(self, centimeters, cmPerSec=20, timeout=None):
+        '''Drives centimeters straight (backwards if negative) at cmPerSec and
+        stops. The move runs on the robot as a script, which waits on the robot's
+        own odometry, so the serial link is free while it drives. Returns True
+        once the robot has stopped, or False if it hasn't within timeout seconds
+        (by default, twice as long as the move should take, plus a second).'''
+        if centimeters == 0:
+            return True
+        cmPerSec = math.copysign(abs(cmPerSec), centimeters)
+        if timeout is None:
+            timeout = 2 * centimeters / cmPerSec + 1
+
+        return self._runMotionScript(drivePacket(10*cmPerSec, 32767) +
+                                     WAIT_PACKET.pack(ord(WAITDIST), int(10*centimeters) & 0xFFFF), timeout)
+
+    def turn(self, degrees, degPerSec=30, timeout=None):
+        '''Turns on the spot by degrees (counterclockwise if positive, clockwise
+        if negative) at degPerSec and stops, run on the robot as a script like
+        moveDistance(). Returns True once the robot has stopped, or False if it
+        hasn't within timeout seconds.'''
+        if degrees == 0:
+            return True
+        if timeout is None:
+            timeout = 2 * abs(degrees / degPerSec) + 1
+
+        # the wheel velocity for turning on the spot, given that the robot's radius is 258mm/2.0
+        velMmSec = math.radians(abs(degPerSec)) * (258.0/2.0)
+        return self._runMotionScript(drivePacket(velMmSec, 0, 'CCW' if degrees > 0 else 'CW') +
+                                     WAIT_PACKET.pack(ord(WAITANGLE), int(degrees) & 0xFFFF), timeout)
+
+    def _runMotionScript(self, commands, timeout):
+        '''Runs the commands as a script on the robot, followed by stopping and
+        playing one of the (silent) MOTION_SONGS. The song's number shows up in
+        the SONG_NUMBER sensor once the script has finished, which is waited for
+        - from the stream while streaming (which always includes SONG_NUMBER),
+        otherwise by polling.'''
+        if not self.motionSongsDefined:
+            for song in MOTION_SONGS:
+                self.setSong(song, [(30, 1)]) # a rest note, 1/64 of a second
+            self.motionSongsDefined = True
+
+        # play the other marker song than the one last played, so the sensor changes
+        song = MOTION_SONGS[1] if self.getSensor('SONG_NUMBER') == MOTION_SONGS[0] else MOTION_SONGS[0]
+        script = commands + drivePacket(0, 0) + bytes([ord(PLAY), song])
+        self.__sendpacket(bytes([ord(DEFINE_SCRIPT), len(script)]) + script + bytes([ord(RUN_SCRIPT)]))
+
+        return self._waitForSensor('SONG_NUMBER', song, timeout)
+
+    def _waitForSensor(self, sensorToRead, value, timeout):
+        '''waits (up to timeout seconds) until the sensor reads value, and returns
+        whether it did'''
+        if self.streaming:
+            with self.streamUpdated:
+                return self.streamUpdated.wait_for(lambda: self.sensorCache.get(sensorToRead) == value, timeout)
+
+        # the robot doesn't answer queries while the script waits, so getSensor() just retries until it's done
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.getSensor(sensorToRead) == value:
+                return True
+            time.sleep(RETRY_SLEEP_TIME / 10)
+        return False
+
 #========================== SENSORS ==============================        
 
     def sensorDataIsOK(self):
@@ -792,65 +1015,155 @@ class Create:
         self.maxSensorRetries = max(newTimeout, MIN_SENSOR_RETRIES)
     
     def getSensor(self, sensorToRead):
-        '''Reads the value of the requested sensor from the robot and returns it.'''
-        # Send the request for data to the Create:
-
-        self.__sendmsg(COMMANDS["QUERY_LIST"],
-                   chr(1) + SENSORS[sensorToRead].ID)
-        # Receive the reply:
-
-        # MB: Added ability to retry in case a user is querying the sensors 
-        # while the robot is executing a wait command.
-        msg = self.__recvmsg(SENSORS[sensorToRead].size)
-        nRetries = 0
-        while len(msg) < SENSORS[sensorToRead].size and nRetries < self.maxSensorRetries:
-            # Serial receive appears to block for 0.5 sec, so we don't
-            # need to sleep
-            msg = self.__recvmsg(SENSORS[sensorToRead].size)
-            nRetries += 1
-
-        #print nRetries, "retries needed"
-                    
+        '''Reads the value of the requested sensor from the robot and returns it.
+        While streaming, the latest streamed value is returned instead (or None
+        if the sensor isn't one of the streamed ones).'''
+        if self.streaming:
+            return self._getStreamedSensor(sensorToRead)
+
+        # Send the request for data to the Create, and receive the reply:
+        msg = self.__query(queryLayout((sensorToRead,)).query, SENSORS[sensorToRead].size)
+
         # Last resort: return None and force the user to deal with it,
         # rather than crashing.
         if len(msg) < SENSORS[sensorToRead].size:
             #raise CommunicationError("Improper sensor query response length: ")
             #self.close()
             return None
-        msg_len = len(msg)
-        sensor_bytes = [ord(b) for b in msg[0:msg_len]]
+        return SENSORS[sensorToRead].unpack_from(bytes(msg, encoding = 'Latin-1'))
+
+    def getSensors(self, sensorsToRead):
+        '''Reads the values of all the requested sensors with a single query
+        (rather than a round trip for each) and returns a dict of their values,
+        or None if the robot didn't reply in full.'''
+        sensorsToRead = tuple(sensorsToRead)
+        if self.streaming:
+            return {name: self._getStreamedSensor(name) for name in sensorsToRead}
+
+        layout = queryLayout(sensorsToRead)
+        size = layout.size
+
+        # Send the request for data to the Create, and receive the reply:
+        msg = self.__query(layout.query, size)
+
+        if len(msg) < size:
+            return None
 
-        return self._interpretSensor(sensorToRead,sensor_bytes)
+        return dict(layout.unpack_from(bytes(msg, encoding = 'Latin-1')))
 
     def _interpretSensor(self, sensorToRead, raw_data):
         '''interprets the raw binary data form a sensor into its appropriate form for use.  This function is for internal use - DO NOT CALL'''
-        data = None
-        interpret = SENSORS[sensorToRead].interpret
-
         if len(raw_data) < SENSORS[sensorToRead].size:
                 return None
 
-        if interpret == "ONE_BYTE_SIGNED":
-            data = self._getOneByteSigned(raw_data[0])
-        elif interpret == "ONE_BYTE_UNSIGNED":
-            data = self._getOneByteUnsigned(raw_data[0])
-        elif interpret == "TWO_BYTE_SIGNED":
-            data = self._getTwoBytesSigned(raw_data[0],raw_data[1])
-        elif interpret == "TWO_BYTE_UNSIGNED":
-            data = self._getTwoBytesUnsigned(raw_data[0],raw_data[1])
-        elif interpret == "ONE_BYTE_UNPACK":
-            if sensorToRead == "BUMPS_AND_WHEEL_DROPS":
-                data = self._getLower5Bits(raw_data[0])
-            elif sensorToRead == "BUTTONS":
-                data = self._getButtonBits(raw_data[0])
-            elif sensorToRead == "USER_DIGITAL_INPUTS":
-                data = self._getLower5Bits(raw_data[0])
-            if sensorToRead == "OVERCURRENTS":
-                data = self._getLower5Bits(raw_data[0])
-        elif interpret == "NO_HANDLING":
-            data = raw_data
-
-        return data
+        return SENSORS[sensorToRead].unpack_from(bytes(raw_data))
+
+#========================== SENSOR STREAMING ==============================
+
+    def startStream(self, sensorsToStream, timeout = 1.0):
+        '''Asks the Create to send the given sensors every 15 ms, and starts a
+        thread that reads them into a cache of the latest values, which
+        getSensor() then returns straight away. Keep the total size of the
+        sensors small (under ~80 bytes) so each packet fits in the 15 ms at
+        57600 baud. Waits (up to timeout seconds) for the first packet.
+        SONG_NUMBER is always streamed too, so the motion scripts can tell when
+        they've finished (the robot's replies to queries would be mixed in with
+        the stream, so they can't be polled for).'''
+        if self.streaming:
+            self.stopStream()
+
+        sensorsToStream = tuple(sensorsToStream)
+        if 'SONG_NUMBER' not in sensorsToStream:
+            sensorsToStream += ('SONG_NUMBER',)
+        self.streamLayout = SensorLayout(sensorsToStream, packetIDs = True)
+        with self.streamLock:
+            self.sensorCache = {name: 0 for name in sensorsToStream if name in ACCUMULATED_SENSORS}
+            self.sensorTimes = {}
+
+        self.__sendpacket(bytes([ord(STREAM), len(sensorsToStream)]) + self.streamLayout.IDs)
+
+        self.streaming = True
+        self.streamThread = Thread(target=self._readStream, daemon=True)
+        self.streamThread.start()
+
+        # wait for the first packet, so the cache is filled in
+        with self.streamUpdated:
+            self.streamUpdated.wait_for(lambda: self.sensorTimes or not self.streaming, timeout)
+
+    def stopStream(self):
+        '''Pauses the Create's stream and stops the reader thread, then throws
+        away any packets that were sent before the pause took effect (so they
+        aren't read as the reply to the next query). The serial port is locked
+        throughout, so queries sent once streaming is off wait until then.'''
+        self.serialLock.acquire()
+        try:
+            self.send(bytes([ord(PAUSERESUME), 0]))
+            self.streaming = False
+            if self.streamThread is not None:
+                self.streamThread.join()
+                self.streamThread = None
+
+            time.sleep(STREAM_SETTLE_TIME)
+            self.discardInput()
+        finally:
+            self.serialLock.release()
+
+    def _getStreamedSensor(self, sensorToRead):
+        '''returns the cached value of a streamed sensor - for the sensors that
+        report the change since they were last read (distance and angle), the
+        streamed changes are added up until they are read.'''
+        with self.streamLock:
+            value = self.sensorCache.get(sensorToRead)
+            if sensorToRead in ACCUMULATED_SENSORS and value is not None:
+                self.sensorCache[sensorToRead] = 0
+        return value
+
+    def _readStream(self):
+        '''the stream reader thread: splits the incoming bytes into packets of
+        [19][n][packet ID][data]...[checksum], checks each packet's checksum
+        (all its bytes add up to 0), and decodes them into the cache.'''
+        buffer = bytearray()
+        while self.streaming:
+            buffer += self.readAvailable()
+
+            while True:
+                # skip to the next header byte
+                start = buffer.find(STREAM_HEADER)
+                if start == -1:
+                    del buffer[:]
+                    break
+                del buffer[:start]
+
+                # wait for the whole packet
+                if len(buffer) < 2 or len(buffer) < buffer[1] + 3:
+                    break
+                packet = bytes(buffer[:buffer[1] + 3])
+
+                values = self._decodeStreamPacket(packet) if sum(packet) & 0xFF == 0 else None
+                if values is None:
+                    # not a valid packet, so this wasn't really a header: resync on the next one
+                    self.streamErrors += 1
+                    del buffer[:1]
+                    continue
+                del buffer[:len(packet)]
+
+                now = time.time()
+                with self.streamUpdated:
+                    for name, value in values:
+                        if name in ACCUMULATED_SENSORS:
+                            self.sensorCache[name] += value
+                        else:
+                            self.sensorCache[name] = value
+                        self.sensorTimes[name] = now
+                    self.streamUpdated.notify_all()
+
+    def _decodeStreamPacket(self, packet):
+        '''returns a list of the (sensor name, value) in a streamed packet, or
+        None if the packet doesn't hold (only) the streamed sensors.'''
+        if len(packet) != self.streamLayout.size + 3:
+            return None
+        return self.streamLayout.unpack_from(packet, 2)
+
 #======================= CARGO BAY OUTPUTS ==========================
 
     def setDigitalOutputs(self, digOut2, digOut1, digOut0):
@@ -922,10 +1235,7 @@ class Create:
         
         # send these as bytes
         # print 'bytes are', firstByteVal, powercolor, power
-        self.send( LEDS )
-        self.send( chr(firstByteVal) )
-        self.send( chr(powercolor) )
-        self.send( chr(power) )
+        self.send( bytes([ord(LEDS), firstByteVal, powercolor, power]) )
         
         return
 
@@ -958,12 +1268,10 @@ class Create:
         if (demoNumber < -1 or demoNumber > 9):
             demoNumber = -1 # stop current demo
         
-        self.send( DEMO )
         if demoNumber < 0 or demoNumber > 9:
             # invalid values are equivalent to stopping
-            self.send( chr(255) ) # -1
-        else:
-            self.send( chr(demoNumber) )
+            demoNumber = 255 # -1
+        self.send( bytes([ord(DEMO), demoNumber]) )
 
 #==================== MUSIC ======================     
     def setSong(self, songNumber, noteList):
@@ -988,23 +1296,20 @@ class Create:
         if songNumber > 15: songNumber = 15
         
         # indicate that a song is coming
-        self.send( SONG )
-        self.send( chr(songNumber) )
-        
         L = min(len(noteList), 16)
-        self.send( chr(L) )
+        packet = bytearray( (ord(SONG), songNumber, L) )
         
         # loop through the notes, up to 16
         for note in noteList[:L]:
             # make sure its a tuple, or else we rest for 1/4 second
             if type(note) == type( () ):
                 #more error checking here!
-                self.send( chr(note[0]) )  # note number
-                self.send( chr(note[1]) )  # duration
+                packet += bytes( (note[0], note[1]) )  # note number, duration
             else:
-                self.send( chr(30) )   # a rest note
-                self.send( chr(16) )   # 1/4 of a second
-                
+                packet += bytes( (30, 16) )   # a rest note, 1/4 of a second
+        
+        # and send the whole song at once
+        self.send( packet )
         return
         
     def playSong(self, noteList):
@@ -1021,8 +1326,7 @@ class Create:
         if songNumber < 0: songNumber = 0
         if songNumber > 15: songNumber = 15
         
-        self.send( PLAY )
-        self.send( chr(songNumber) )
+        self.send( bytes([ord(PLAY), songNumber]) )
     
     def playNote(self, noteNumber, duration, songNumber=0):
         """ plays a single note as a song (at songNumber)
@@ -1063,14 +1367,6 @@ class Create:
         return     
     
     #==================== Class Level Math functions =============
-    def _getButtonBits( self, r ):
-        """ r is one byte as an integer """
-        return [ bitOfByte(2,r), bitOfByte(0,r) ]
-    
-    def _getLower5Bits( self, r ):
-        """ r is one byte as an integer """
-        return [ bitOfByte(4,r), bitOfByte(3,r), bitOfByte(2,r), bitOfByte(1,r), bitOfByte(0,r) ]
-
     def _getOneBit( self, r ):
         """ r is one byte as an integer """
         if r == 1:  return 1
@@ -1093,8 +1389,7 @@ class Create:
         return r1 << 8 | r2
         
     def _rawSend( self, listofints ):
-        for x in listofints:
-            self.send( chr(x) )
+        self.send( bytes(listofints) )
     
     def _rawRecv( self ):
         nBytesWaiting = self.ser.inWaiting()
@@ -1115,5 +1410,243 @@ class Create:
         # but how right is it?
         return self.sciMode
     
+# ======================The ASYNCIO CREATE ROBOT CLASS==========================
+class SerialStreamWriter:
+    """ the writing half of an asyncio stream over a pyserial port (the
+        reading half is an asyncio.StreamReader fed by the event loop),
+        see openSerialStream() """
+
+    def __init__(self, ser, loop):
+        self.ser = ser
+        self.loop = loop
+
+    def write(self, data):
+        self.ser.write(data)
+
+    async def drain(self):
+        return
+
+    def close(self):
+        self.loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+
+    async def wait_closed(self):
+        return
+
+async def openSerialStream(PORT, baudrate=baudrate):
+    """ opens the serial port PORT (a name, or a number counting from 1 as
+        in the Create class) as an asyncio (reader, writer) pair - the event
+        loop reads the port whenever it has data, so the port has to be
+        selectable (i.e. not on Windows) """
+    if type(PORT) != type('string'):
+        PORT = PORT - 1
+    ser = serial.Serial(PORT, baudrate=baudrate, timeout=0)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    def readAvailable():
+        data = ser.read(max(1, ser.inWaiting()))
+        if data:
+            reader.feed_data(data)
+    loop.add_reader(ser.fileno(), readAvailable)
+    return reader, SerialStreamWriter(ser, loop)
+
+class AsyncCreate:
+    """ an asyncio version of the Create class: nothing blocks, so the
+        robot can be driven while its sensors are being read, alongside
+        other tasks in the same event loop
+
+        it stands on its own: scibot.py still drives the (blocking) Create,
+        with the LIDAR read in its own process and the gyro integrated in
+        its own thread (see sensors.py), so moving those onto this event
+        loop is still to be done
+
+        commands are written as soon as they are given, without waiting
+        for earlier queries to be answered - the Create answers queries in
+        the order they were sent, so each reply goes to the oldest query
+        still waiting on one
+
+        once a query times out, a late reply to it can't be told apart from
+        the replies to the queries after it, so those are given up on too,
+        and the next queries are held back until the line has gone quiet
+
+        use   robot = await AsyncCreate.connect(PORT)
+        where PORT is a serial port or 'sim' for the simulator socket
+    """
+
+    def __init__(self, reader, writer, timeout=timeout, quiet=0.05):
+        """ takes an already open asyncio (reader, writer) pair, see connect() """
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout              # seconds to wait for a reply before giving up on it
+        self.quiet = quiet                  # seconds without any input after which the line has settled (after a timeout)
+        self.pending = deque()              # (size, future, deadline) of the queries waiting on replies, oldest first
+        self.held = deque()                 # (data, size, future) of the queries waiting for the line to settle
+        self.settling = False
+        self.queried = asyncio.Event()      # set when a query is sent
+        self.sciMode = OFF_MODE
+        self.replyTask = asyncio.get_running_loop().create_task(self._readReplies())
+
+    @classmethod
+    async def connect(cls, PORT, startingMode=SAFE_MODE, sim_host='127.0.0.1', sim_port=65000):
+        """ opens the connection to the robot at port PORT (or to the simulator
+            if PORT is 'sim') and puts it into startingMode """
+        if PORT == 'sim':
+            reader, writer = await asyncio.open_connection(sim_host, sim_port)
+        else:
+            reader, writer = await openSerialStream(PORT)
+        robot = cls(reader, writer)
+        if startingMode == SAFE_MODE:
+            await robot.toSafeMode()
+        elif startingMode == FULL_MODE:
+            await robot.toFullMode()
+        return robot
+
+    async def close(self):
+        """ stops the robot and closes the connection """
+        await self.stop()
+        self.replyTask.cancel()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    def send(self, data):
+        """ writes a command (bytes, or a string of chr()s) to the robot,
+            without waiting for the write to finish """
+        if type(data) == str:
+            data = bytes(data, encoding='Latin-1')
+        self.writer.write(data)
+
+    async def sendAndDrain(self, data):
+        """ writes to the robot, waiting until the write is under way """
+        self.send(data)
+        await self.writer.drain()
+
+    def query(self, data, size):
+        """ sends a query and returns a future for the size bytes of its
+            reply (or None if it doesn't come within the timeout) """
+        future = asyncio.get_running_loop().create_future()
+        if self.settling:
+            self.held.append((data, size, future))
+        else:
+            self._sendQuery(data, size, future)
+        return future
+
+    def _sendQuery(self, data, size, future):
+        self.pending.append((size, future, time.monotonic() + self.timeout))
+        self.queried.set()
+        self.send(data)
+
+    async def _settle(self):
+        """ reads and throws away whatever the robot sends until it has been
+            quiet for a while, then sends the queries held back meanwhile """
+        self.settling = True
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(self.reader.read(4096), self.quiet)
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    # the connection closed (which the next read finds out again)
+                    break
+        finally:
+            self.settling = False
+            while self.held:
+                self._sendQuery(*self.held.popleft())
+
+    async def _readReplies(self):
+        """ reads whatever the robot sends and hands it out to the
+            queries waiting on it, oldest first """
+        buffer = bytearray()
+        while True:
+            if not self.pending:
+                self.queried.clear()
+                await self.queried.wait()
+                continue
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(4096), self.pending[0][2] - time.monotonic())
+            except asyncio.TimeoutError:
+                # the oldest query went unanswered: give up on it and whatever part of its reply came, and on
+                #   the queries sent after it (its reply may still come, in their place), until the line settles
+                while self.pending:
+                    size, future, deadline = self.pending.popleft()
+                    if not future.done():
+                        future.set_result(None)
+                buffer.clear()
+                await self._settle()
+                continue
+            if not chunk:
+                # the connection closed
+                while self.pending:
+                    size, future, deadline = self.pending.popleft()
+                    if not future.done():
+                        future.set_result(None)
+                return
+            buffer += chunk
+            while self.pending and len(buffer) >= self.pending[0][0]:
+                size, future, deadline = self.pending.popleft()
+                if not future.done():
+                    future.set_result(bytes(buffer[:size]))
+                del buffer[:size]
+            if not self.pending:
+                # nothing asked for the rest
+                buffer.clear()
+
+    async def getSensors(self, sensorsToRead):
+        """ reads all the requested sensors with a single query and returns a
+            dict of their values, or None if the robot didn't reply in full """
+        sensorsToRead = tuple(sensorsToRead)
+        layout = queryLayout(sensorsToRead)
+        reply = await self.query(layout.query, layout.size)
+        if reply is None:
+            return None
+        return dict(layout.unpack_from(reply))
+
+    async def getSensor(self, sensorToRead):
+        """ reads the value of the requested sensor, or None if the robot didn't reply """
+        values = await self.getSensors((sensorToRead,))
+        return None if values is None else values[sensorToRead]
+
+    async def stop(self):
+        """ stop calls go(0,0) """
+        await self.go(0,0)
+
+    async def go(self, cmPerSec=0, degPerSec=0):
+        """ sets the robot's linear velocity to cmPerSec centimeters per second
+            and its angular velocity to degPerSec degrees per second """
+        await self.drive(*goToDrive(cmPerSec, degPerSec))
+
+    async def drive(self, roombaMmSec, roombaRadiusMm, turnDir='CCW'):
+        """ implements the drive command, see Create.drive() """
+        await self.sendAndDrain(drivePacket(roombaMmSec, roombaRadiusMm, turnDir))
+
+    async def driveDirect(self, leftCmSec=0, rightCmSec=0):
+        """ sends velocities of each wheel independently, see Create.driveDirect() """
+        await self.sendAndDrain(driveDirectPacket(leftCmSec, rightCmSec))
+
+    async def start(self):
+        """ changes from OFF_MODE to PASSIVE_MODE """
+        await self.sendAndDrain(START)
+        # they recommend 20 ms between mode-changing commands
+        await asyncio.sleep(0.03)
+        self.sciMode = PASSIVE_MODE
+
+    async def toSafeMode(self):
+        """ changes the state (from PASSIVE_MODE or FULL_MODE) to SAFE_MODE """
+        await self.start()
+        await self.sendAndDrain(SAFE)
+        await asyncio.sleep(0.03)
+        self.sciMode = SAFE_MODE
+
+    async def toFullMode(self):
+        """ changes the state from PASSIVE to SAFE to FULL_MODE """
+        await self.toSafeMode()
+        await self.sendAndDrain(FULL)
+        await asyncio.sleep(0.03)
+        self.sciMode = FULL_MODE
+
+    def getMode(self):
+        """ returns one of OFF_MODE, PASSIVE_MODE, SAFE_MODE, FULL_MODE """
+        return self.sciMode
+
 if __name__ == '__main__':
     displayVersion()
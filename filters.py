@@ -1,87 +1,153 @@
-"""filters.py: a collection of filters (only one at the moment, though) for localizing the robot"""
+"""filters.py: a collection of filters for localizing the robot"""
 __author__ = "Malte Ahrens"
 __license__ = "Attribution 3.0 Unported (CC BY 3.0)"
 
 from PIL import Image
-from time import sleep, time
+import hashlib
+import os
+import shutil
+import numpy as np
 
-class Histogram():
-    """runs the histogram filter (Monte-Carlo localization) to localize the robot"""
-    
-    def __init__(self, robot, gyro, lidar_results):
-        self.robot = robot
-        self.gyro = gyro
-        self.lidar_results = lidar_results
-        	
-        #construct the map from an image
-        self.map = self.convert_image_to_map()
-
-        #note sending map[0], they're all the same for the different directions, so only send one of them
-        self.sense_map = self.create_sense_options(self.map[0]) 
-        
-        #send an initial probability where all cells are equal
-        self.p = self.normalize(self.convert_image_to_map(False))
-        
-        #start the driving / localization
-        self.drive()
+class Filter():
+    """the parts shared by all the filters: loading the map, and turning sensor readings into moves of the robot"""
 
     def convert_image_to_map(self, ones = True, fp = 'hallway.png'):
         """converts the specified image into a map (matrix) via pixel values"""
 
         #load the image with PIL (Python Imaging Library - http://www.pythonware.com/products/pil/)
-        #   python3 version (unofficial) from http://www.lfd.uci.edu/~gohlke/pythonlibs/
-        i = Image.open(fp)
-        pixels = i.load()
-        width, height = i.size
-        map = []
-
-        #go through all the pixels, and if they're black => it's non passable terrain (i.e. a wall),
-        #                               if they're white => it's movable space (i.e. the corridor in this case)
-        for y in range(height):
-            row = []
-            for x in range(width):
-                val = pixels[x, y][0] #choose the first value (of RGB) -> doesn't matter, it's Black & White
-
-                #if ones, the walls become 1
-                if ones:
-                    row.append(0 if val > 0 else 1)
-
-                #if not ones, the movable space becomes 1 (needed for the initial probability)
-                else:
-                    row.append(1 if val > 0 else 0)
-
-            map.append(row)
-
-        #return an individual map for each of the four directions (N, E, S, W)
-        #   (it's the same map, just four times)
-        return [map for direction in range(4)]
-    
-    def create_sense_options(self, map):
+        #   and convert all of its pixels into an array at once
+        pixels = np.asarray(Image.open(fp))
+        if pixels.ndim == 3:
+            pixels = pixels[:, :, 0] #choose the first value (of RGB) -> doesn't matter, it's Black & White
+
+        #if the pixels are black => it's non passable terrain (i.e. a wall),
+        #   if they're white => it's movable space (i.e. the corridor in this case)
+        #if ones, the walls become 1, if not ones, the movable space becomes 1 (needed for the initial probability)
+        map = (pixels == 0) if ones else (pixels > 0)
+        map = map.astype(np.uint8)
+
+        #return the one (height, width) map - it's the same for all four directions (N, E, S, W),
+        #   so it's only stored once (and only the probabilities are kept for each direction)
+        return map
+
+    map_cache = '.map_cache' #where the compiled maps are kept (next to their images), so each map is only compiled once
+    map_version = b'3' #bump this whenever what's compiled changes, so the old compiled maps aren't used
+    def load_map(self, fp = 'hallway.png', downsample = 1, headings = 4):
+        """returns the compiled map of the image (see compile_map) as a dictionary of read only (memory mapped) arrays,
+            compiling it (and caching it on disk, keyed by the image's hash) the first time the image is loaded"""
+        #the compiled maps of each version are kept apart (in .map_cache/v<version>/<hash>), so a bump of the version
+        #   can clear away all the older versions' maps at once
+        with open(fp, 'rb') as image:
+            key = hashlib.sha1(str((downsample, headings)).encode() + image.read()).hexdigest()
+        cache = os.path.join(os.path.dirname(os.path.abspath(fp)), self.map_cache)
+        version = 'v' + self.map_version.decode()
+        directory = os.path.join(cache, version, key)
+
+        compiled = {}
+        try:
+            for name in ('map', 'prior', 'sense_map', 'distance'):
+                compiled[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+        #not compiled yet (or a part of it is missing) => compile it now
+        except (OSError, ValueError):
+            compiled = self.compile_map(fp, downsample, headings)
+
+            #throw away the maps compiled by the other versions (or kept in the cache before it was split by version)
+            if os.path.isdir(cache):
+                for entry in os.listdir(cache):
+                    if entry != version:
+                        shutil.rmtree(os.path.join(cache, entry), ignore_errors=True)
+
+            #write each array to a temporary file first, so that another process never loads a half written one
+            try:
+                os.makedirs(directory, exist_ok=True)
+                for name, array in compiled.items():
+                    temporary = os.path.join(directory, name + '.' + str(os.getpid()) + '.npy')
+                    np.save(temporary, array)
+                    os.replace(temporary, os.path.join(directory, name + '.npy'))
+
+            #can't cache it (e.g. read only file system), so it'll just be compiled again next time
+            except OSError:
+                pass
+
+        return compiled
+
+    def compile_map(self, fp = 'hallway.png', downsample = 1, headings = 4):
+        """compiles the image (scaled down by the downsample factor) into the arrays the filters need:
+            map - the (height, width) occupancy grid (1 => wall, 0 => movable terrain)
+            prior - the (height, width) initial probability of each cell (for each of the headings)
+            sense_map - the (headings, height, width) expected sensor readings (see create_sense_options)
+            distance - the (height, width) distance (in cells) from each cell to the nearest wall"""
+        map = self.convert_image_to_map(fp = fp)
+
+        #each cell of a scaled down map covers downsample x downsample cells, and is only a wall if all of them are
+        #   (so that we can be in any cell of the scaled down map that we could be in on the full map)
+        if downsample > 1:
+            height, width = -(-map.shape[0] // downsample), -(-map.shape[1] // downsample)
+            walls = np.ones((height * downsample, width * downsample), dtype=np.uint8)
+            walls[:map.shape[0], :map.shape[1]] = map
+            map = walls.reshape(height, downsample, width, downsample).all(axis=(1, 3)).astype(np.uint8)
+
+        #the movable terrain is everything that isn't a wall (rather than loading the image a second time for it)
+        free = 1 - map
+        return {'map': map, 'prior': free / max(headings * np.count_nonzero(free), 1),
+                'sense_map': self.create_sense_options(map, headings), 'distance': self.distance_transform(map)}
+
+    def distance_transform(self, map):
+        """returns the (euclidean) distance from each cell to the nearest wall (inf if there are no walls),
+            first finding the distance to the nearest wall in the same column, then the nearest over all the columns"""
+        wall = np.asarray(map) != 0
+        height, width = wall.shape
+
+        #the distance to the nearest wall above, then (going back up) to the nearest wall above or below
+        column = np.where(wall, 0, np.inf)
+        for row in range(1, height):
+            column[row] = np.minimum(column[row], column[row - 1] + 1)
+        for row in range(height - 2, -1, -1):
+            column[row] = np.minimum(column[row], column[row + 1] + 1)
+
+        #the squared distance to the nearest wall k columns across is column ** 2 + k ** 2, so try more and more
+        #   columns across until they're further away than the furthest (so far) nearest wall - including the cells
+        #   that haven't found a wall yet (inf), e.g. in the columns without any walls
+        column **= 2
+        squared = column.copy()
+        k = 1
+        while k < width and k ** 2 < np.max(squared, initial=0):
+            np.minimum(squared[:, k:], column[:, :-k] + k ** 2, out=squared[:, k:])
+            np.minimum(squared[:, :-k], column[:, k:] + k ** 2, out=squared[:, :-k])
+            k += 1
+
+        return np.sqrt(squared)
+
+    def create_sense_options(self, map, headings = 4):
         """Creates an array of the expected sensor values for different places in the map.
-            The array is in the form of [left, forward, right] sensor values"""
-        #fill the sense_map matrix with empty arrays
-        sense_map = [[[[] for j in range(len(map[0]))] for i in range(len(map))] for direction in range(4)]
-        
-        #go through the map
-        for y in range(len(map)):
-            for x in range(len(map[y])):
-                #if it is moveable terrain
-                if map[y][x] == 0:
-                        #looking north
-                        sense_map[0][y][x] = [map[y][x - 1], map[y - 1][x], map[y][x + 1]]
-                        
-                        #looking east
-                        sense_map[1][y][x] = [map[y - 1][x], map[y][x + 1], map[y + 1][x]]
-                        
-                        #looking south
-                        sense_map[2][y][x] = [map[y][x + 1], map[y + 1][x], map[y][x - 1]]
-                        
-                        #looking west
-                        sense_map[3][y][x] = [map[y + 1][x], map[y][x - 1], map[y - 1][x]]
-                                
+            Each [left, forward, right] sensor value is packed into a 3-bit signature (see reading_to_signature),
+            so the array has the shape (headings, height, width) - the headings going clockwise from north, each
+            sensing the neighbouring cells to its left, in front and to its right (diagonally in between N, E, S, W)"""
+        map = np.asarray(map, dtype=np.uint8)
+        height, width = map.shape
+        sense_map = np.zeros((headings,) + map.shape, dtype=np.uint8)
+
+        #off the map is a wall (as for moving, and the likelihood field), so the map is surrounded by a border of walls
+        padded = np.pad(map != 0, 1, constant_values=True).astype(np.uint8)
+
+        for heading in range(headings):
+            for bit, turn in ((2, -np.pi / 2), (1, 0), (0, np.pi / 2)): #left, forward, right
+                #the neighbouring cell of every cell that way (moving forward, theta = 0, is going up a row), found by
+                #   shifting the whole (padded) map
+                theta = heading * 2 * np.pi / headings + turn
+                row, col = int(round(-np.cos(theta))), int(round(np.sin(theta)))
+                sense_map[heading] |= padded[1 + row:1 + row + height, 1 + col:1 + col + width] << bit
+
+        #walls can't be sensed from (we can't be in them), so give them a signature the lidar can never return
+        sense_map[:, map != 0] = 8
+
         return sense_map
-            
-            
+
+    def reading_to_signature(self, sensor_sees):
+        """packs a [left, forward, right] reading (e.g. [1, 0, 1]) into a single 3-bit number (e.g. 0b101 = 5)"""
+        return (int(sensor_sees[0]) << 2) | (int(sensor_sees[1]) << 1) | int(sensor_sees[2])
+
     def convert_to_command(self, sensor_sees, distance = 1):
         """converts the lidar results (e.g. [0, 1, 0]) to a [x,y] turn vector (e.g. [1,1], or move right & drive)"""
         
@@ -103,43 +169,34 @@ class Histogram():
 
         return command
 
+    turn_with_gyro = False #turn with the gyro telling the robot when to stop, rather than with the robot's own odometry
+
     def move_distance(self, distance = 1, speed = 20):
         """moves the robot a set distance (in meters) at a set speed (in cm/sec)"""
 
-        distance *= 1000 #convert to mm
-        
-        #if we are to move forward
-        if distance > 1:
-            self.robot.go(speed, 0)
-            distance *= 0.91 #tolerance
-
-        #if we are to move backwards
-        elif distance < 1:
-            self.robot.go(-speed, 0)
-            distance *= 0.91 #tolerance
-
-        #continuously check the wheel encoders (on the robot) to see if we've travelled the set distances
-        dtravelled = 0
-        while abs(dtravelled) < abs(distance):
-            dtravelled += int(self.robot.getSensor('DISTANCE') or 0) #'DISTANCE' is in mm
-            sleep(0.01)
-
-        #once we travelled that distance, stop
-        self.robot.stop()
+        #the robot drives the distance by itself (with a script waiting on its wheel encoders), and lets us know when it's done
+        #   (if it doesn't, stop it ourselves)
+        if not self.robot.moveDistance(distance * 100, speed):
+            self.robot.stop()
 
     def move_turn(self, turn = 'right', speed = 30):
-        """turns the robot a set angle (in degrees) at a set speed (in cm/sec)"""
+        """turns the robot 90 degrees (left or right) at a set speed (in degrees/sec)"""
 
-        #if we are to turn counterclockwise
-        if turn == 'left':
-            self.robot.go(0, speed)
+        if self.turn_with_gyro:
+            #if we are to turn counterclockwise
+            if turn == 'left':
+                self.robot.go(0, speed)
 
-        #if we are to turn clockwise
-        elif turn == 'right':
-            self.robot.go(0, -speed)
+            #if we are to turn clockwise
+            elif turn == 'right':
+                self.robot.go(0, -speed)
 
-        #use the gyro to tell the robot when to stop (when it has turned 90 degrees)
-        self.gyro.turn()
+            #use the gyro to tell the robot when to stop (when it has turned 90 degrees)
+            self.gyro.turn()
+
+        #otherwise the robot turns by itself, like it drives the distances
+        elif not self.robot.turn(90 if turn == 'left' else -90, speed):
+            self.robot.stop()
 
     def move_robot(self, move_command):
         """moves the robot as per the command given (e.g. [1,1] is translated to turn right then move forward 1m"""
@@ -161,9 +218,75 @@ class Histogram():
             self.move_turn('left')
             self.move_distance(1)
 
+class SparseBelief():
+    """a sparse (active-set) probability array: only the cells above a probability floor are kept,
+    as their flat indices into the dense (headings, height, width) array along with their probabilities"""
+
+    def __init__(self, shape, indices, values):
+        self.shape = shape
+        self.size = int(np.prod(shape))
+        self.indices = indices #sorted flat indices of the active cells
+        self.values = values #the probabilities of the active cells
+
+    def __len__(self):
+        return len(self.indices)
+
+    def to_dense(self):
+        """converts back to a dense (headings, height, width) probability array"""
+        p = np.zeros(self.size)
+        p[self.indices] = self.values
+
+        return p.reshape(self.shape)
+
+class Histogram(Filter):
+    """runs the histogram filter (Monte-Carlo localization) to localize the robot"""
+    
+    def __init__(self, robot, gyro, lidar_results, sparse = False, fp = 'hallway.png', drive = True, log_space = False, scans = None,
+                 cell_size = 1.0, downsample = 1, headings = 4):
+        self.robot = robot
+        self.gyro = gyro
+        self.lidar_results = lidar_results
+        self.scans = scans #the (optional) ScanRing of full lidar scans, to sense with the likelihood field (see scan_likelihood)
+        self.sparse = sparse
+        self.log_space = log_space
+        self.headings = headings #the number of headings the probabilities are split into (4 => N, E, S, W)
+        	
+        #load the compiled map of the image (compiled once, then loaded from the cache), scaled down by the downsample
+        #   factor if asked to (each pixel of the image being a cell_size x cell_size block, in meters)
+        compiled = self.load_map(fp, downsample, headings)
+        self.cell_size = cell_size * downsample
+
+        #the map is a single (height, width) array, shared by all the headings
+        self.map = compiled['map']
+
+        #the expected sensor readings at different places (and directions)
+        self.sense_map = compiled['sense_map']
+
+        #the distance from each cell to the nearest wall (for the likelihood field of the full scans)
+        self.distance = compiled['distance']
+
+        #the initial probabilities
+        self.p = self.initial_belief(compiled)
+
+        #start the driving / localization (unless we're just setting up the filter, e.g. for benchmarking)
+        if drive:
+            self.drive()
+
+    def initial_belief(self, compiled):
+        """returns the initial probabilities, where all the (movable) cells are equal
+            (p is its own contiguous (headings, height, width) float array - one for each heading - so all the updates can
+            be done as whole-array operations, and the memory needed is just the map plus the headings' probabilities)"""
+        p = np.repeat(compiled['prior'][np.newaxis], self.headings, axis=0)
+
+        #or its log (walls becoming -inf), if we're working with log probabilities
+        if self.log_space:
+            p = np.log(p, out=np.full_like(p, -np.inf), where=p > 0)
+            self.log_drift = 0
+
+        return p
+
     p = [] #probability map of where we think we are
     map = [] #map of surroundings (1 => wall, 0 => movable terrain)
-    from time import time
     def drive(self):
         """starts the process of sense (update probabilities) -> move (real robot) -> move (update probabilities), repeat"""
 
@@ -176,15 +299,16 @@ class Histogram():
             #comment out the sensor_sees = self.lid... and self.move_robot(... lines as well
             #sensor_sees = fake_sensor[x]
 
-            #get the latest results from the lidar
+            #get the latest results from the lidar (and its latest full scan, if we have them)
             sensor_sees = self.lidar_results[:]
+            depths = self.latest_depths()
 
             #update the probabilities (sense)
-            self.p = self.sense(sensor_sees)
+            self.update_sense(sensor_sees, depths)
 
             #debug stuff
             print('sensor reading: ' + str(sensor_sees))
-            self.show(self.normalize(self.p))
+            self.show(self.belief(self.p))
 
             #convert turn & distance to [x,y] command vector
             move_command = self.convert_to_command(sensor_sees)            
@@ -193,115 +317,412 @@ class Histogram():
             self.move_robot(move_command)
 
             #update the probabilities (move)
-            self.p = self.move(move_command)
-
-            #normalize the probability array
-            self.p = self.normalize(self.p)
+            self.update_move(move_command)
 
             #more debug stuff
             print('\nmove command: ' + str(move_command))
-            self.show(self.p)
+            self.show(self.belief(self.p))
             print('\n\n')
 
+    def latest_depths(self):
+        """returns a copy of the depths of the lidar's latest full scan (or None, if there are no scans), checking the
+            scan wasn't overwritten by the LIDAR process while it was being copied (and if it was, copying the newer one)"""
+        while self.scans is not None:
+            latest = self.scans.latest()
+            if latest is None:
+                break
+
+            depths = np.array(latest[3])
+            if self.scans.is_current(latest[0]):
+                return depths
+
+        return None
+
+    def update_sense(self, sensor_sees, depths = None):
+        """updates the probabilities given the sensor reading (and the full scan, if there is one)"""
+        self.p = self.sense(sensor_sees, depths)
+
+    def update_move(self, move_command):
+        """updates the probabilities given that we move, normalizing them, and switching between the sparse and dense
+            probability arrays, depending on how spread out the belief is"""
+        self.p = self.compact(self.normalize(self.move(move_command)))
+
     def normalize(self, p):
         """normalizes the probability array that they all add up to 1 again"""
 
-        #first find the sum of all the cells
+        #divide each cell by the sum of all the cells - i.e. normalize the probabilities
         #   (across all four directions so we can compare directional probability as well)
-        p_sum = 0
-        for direction in range(4):
-            for row in range(len(p[direction])):
-                p_sum += sum(p[direction][row])
-                    
-        #then divide each cell by the sum - i.e. normalize the probabilities
-        for direction in range(4):
-            for row in range(len(p[direction])):
-                for col in range(len(p[direction][row])):
-                        p[direction][row][col] /= p_sum
+        if isinstance(p, SparseBelief):
+            p.values /= p.values.sum()
+
+        #log probabilities are only normalized (by subtracting the log of the sum) once they may have drifted far enough
+        #   from 0 to lose precision (or underflow when converted back), saving a pass over all the cells most of the time
+        elif self.log_space:
+            if self.log_drift > self.log_range:
+                p -= self.log_sum(p)
+                self.log_drift = 0
+
+        else:
+            p /= p.sum()
+
+        return p
+
+    log_space = False #whether to keep the log of the probabilities (so sense and move add rather than multiply)
+    log_range = 500 #how far the log probabilities may drift (at most) before they're normalized
+    log_drift = 0 #how far the highest log probability may have dropped since the last normalization
+    def log_sum(self, p):
+        """returns the log of the sum of the exponentials of the log probabilities (without overflowing or underflowing)"""
+        highest = p.max()
+        if not np.isfinite(highest):
+            return highest
+
+        return highest + np.log(np.exp(p - highest).sum())
+
+    def belief(self, p):
+        """returns the normalized probabilities (converting them back from log probabilities if need be),
+            e.g. to show them"""
+        if self.log_space and not isinstance(p, SparseBelief):
+            return np.exp(p - self.log_sum(p))
+
+        return self.normalize(p)
+
+    sparse = False #whether to switch to a sparse probability array once the robot has (mostly) localized
+    p_floor = 1e-6 #the probability below which cells are dropped from the sparse probability array
+    sparse_fraction = 0.05 #the sparse array is used while at most this fraction of the cells are above p_floor
+    def compact(self, p):
+        """converts the (normalized) probability array to a sparse one if only a few cells are above p_floor,
+            or back to a dense one if the belief has spread out again"""
+        #(log probabilities are always kept dense)
+        if not self.sparse or self.log_space:
+            return p
+
+        if isinstance(p, SparseBelief):
+            #belief has spread out again => fall back to the dense array
+            if len(p) > self.sparse_fraction * p.size:
+                return p.to_dense()
+
+            #otherwise drop the cells that have fallen below the floor
+            keep = p.values >= self.p_floor
+            if not np.all(keep):
+                p = self.normalize(SparseBelief(p.shape, p.indices[keep], p.values[keep]))
+
+            return p
+
+        active = np.flatnonzero(p >= self.p_floor)
+        if len(active) <= self.sparse_fraction * p.size:
+            return self.normalize(SparseBelief(p.shape, active, p.reshape(-1)[active]))
 
         return p
 
     p_sense = 0.95 #the probability of successful sensor reading...pretty high
-    sense_map = [] #map of the expected sensor readings at different places (and directions)
-    def sense(self, sensor_sees):
-        """update all the probabilities given that we have new sensor information"""
-        
-        new_probability = [[] for direction in range(4)]
-
-        #go through each cell on the map
-        for direction in range(4):
-            for row in range(len(self.p[direction])):
-                    row_probabilities = []
-                    for col in range(len(self.p[direction][row])):
-                            #is the sensor result expected given the [row][col] cell?
-                            hit = (sensor_sees == self.sense_map[direction][row][col])
-                            
-                            #multiplication factor of the existing probability of that cell
-                            #   i.e. if the sensor reading matches up, it's likely we're there, so multiple by p_sense
-                            #   if doesn't multiply by 1 - p_sense (which drastically decreases it's [the cell's] probability)
-                            factor = self.p_sense if hit else 1 - self.p_sense
-                            
-                            row_probabilities.append(self.p[direction][row][col] * factor)
-                    
-                    new_probability[direction].append(row_probabilities)
+    cell_size = 1.0 #the size of a cell of the map (in meters)
+    lidar_first_step = 44 #the step of the lidar's first reading (it has 1024 steps per revolution, with step 384 facing forward)
+    likelihood_beams = 30 #the number of readings (evenly spread over the scan) the likelihood field is scored with
+    likelihood_range = (0.02, 4.0) #the readings outside this range (in meters) are errors or nothing being hit, so are left out
+    def scan_offsets(self, depths):
+        """works out which cell each (chosen) reading of a scan (in mm) ends in, as its (direction, row, col) offset from the
+            cell the robot's in, for each of the headings. Returns the distinct offsets and how many readings end there"""
+        depths = np.asarray(depths, dtype=float) / 1000
+        usable = np.flatnonzero((depths >= self.likelihood_range[0]) & (depths < self.likelihood_range[1]))
+        chosen = usable[np.linspace(0, len(usable) - 1, min(self.likelihood_beams, len(usable))).astype(int)]
+
+        #the angle of each reading, clockwise from north (the readings go counterclockwise, and the headings clockwise from N)
+        angles = (self.lidar_first_step + chosen - 384) * 2 * np.pi / 1024
+        directions = np.arange(self.headings).reshape(-1, 1)
+        theta = directions * 2 * np.pi / self.headings - angles
+
+        #starting from the middle of the cell, moving forward (theta = 0) is going up a row
+        cells = depths[chosen] / self.cell_size
+        rows = np.floor(0.5 - cells * np.cos(theta)).astype(int)
+        cols = np.floor(0.5 + cells * np.sin(theta)).astype(int)
+
+        #many readings end up in the same cell (certainly on a coarse map), so each distinct offset is only looked up once
+        offsets = np.stack([np.broadcast_to(directions, rows.shape), rows, cols], axis=-1).reshape(-1, 3)
+        return np.unique(offsets, axis=0, return_counts=True)
+
+    likelihood_sigma = 0.5 #the standard deviation (in meters) of a reading ending up away from the nearest wall
+    likelihood_hit = 0.8 #the weight of readings that hit a wall (roughly where the map says)...
+    likelihood_random = 0.2 #...versus readings that are just noise (anywhere in the range)
+    likelihood_field = None #the (padded) log likelihood of a reading ending in each cell, worked out on first use
+    def create_likelihood_field(self):
+        """works out the log likelihood of a reading ending in each cell from the distance to the nearest wall, padded by
+            the longest reading's number of cells (a reading ending off the map is scored as noise, rather than a wall hit -
+            otherwise the cells by the edge would score best with the readings that fly out of the map)"""
+        noise = self.likelihood_random / self.likelihood_range[1]
+        hit = self.likelihood_hit / (np.sqrt(2 * np.pi) * self.likelihood_sigma)
+        #(the readings end on the edges of the walls, so it's the distance to the nearest wall's edge rather than its middle)
+        distance = np.maximum(self.distance - 0.5, 0) * self.cell_size
+        field = np.log(hit * np.exp(-0.5 * (distance / self.likelihood_sigma) ** 2) + noise)
+
+        self.likelihood_padding = int(np.ceil(self.likelihood_range[1] / self.cell_size)) + 1
+        return np.pad(field, self.likelihood_padding, constant_values=np.log(noise))
+
+    def scan_likelihood(self, depths, indices = None):
+        """scores a full scan (in mm) against every cell & direction at once with the likelihood field, returning a
+            (headings, height, width) array of the log likelihood of the scan (relative to the most likely place)
+            - or if given the flat indices of some of the cells (e.g. a sparse probability array's), just theirs"""
+        if self.likelihood_field is None:
+            self.likelihood_field = self.create_likelihood_field()
+
+        height, width = self.map.shape
+        pad = self.likelihood_padding
+
+        if indices is None:
+            log_likelihood = np.zeros((self.headings, height, width))
+
+            #each offset adds the likelihood field (shifted by it) to every cell of its direction
+            for (direction, row, col), count in zip(*self.scan_offsets(depths)):
+                log_likelihood[direction] += count * self.likelihood_field[pad + row:pad + row + height, pad + col:pad + col + width]
 
-        return new_probability
+        else:
+            directions, rows, cols = np.unravel_index(indices, (self.headings, height, width))
+            cells = [np.flatnonzero(directions == direction) for direction in range(self.headings)]
+            log_likelihood = np.zeros(len(indices))
+
+            #each offset adds the likelihood field (where it ends up) to just the given cells of its direction
+            for (direction, row, col), count in zip(*self.scan_offsets(depths)):
+                at = cells[direction]
+                log_likelihood[at] += count * self.likelihood_field[pad + row + rows[at], pad + col + cols[at]]
+
+        return log_likelihood - (log_likelihood.max() if log_likelihood.size else 0)
+
+    sense_map = [] #map of the expected (packed) sensor readings at different places (and directions)
+    def sense(self, sensor_sees, depths = None):
+        """update all the probabilities given that we have new sensor information
+            (given a full scan as well, its depths in mm, the likelihood field is used rather than the sensor_sees)"""
+
+        if depths is not None:
+            return self.sense_scan(depths)
+
+        #multiplication factor of the existing probability of every cell
+        #   i.e. where the sensor reading matches up, it's likely we're there, so multiple by p_sense
+        #   where it doesn't multiply by 1 - p_sense (which drastically decreases it's [the cell's] probability)
+        signature = self.reading_to_signature(sensor_sees)
+
+        #only the active cells need to be updated for a sparse probability array
+        if isinstance(self.p, SparseBelief):
+            factor = np.where(self.sense_map.reshape(-1)[self.p.indices] == signature, self.p_sense, 1 - self.p_sense)
+            return SparseBelief(self.p.shape, self.p.indices, self.p.values * factor)
+
+        #with log probabilities, add the log of the factor instead
+        #   (the highest log probability drops by at most -log(1 - p_sense))
+        if self.log_space:
+            self.log_drift -= np.log(1 - self.p_sense)
+            return self.p + np.where(self.sense_map == signature, np.log(self.p_sense), np.log(1 - self.p_sense))
+
+        return self.p * np.where(self.sense_map == signature, self.p_sense, 1 - self.p_sense)
+
+    def sense_scan(self, depths):
+        """the sense() update for a full scan, multiplying by its likelihood (see scan_likelihood)"""
+        if isinstance(self.p, SparseBelief):
+            return SparseBelief(self.p.shape, self.p.indices, self.p.values * np.exp(self.scan_likelihood(depths, self.p.indices)))
+
+        log_likelihood = self.scan_likelihood(depths)
+
+        #(the highest log probability drops by at most the lowest log likelihood)
+        if self.log_space:
+            self.log_drift -= log_likelihood.min()
+            return self.p + log_likelihood
+
+        return self.p * np.exp(log_likelihood)
+
+    window_floor = 1e-12 #the cells with less than this fraction of the highest probability are left out of the motion update
+    def belief_window(self, p):
+        """returns the smallest window of the map holding every cell with a significant probability (see window_floor),
+            as its ((first row, last row + 1), (first col, last col + 1)), or None if there aren't any"""
+        highest = p.max()
+        if self.log_space:
+            if not np.isfinite(highest):
+                return None
+            significant = p >= highest + np.log(self.window_floor)
+        else:
+            if highest <= 0:
+                return None
+            significant = p >= highest * self.window_floor
+
+        rows = np.flatnonzero(significant.any(axis=(0, 2)))
+        cols = np.flatnonzero(significant.any(axis=(0, 1)))
+        return (rows[0], rows[-1] + 1), (cols[0], cols[-1] + 1)
 
     p_move = 0.9 #the probability of successful movement...decently high
+    turn_noise = 0 #the standard deviation of a turn (in headings per quarter turn), 0 => turns only spread over the headings they fall between
+    move_noise = 0 #the standard deviation of where a move ends up (in cells per cell moved), 0 => it only spreads over the cells it falls between
+    kernels = None #the motion kernels worked out so far, for each move
+    def motion_kernel(self, move):
+        """Works out (then caches) the kernels of a move (in meters & quarter turns clockwise, e.g. [1, 1] is turn right and
+            move 1m forward): the turn as a list of (shift in headings, probability), and the move forward as an array of
+            (row, col) shifts of the cells along with a (headings, shifts) array of the probability of each shift for
+            each heading, which includes staying on the same cell (with 1 - p_move)"""
+        if self.kernels is None:
+            self.kernels = {}
+        key = (move[0], move[1])
+        if key in self.kernels:
+            return self.kernels[key]
+
+        #the turn, spread over the headings around it (just the one if it's a whole number of headings and there's no noise)
+        turn = move[1] * self.headings / 4
+        noise = self.turn_noise * abs(move[1])
+        shifts = np.arange(int(np.floor(turn - 3 * noise)), int(np.floor(turn + 3 * noise)) + 2)
+        if noise:
+            weights = np.exp(-0.5 * ((shifts - turn) / noise) ** 2)
+        else:
+            weights = np.maximum(1 - np.abs(shifts - turn), 0)
+        turns = [(int(shift), probability) for shift, probability in zip(shifts, weights / weights.sum()) if probability > 0]
+
+        #where moving forward ends up in each heading, clockwise from north (moving forward, theta = 0, is going up a row),
+        #   spread over the cells around it
+        cells = move[0] / self.cell_size
+        theta = np.arange(self.headings) * 2 * np.pi / self.headings
+        rows, cols = np.round(-cells * np.cos(theta), 9), np.round(cells * np.sin(theta), 9)
+        noise = self.move_noise * abs(cells)
+        spread = np.arange(-int(np.ceil(3 * noise)), int(np.ceil(3 * noise)) + 2)
+        shift_rows, shift_cols = np.broadcast_arrays((np.floor(rows)[:, np.newaxis, np.newaxis] + spread[:, np.newaxis]).astype(int),
+                                                     (np.floor(cols)[:, np.newaxis, np.newaxis] + spread).astype(int))
+        row_distances = shift_rows - rows[:, np.newaxis, np.newaxis]
+        col_distances = shift_cols - cols[:, np.newaxis, np.newaxis]
+        if noise:
+            weights = np.exp(-0.5 * (row_distances ** 2 + col_distances ** 2) / noise ** 2)
+        else:
+            weights = np.maximum(1 - np.abs(row_distances), 0) * np.maximum(1 - np.abs(col_distances), 0)
+        weights = self.p_move * weights / weights.sum(axis=(1, 2), keepdims=True)
+
+        #gather the shifts of all the headings (and staying on the same cell) into one kernel
+        all_shifts = np.concatenate([np.stack([shift_rows, shift_cols], axis=-1).reshape(-1, 2), np.zeros((self.headings, 2), dtype=int)])
+        all_weights = np.concatenate([weights.reshape(-1), np.full(self.headings, 1 - self.p_move)])
+        all_headings = np.concatenate([np.repeat(np.arange(self.headings), len(spread) ** 2), np.arange(self.headings)])
+        shifts, shift = np.unique(all_shifts, axis=0, return_inverse=True)
+        weights = np.zeros((self.headings, len(shifts)))
+        np.add.at(weights, (all_headings, shift.reshape(-1)), all_weights)
+
+        #leave out the shifts that nothing moves by
+        used = weights.any(axis=0)
+        self.kernels[key] = (turns, shifts[used], weights[:, used])
+        return self.kernels[key]
+
     def move(self, move, distance = 1):
         """update all the probabilities given that we move"""
 
-        new_probability = [[] for direction in range(4)]
-        for direction in range(4):
-            #cycle the maps if there is a rotate in the move command. e.g.
-            #   if we move right, N probabilities go to E, E goes to S, etc.
-            #   using direction_index that we access the 'rotated map' data
-            #   rather than that of the current direction
-            direction_index = (direction - move[1]) % 4
-
-            #convert the relative command (relative to the robot) to one that is relative
-            #   to the current maps' direction
-            directional_move = []
-            if direction == 0: #N
-                directional_move = [move[0], 0]
-            elif direction == 1: #E
-                directional_move = [0, move[0]]
-            elif direction == 2: #S
-                directional_move = [-move[0], 0]
-            elif direction == 3: #W
-                directional_move = [0, -move[0]]
-
-            for row in range(len(self.p[direction_index])):
-                row_probabilities = []
-                for col in range(len(self.p[direction_index][row])):
-
-                    #if the cell is not a wall
-                    if self.map[direction_index][row][col] == 0:
-
-                        #the probability of the cell we're coming from (given the motion)
-                        pr_onthatcell = self.p[direction_index][(row + directional_move[0])][col - directional_move[1]]
-
-                        #the probability that we therefore arrive at this cell
-                        pr_movetocell = self.p_move * pr_onthatcell
-
-                        #the probability that instead of moving, we stay on the current cell (e.g. broken robot)
-                        #   the 1 - p_move makes it pretty small...
-                        pr_stayoncell = (1 - self.p_move) * self.p[direction_index][row][col]
-
-                        #the sum of the probabilities is the probability that we are on the current cell
-                        #   either by arriving here, or by staying here
-                        row_probabilities.append(pr_movetocell + pr_stayoncell)
-                    else:
-                        row_probabilities.append(0)
-                        
-                new_probability[direction].append(row_probabilities)
-
+        if isinstance(self.p, SparseBelief):
+            return self.move_sparse(move)
+
+        #with log probabilities, the highest one drops by at most -log(1 - p_move) (if it stays on its cell)
+        if self.log_space:
+            self.log_drift -= np.log(1 - self.p_move)
+
+        turns, shifts, weights = self.motion_kernel(move)
+        height, width = self.map.shape
+
+        #only the window around the cells with any (significant) probability is moved, everything else stays 0
+        #   (so the update gets cheaper as the robot localizes)
+        window = self.belief_window(self.p)
+        if window is None:
+            return np.full(self.p.shape, -np.inf) if self.log_space else np.zeros(self.p.shape)
+        (row_start, row_stop), (col_start, col_stop) = window
+        source = self.p[:, row_start:row_stop, col_start:col_stop]
+
+        #with log probabilities, the window is moved as (linear) probabilities relative to its highest one, taking the exp
+        #   of it once rather than a log-sum-exp for every shift of the kernel - leaving out the cells below window_floor
+        #   (by clipping them before the exp and zeroing them after it, as the exp is much slower on -inf, e.g. the walls)
+        if self.log_space:
+            highest = source.max()
+            floor = np.log(self.window_floor)
+            source = source - highest
+            significant = source >= floor
+            np.exp(np.maximum(source, floor, out=source), out=source)
+            source *= significant
+        new_probability = np.zeros(self.p.shape)
+
+        #turn (cycling the headings, e.g. if we turn right, N probabilities go to E, E goes to S, etc.)
+        #   (np.roll wraps around, so the last heading goes to the first)
+        if len(turns) == 1:
+            rotated = np.roll(source, turns[0][0], axis=0) if turns[0][0] % self.headings else source
+        else:
+            rotated = sum(probability * np.roll(source, shift, axis=0) for shift, probability in turns)
+
+        #then move each heading's probabilities forward, as a convolution with each heading's kernel: each shift of the
+        #   kernel adds the probability of the cells we're coming from (given the motion), i.e. p[row - shift][col - shift],
+        #   times the probability of the shift - including staying on the current cell (e.g. broken robot) with 1 - p_move
+        for (row, col), weight in zip(shifts, weights.T):
+            #(the headings the shift is used by, as a slice if they're all next to each other, so no copies are made)
+            headings = np.flatnonzero(weight)
+            if headings[-1] - headings[0] + 1 == len(headings):
+                headings = slice(headings[0], headings[-1] + 1)
+
+            #where the window ends up, cut off at the edges of the map (moving off the map isn't possible, so rather than
+            #   wrapping around to the other side, that probability is lost)
+            rows_to = slice(max(row_start + row, 0), min(row_stop + row, height))
+            cols_to = slice(max(col_start + col, 0), min(col_stop + col, width))
+            if rows_to.start >= rows_to.stop or cols_to.start >= cols_to.stop:
+                continue
+            rows_from = slice(rows_to.start - row - row_start, rows_to.stop - row - row_start)
+            cols_from = slice(cols_to.start - col - col_start, cols_to.stop - col - col_start)
+
+            new_probability[headings, rows_to, cols_to] += weight[headings, np.newaxis, np.newaxis] * rotated[headings, rows_from, cols_from]
+
+        #the sum of the probabilities is the probability that we are on the current cell
+        #   either by arriving here, or by staying here (unless the cell is a wall - only the window moved into can be)
+        reach = np.abs(shifts).max(axis=0)
+        rows_to = slice(max(row_start - reach[0], 0), min(row_stop + reach[0], height))
+        cols_to = slice(max(col_start - reach[1], 0), min(col_stop + reach[1], width))
+        moved_into = new_probability[:, rows_to, cols_to]
+
+        #back to log probabilities (only the window moved into has any), where the walls are -inf - the cells nothing
+        #   moved into are raised to the smallest float before the log (which is much slower on 0s), so they end up
+        #   far below anything that matters rather than at -inf
+        if self.log_space:
+            np.log(np.maximum(moved_into, np.finfo(moved_into.dtype).tiny, out=moved_into), out=moved_into)
+            moved_into += np.where(self.map[rows_to, cols_to] != 0, -np.inf, highest)
+            if moved_into.shape == new_probability.shape:
+                return new_probability
+
+            log_probability = np.full(self.p.shape, -np.inf)
+            log_probability[:, rows_to, cols_to] = moved_into
+            return log_probability
+
+        moved_into *= self.map[rows_to, cols_to] == 0
         return new_probability
 
+    def move_sparse(self, move):
+        """the move() update for a sparse probability array, which pushes each active cell forward
+            (rather than pulling every cell from where it came from)"""
+        directions, rows, cols = np.unravel_index(self.p.indices, self.p.shape)
+        turns, shifts, weights = self.motion_kernel(move)
+
+        #the heading each active cell ends up in after turning (i.e. the opposite of the turn in move())
+        new_directions = np.concatenate([(directions + shift) % self.headings for shift, probability in turns])
+        values = np.concatenate([probability * self.p.values for shift, probability in turns])
+        rows, cols = np.tile(rows, len(turns)), np.tile(cols, len(turns))
+
+        #every shift of the kernel of that heading, i.e. each cell it moves to with the probability of moving there
+        #   (including staying on the current one)
+        cell, shift = np.nonzero(weights[new_directions])
+        new_directions, rows, cols = new_directions[cell], rows[cell] + shifts[shift, 0], cols[cell] + shifts[shift, 1]
+        values = values[cell] * weights[new_directions, shift]
+
+        #we can't move off the map (just as the dense move() doesn't wrap around the edges), or be in a wall
+        #   (the map is the same for all the directions, so only the cell matters)
+        possible = (rows >= 0) & (rows < self.map.shape[0]) & (cols >= 0) & (cols < self.map.shape[1])
+        possible[possible] = self.map[rows[possible], cols[possible]] == 0
+        indices = np.ravel_multi_index((new_directions[possible], rows[possible], cols[possible]), self.p.shape)
+
+        #add up the probabilities of the cells that we can arrive at in more than one way
+        indices, inverse = np.unique(indices, return_inverse=True)
+        values = np.bincount(inverse, weights=values[possible])
+
+        return SparseBelief(self.p.shape, indices, values)
+
     def show(self, p):
         """prints the map / p / sense_map matrices with rounding and (somewhat) nicer formatting"""
 
-        for direction in range(4):
+        #only print the active cells of a sparse probability array
+        if isinstance(p, SparseBelief):
+            print('\n\t' + str(len(p)) + ' active cells (direction, row, col)')
+            for index, value in zip(zip(*np.unravel_index(p.indices, p.shape)), p.values):
+                print('\t' + str(tuple(int(i) for i in index)) + ': ' + str(round(value, 3)))
+
+            return
+
+        for direction in range(len(p)):
             print('\n\tdirection ' + str(direction))
 
             for i in range(len(p[direction])):
@@ -310,4 +731,286 @@ class Histogram():
                 for j in range(len(p[direction][0])):
                     to_print += str(round(p[direction][i][j], 3)) + ', '
 
-                print(to_print)
\ No newline at end of file
+                print(to_print)
+
+class Pyramid(Histogram):
+    """runs the histogram filter coarse-to-fine, so the robot can be localized on a detailed map (e.g. 5cm cells): the
+    whole map is only covered by a coarse histogram filter (on the map scaled down), and wherever its probabilities are
+    concentrated the cells are refined to the full map (as a sparse probability array of just those cells)"""
+
+    def __init__(self, robot, gyro, lidar_results, fp = 'hallway.png', cell_size = 0.05, downsample = 20, scans = None, drive = True,
+                 headings = 4):
+        #the coarse filter, each of its cells covering downsample x downsample cells of the map
+        self.coarse = Histogram(robot, gyro, lidar_results, fp = fp, drive = False, scans = scans, cell_size = cell_size,
+                                downsample = downsample, headings = headings)
+        self.downsample = downsample
+
+        #this (fine) filter only has probabilities for the refined cells (see initial_belief)
+        super().__init__(robot, gyro, lidar_results, sparse = True, fp = fp, drive = drive, scans = scans, cell_size = cell_size,
+                         headings = headings)
+
+    def initial_belief(self, compiled):
+        """there are no refined cells until the coarse probabilities are concentrated (so the full map never needs a dense
+            probability array)"""
+        return None
+
+    refine_mass = 0.99 #the coarse cells holding this much of the probability are the ones refined...
+    refine_fraction = 0.05 #...once they're at most this fraction of the coarse cells
+    def refine(self):
+        """refines the most likely coarse cells (if there are few enough of them) into a sparse probability array of the
+            full map, spreading each coarse cell's probability evenly over the movable cells it covers (or returns None)"""
+        coarse = self.coarse.p
+
+        #the fewest (most likely) coarse cells that hold refine_mass of the probability
+        order = np.argsort(coarse, axis=None)[::-1]
+        needed = np.searchsorted(np.cumsum(coarse.reshape(-1)[order]), self.refine_mass * coarse.sum()) + 1
+        if needed > self.refine_fraction * coarse.size:
+            return None
+        active = np.sort(order[:needed])
+
+        #all the cells covered by each active coarse cell
+        directions, rows, cols = np.unravel_index(active, coarse.shape)
+        block_rows, block_cols = np.indices((self.downsample, self.downsample)).reshape(2, 1, -1)
+        rows = (rows[:, np.newaxis] * self.downsample + block_rows).reshape(-1)
+        cols = (cols[:, np.newaxis] * self.downsample + block_cols).reshape(-1)
+        directions = np.repeat(directions, self.downsample ** 2)
+        covering = np.repeat(np.arange(len(active)), self.downsample ** 2) #the coarse cell each of them is covered by
+
+        #only the ones on the map (the edge of the coarse map can hang over it) that aren't walls
+        movable = (rows < self.map.shape[0]) & (cols < self.map.shape[1])
+        movable[movable] = self.map[rows[movable], cols[movable]] == 0
+        directions, rows, cols, covering = directions[movable], rows[movable], cols[movable], covering[movable]
+
+        values = coarse.reshape(-1)[active][covering] / np.bincount(covering, minlength=len(active))[covering]
+        indices = np.ravel_multi_index((directions, rows, cols), (self.headings,) + self.map.shape)
+        order = np.argsort(indices)
+
+        return self.normalize(SparseBelief((self.headings,) + self.map.shape, indices[order], values[order]))
+
+    def sense(self, sensor_sees, depths = None):
+        """the sense() update of the refined cells: with a full scan the likelihood field of the full map is used, otherwise
+            each cell takes on the sensor reading expected in the coarse cell covering it (its neighbours are too close
+            to tell apart with the [left, forward, right] reading)"""
+        if depths is not None:
+            return self.sense_scan(depths)
+
+        directions, rows, cols = np.unravel_index(self.p.indices, self.p.shape)
+        expected = self.coarse.sense_map[directions, rows // self.downsample, cols // self.downsample]
+        factor = np.where(expected == self.reading_to_signature(sensor_sees), self.p_sense, 1 - self.p_sense)
+
+        return SparseBelief(self.p.shape, self.p.indices, self.p.values * factor)
+
+    def compact(self, p):
+        """drops the cells below p_floor, or all of the refined cells once they have spread out too far (going back to
+            the coarse probabilities until they're concentrated again)"""
+        if len(p) == 0 or p.values.sum() == 0:
+            return None
+
+        p = super().compact(self.normalize(p))
+        return p if isinstance(p, SparseBelief) else None
+
+    def update_sense(self, sensor_sees, depths = None):
+        """updates the coarse probabilities, and the refined ones (refining the coarse ones if there aren't any yet)"""
+        self.coarse.p = self.coarse.normalize(self.coarse.sense(sensor_sees, depths))
+
+        if self.p is None:
+            self.p = self.refine()
+        else:
+            self.p = self.compact(self.sense(sensor_sees, depths))
+
+    def update_move(self, move_command):
+        """updates the coarse and the refined probabilities given that we move"""
+        self.coarse.p = self.coarse.normalize(self.coarse.move(move_command))
+
+        if self.p is not None:
+            self.p = self.compact(self.move(move_command))
+
+    def belief(self, p):
+        """the refined probabilities (always normalized), or None until there are some"""
+        return p
+
+    def show(self, p):
+        """prints the coarse probabilities until there are refined ones, then the most likely of the refined cells"""
+        if p is None:
+            self.coarse.show(self.coarse.p)
+            return
+
+        most_likely = np.argmax(p.values)
+        print('\n\t' + str(len(p)) + ' refined cells, the most likely (direction, row, col): '
+              + str(tuple(int(i) for i in np.unravel_index(p.indices[most_likely], p.shape))) + ': ' + str(round(p.values[most_likely], 3)))
+
+class Particle(Filter):
+    """runs a particle filter (Monte-Carlo localization with continuous (row, col, theta) poses) to localize the robot.
+    The number of particles adapts to how spread out they are (KLD-sampling)"""
+
+    def __init__(self, robot, gyro, lidar_results):
+        self.robot = robot
+        self.gyro = gyro
+        self.lidar_results = lidar_results
+        self.random = np.random.default_rng()
+
+        #load the (compiled) map of the image
+        self.map = self.load_map()['map']
+
+        #spread the (maximum number of) particles evenly over the movable terrain
+        self.particles = self.create_particles(self.n_max)
+        self.weights = np.full(self.n_max, 1 / self.n_max)
+
+        #start the driving / localization
+        self.drive()
+
+    def create_particles(self, n):
+        """creates n particles at random poses on the movable terrain, as an (n, 3) array of [row, col, theta]
+            (theta is the heading, 0 => N, pi/2 => E, etc. - i.e. clockwise like the direction maps of the Histogram)"""
+        cells = np.argwhere(self.map == 0)
+        cells = cells[self.random.integers(len(cells), size=n)]
+
+        particles = np.empty((n, 3))
+        particles[:, :2] = cells + self.random.random((n, 2)) #anywhere in the cell
+        particles[:, 2] = self.random.random(n) * 2 * np.pi
+
+        return particles
+
+    def is_wall(self, rows, cols):
+        """returns whether each (continuous) position is in a wall (off the map counts as a wall)"""
+        rows = np.floor(rows).astype(int)
+        cols = np.floor(cols).astype(int)
+        on_map = (rows >= 0) & (rows < self.map.shape[0]) & (cols >= 0) & (cols < self.map.shape[1])
+
+        wall = np.ones(len(rows), dtype=bool)
+        wall[on_map] = self.map[rows[on_map], cols[on_map]] != 0
+
+        return wall
+
+    def expected_signatures(self):
+        """returns the (packed, see reading_to_signature) [left, forward, right] reading expected at each particle,
+            i.e. whether there is a wall 1 cell to the left, in front and to the right of it"""
+        rows, cols, theta = self.particles.T
+        signature = np.zeros(len(self.particles), dtype=np.uint8)
+
+        for bit, turn in ((2, -np.pi / 2), (1, 0), (0, np.pi / 2)): #left, forward, right
+            #moving forward (theta = 0) is going up a row
+            signature |= self.is_wall(rows - np.cos(theta + turn), cols + np.sin(theta + turn)).astype(np.uint8) << bit
+
+        return signature
+
+    p_sense = 0.95 #the probability of successful sensor reading...pretty high
+    def sense(self, sensor_sees):
+        """update the particles' weights given that we have new sensor information"""
+
+        #if the sensor reading matches up with what the particle expects, it's likely we're there, so multiple by p_sense
+        #   if doesn't multiply by 1 - p_sense (which drastically decreases the particle's weight)
+        hit = self.expected_signatures() == self.reading_to_signature(sensor_sees)
+
+        return self.weights * np.where(hit, self.p_sense, 1 - self.p_sense)
+
+    p_move = 0.9 #the probability of successful movement...decently high
+    move_noise = 0.1 #the standard deviation of the distance travelled (as a fraction of the distance)
+    turn_noise = np.radians(5) #the standard deviation of the angle turned (in radians)
+    def move(self, move):
+        """moves all the particles (with a bit of noise) given that we move, and returns their new weights"""
+        n = len(self.particles)
+
+        #turn first (move[1] is in quarter turns, clockwise)...
+        self.particles[:, 2] += move[1] * np.pi / 2 + self.random.normal(0, self.turn_noise, n)
+        self.particles[:, 2] %= 2 * np.pi
+
+        #...then drive forward, unless the move fails (e.g. broken robot) and we stay where we are
+        distance = move[0] * (1 + self.random.normal(0, self.move_noise, n))
+        distance *= self.random.random(n) < self.p_move
+        self.particles[:, 0] -= distance * np.cos(self.particles[:, 2])
+        self.particles[:, 1] += distance * np.sin(self.particles[:, 2])
+
+        #we can't be in a wall
+        return np.where(self.is_wall(self.particles[:, 0], self.particles[:, 1]), 0, self.weights)
+
+    def normalize(self, weights):
+        """normalizes the weights that they all add up to 1 again"""
+        weights_sum = weights.sum()
+
+        #all the particles have ended up in walls, so we're lost => start again
+        if weights_sum == 0:
+            self.particles = self.create_particles(self.n_max)
+            return np.full(self.n_max, 1 / self.n_max)
+
+        return weights / weights_sum
+
+    n_min = 100 #the fewest particles to keep
+    n_max = 5000 #the most particles to keep (and the number we start with)
+    kld_epsilon = 0.05 #the maximum error (KL-distance) between the particles and the true belief
+    kld_z = 2.326 #the upper 1 - delta quantile of the standard normal distribution (delta = 0.01)
+    bin_size = 0.5 #the size (in cells) of the bins used to count how spread out the particles are
+    bin_angle = np.pi / 8 #the angular size (in radians) of those bins
+    resample_fraction = 0.5 #resample once the effective number of particles drops below this fraction of them
+    def resample(self):
+        """draws a new set of particles in proportion to their weights (low-variance resampling), keeping only as many
+            as KLD-sampling says are needed to represent how spread out they are"""
+
+        #low-variance resampling: a single random offset, then evenly spaced steps through the cumulative weights
+        steps = (self.random.random() + np.arange(self.n_max)) / self.n_max
+        chosen = np.searchsorted(np.cumsum(self.weights), steps)
+        chosen = np.minimum(chosen, len(self.particles) - 1) #in case of rounding at the end of the cumsum
+
+        #shuffle them so that any first n of them are an unbiased sample
+        particles = self.particles[self.random.permutation(chosen)]
+
+        #count the number of occupied bins k after each particle
+        bins = np.floor(particles / [self.bin_size, self.bin_size, self.bin_angle]).astype(np.int64)
+        bins = np.ravel_multi_index((bins - bins.min(axis=0)).T, bins.max(axis=0) - bins.min(axis=0) + 1)
+        new_bin = np.zeros(self.n_max, dtype=bool)
+        new_bin[np.unique(bins, return_index=True)[1]] = True
+        k = np.maximum(np.cumsum(new_bin), 2)
+
+        #the number of particles KLD-sampling needs for k bins (Fox, 2003)
+        a = 2 / (9 * (k - 1))
+        n_needed = (k - 1) / (2 * self.kld_epsilon) * (1 - a + np.sqrt(a) * self.kld_z) ** 3
+
+        #keep the first n particles once n is enough for the bins they occupy
+        enough = np.flatnonzero(np.arange(1, self.n_max + 1) >= np.maximum(n_needed, self.n_min))
+        n = enough[0] + 1 if len(enough) else self.n_max
+
+        self.particles = particles[:n].copy()
+        self.weights = np.full(n, 1 / n)
+
+    def drive(self):
+        """starts the process of sense (update weights) -> resample -> move (real robot) -> move (update particles), repeat"""
+
+        #limit the loop to just 10 times...makes catching an escaping robot easier...
+        for x in range(10):
+            #get the latest results from the lidar
+            sensor_sees = self.lidar_results[:]
+
+            #update the weights (sense) and, once too few particles carry most of the weight, draw a new set of them
+            self.weights = self.normalize(self.sense(sensor_sees))
+            if 1 / np.sum(self.weights ** 2) < self.resample_fraction * len(self.particles):
+                self.resample()
+
+            #debug stuff
+            print('sensor reading: ' + str(sensor_sees))
+            self.show()
+
+            #convert turn & distance to [x,y] command vector
+            move_command = self.convert_to_command(sensor_sees)
+
+            #actually move the robot
+            self.move_robot(move_command)
+
+            #update the particles (move)
+            self.weights = self.normalize(self.move(move_command))
+
+            #more debug stuff
+            print('\nmove command: ' + str(move_command))
+            self.show()
+            print('\n\n')
+
+    def show(self):
+        """prints the (weighted) mean pose of the particles and how spread out they are"""
+        rows, cols, theta = self.particles.T
+
+        #average the headings as vectors, so that 359 and 1 degrees average to 0 (rather than 180)
+        heading = np.degrees(np.arctan2(np.sum(self.weights * np.sin(theta)), np.sum(self.weights * np.cos(theta)))) % 360
+
+        print('\t' + str(len(self.particles)) + ' particles')
+        print('\tmean pose (row, col, heading): ' + str(round(np.sum(self.weights * rows), 2)) + ', '
+              + str(round(np.sum(self.weights * cols), 2)) + ', ' + str(round(heading, 1)))
+        print('\tspread (rows, cols): ' + str(round(np.std(rows), 2)) + ', ' + str(round(np.std(cols), 2)))
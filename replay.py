@@ -0,0 +1,220 @@
+"""replay.py: records the raw traffic of the robot's serial ports into a log, and replays it (in place of the ports) later on"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import math
+import os
+import struct
+from multiprocessing import Array, Value
+from time import perf_counter, sleep, time
+
+#each record in the log is a header (time, source, direction, length of the data) followed by the data itself
+RECORD = struct.Struct('<dBBI')
+SOURCES = {'create': 0, 'lidar': 1} #the ports that can be recorded (into the same log)
+RECEIVED, SENT = 0, 1 #the direction of the data
+
+def read_log(path):
+    """yields the (time, source, direction, data) records of a log"""
+    with open(path, 'rb') as log:
+        contents = log.read()
+
+    offset = 0
+    while offset + RECORD.size <= len(contents):
+        timestamp, source, direction, length = RECORD.unpack_from(contents, offset)
+        offset += RECORD.size
+
+        #a record cut short (e.g. the process was killed mid-write) ends the log
+        if offset + length > len(contents):
+            return
+
+        yield timestamp, source, direction, contents[offset:offset + length]
+        offset += length
+
+class RecordingSerial():
+    """Wraps a serial port (or anything with the same read/write/inWaiting methods), logging everything read from
+    and written to it. Each record is appended to the log in a single write, so several ports (even from different
+    processes, e.g. the LIDAR's) can be recorded into the same log"""
+
+    def __init__(self, port, path, source):
+        self.port = port
+        self.path = path
+        self.source = SOURCES[source]
+        self.log = None #opened on first use, so the port can be handed to another process before then
+
+    def record(self, direction, data):
+        if self.log is None:
+            self.log = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+
+        os.write(self.log, RECORD.pack(time(), self.source, direction, len(data)) + bytes(data))
+
+    def read(self, size = 1):
+        data = self.port.read(size)
+        if data:
+            self.record(RECEIVED, data)
+        return data
+
+    def write(self, data):
+        self.record(SENT, data)
+        return self.port.write(data)
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+    def isOpen(self):
+        return self.port.isOpen()
+
+    def close(self):
+        if self.log is not None:
+            os.close(self.log)
+            self.log = None
+        self.port.close()
+
+class ReplayClock():
+    """The virtual time of a replay that runs as fast as possible, shared by its ports (even across processes, so create it
+    in the main process and hand it to each ReplaySerial before the LIDAR process is started). The port of the robot leads:
+    each command written to it moves the clock on to the next command it was recorded sending, making everything that was
+    received before then due (from the robot and the lidar alike). The other ports follow it: the leading port doesn't
+    return from a write until they've read everything that's due and come back for more (i.e. their reader is done with
+    it), so what the robot's host sees after each command is the same every time the log is replayed"""
+
+    def __init__(self, lead = 'create', timeout = 5):
+        self.lead = SOURCES[lead]
+        self.timeout = timeout #how long (in real time) to wait for the following ports, e.g. if their process has died
+        self.now = Value('d', -math.inf) #everything recorded before this time is due
+
+        #for each source: whether a port follows the clock, whether it has started reading, and the clock's time when it
+        #   last came back for more with nothing left that was due
+        self.following = Array('b', len(SOURCES))
+        self.started = Array('b', len(SOURCES))
+        self.caught_up = Array('d', [-math.inf] * len(SOURCES))
+
+    def advance(self, now):
+        """moves the clock on to now (only the leading port does this), then waits for the started ports to catch up"""
+        self.now.value = now
+        self.wait(lambda source: self.started[source], self.timeout)
+
+    def sync(self, timeout = None):
+        """waits until every following port has started and caught up with the clock, e.g. once the LIDAR process has been
+            started (and before the filter first looks at its results), returning whether they did"""
+        return self.wait(lambda source: True, self.timeout if timeout is None else timeout)
+
+    def wait(self, waiting_for, timeout):
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            now = self.now.value
+            if all(self.caught_up[source] >= now for source in range(len(SOURCES)) if self.following[source] and waiting_for(source)):
+                return True
+            sleep(0.0005)
+
+        return False
+
+class ReplaySerial():
+    """Stands in for a recorded serial port, giving back what was read from it (whatever is written to it is ignored).
+    Without a clock, the data becomes available as long after the first read or write as it came after the port's first
+    record, i.e. in real time. With a (shared) ReplayClock, it's replayed as fast as possible: each read takes the next
+    recorded piece that's due by the clock (see ReplayClock), so it's read in the same pieces as it was recorded"""
+
+    def __init__(self, path, source, clock = None, timeout = 0.5):
+        self.path = path
+        self.source = SOURCES[source]
+        self.clock = clock
+        self.timeout = timeout #how long a read waits for data (like the serial port's timeout)
+        self.records = None #loaded on first use, so the port can be handed to another process before then
+
+        #the leading port starts the clock at its first command straight away (so what was received before then is due),
+        #   the others let it know they follow it
+        if clock is not None and self.source == clock.lead:
+            self.load()
+        elif clock is not None:
+            clock.following[self.source] = 1
+
+    def load(self):
+        records = [(timestamp, direction, data) for timestamp, source, direction, data in read_log(self.path) if source == self.source]
+        self.first = records[0][0] if records else 0
+
+        #the data received, and when - as well as when each command was sent, for the leading port of a clock
+        self.records = [(timestamp, data) for timestamp, direction, data in records if direction == RECEIVED]
+        self.sent = [timestamp for timestamp, direction, data in records if direction == SENT]
+        self.writes = 0 #the number of writes so far
+        self.record = 0 #the next record to read from
+        self.buffer = b'' #the part of the last record that hasn't been read yet
+        self.start = perf_counter()
+
+        if self.clock is not None and self.source == self.clock.lead:
+            self.clock.now.value = self.sent[0] if self.sent else math.inf
+        elif self.clock is not None:
+            self.clock.started[self.source] = 1
+
+    def available(self):
+        """moves the data that's due by now into the buffer, and returns when the next record is due (or None)"""
+        if self.records is None:
+            self.load()
+
+        now = perf_counter() - self.start
+        while self.record < len(self.records) and self.records[self.record][0] - self.first <= now:
+            self.buffer += self.records[self.record][1]
+            self.record += 1
+
+        return self.records[self.record][0] - self.first - now if self.record < len(self.records) else None
+
+    def next_due(self):
+        """(replaying on a clock) moves the next record into the buffer if it's due by the clock, and returns whether it
+            was - if it wasn't, a following port has caught up with the clock"""
+        if self.records is None:
+            self.load()
+
+        now = self.clock.now.value
+        if self.record < len(self.records) and self.records[self.record][0] < now:
+            self.buffer += self.records[self.record][1]
+            self.record += 1
+            return True
+
+        if self.source != self.clock.lead:
+            self.clock.caught_up[self.source] = now if self.record < len(self.records) else math.inf
+        return False
+
+    def read(self, size = 1):
+        #wait (up to the timeout) for enough data
+        deadline = perf_counter() + self.timeout
+        if self.clock is not None:
+            while len(self.buffer) < size:
+                if not self.next_due():
+                    if perf_counter() >= deadline:
+                        break
+                    sleep(0.0005)
+        else:
+            due = self.available()
+            while len(self.buffer) < size and perf_counter() < deadline:
+                sleep(max(0, min(deadline - perf_counter(), self.timeout if due is None else due)))
+                due = self.available()
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def write(self, data):
+        if self.records is None:
+            self.load()
+
+        #each command of the leading port moves the clock on to when the next one was sent
+        if self.clock is not None and self.source == self.clock.lead:
+            self.writes += 1
+            self.clock.advance(self.sent[self.writes] if self.writes < len(self.sent) else math.inf)
+        return len(data)
+
+    def inWaiting(self):
+        if self.clock is not None:
+            if not self.buffer:
+                self.next_due()
+        else:
+            self.available()
+        return len(self.buffer)
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        return
+
+    def finished(self):
+        """whether everything recorded has been read"""
+        return self.records is not None and self.record == len(self.records) and not self.buffer
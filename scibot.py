@@ -2,33 +2,65 @@
 __author__ = "Malte Ahrens"
 __license__ = "Attribution 3.0 Unported (CC BY 3.0)"
 
-from multiprocessing import Process, Array
-from time import sleep
+from multiprocessing import Array
+import sys
 from create import *
-from sensors import LIDAR, Gyroscope
+from sensors import LIDAR, Gyroscope, ScanRing
+from replay import ReplayClock, ReplaySerial
+from simulator import Simulator
 from filters import Histogram
 
 if __name__ == '__main__':
+    #python scibot.py record <log> records the traffic of the robot & lidar into the log,
+    #python scibot.py replay <log> [fast] plays it back (in real time, or as fast as possible) instead of using the robot & lidar
+    #python scibot.py sim runs everything against the simulated robot & lidar (see simulator.py)
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    log = sys.argv[2] if len(sys.argv) > 2 else None
+    record = log if mode == 'record' else None
+    clock = ReplayClock() if mode == 'replay' and 'fast' in sys.argv[3:] else None #keeps the replayed ports in step
+    if mode == 'replay':
+        robot_port, lidar_port = ReplaySerial(log, 'create', clock), ReplaySerial(log, 'lidar', clock)
+    elif mode == 'sim':
+        simulator = Simulator()
+        simulator.start()
+        robot_port, lidar_port = 'sim', simulator.lidar_port
+    else:
+        robot_port, lidar_port = 5, 23
+
     #initialize COM connections with the robot (handled by the create library)
-    robot = Create(5)
+    robot = Create(robot_port, record = record)
+
+    #have the robot stream the sensors we use (every 15ms), so reading them doesn't need a round trip each time
+    #   (SONG_NUMBER lets us know when the robot has finished a move)
+    robot.startStream(['DISTANCE', 'ANGLE', 'USER_ANALOG_INPUT', 'BUMPS_AND_WHEEL_DROPS', 'SONG_NUMBER'])
 
     #initialize the gyroscope (calibrate it)
     gyro = Gyroscope(robot)
 
     #initialize the LIDAR to com port 23 (& provide the SynchronizedArray from multiprocessing to facilitate the sharing of memory)
     lidar_results = Array('i', 3)
-    lidar = LIDAR(23, lidar_results)
+
+    #the full scans (with timestamps) are published into a ring buffer in shared memory as well
+    lidar_scans = ScanRing()
+    lidar = LIDAR(lidar_port, lidar_results, lidar_scans, record = record)
     lidar.start()
 
     #TODO: see if we need to wait here until the lidar has fully initialized
+    #(replaying as fast as possible, the lidar does have to catch up with the replay before the filter first looks at it)
+    if clock is not None:
+        clock.sync()
 
     #start the robot service (movement, localization, etc.)
-    #for debugging, use histogram_filter = Histogram(0,0,0) and comment out all the initialization lines of robot, gyro, and lidar
-    #and be sure to do some (un)commenting in filters.py, in the drive() function
+    #for debugging, replay a recorded run (see above), or use histogram_filter = Histogram(0,0,0) and comment out all the
+    #initialization lines of robot, gyro, and lidar and be sure to do some (un)commenting in filters.py, in the drive() function
+    #(or import Particle from filters and swap in Particle(robot, gyro, lidar_results) to localize with the particle filter instead,
+    #   or pass scans = lidar_scans to have the histogram filter score the full scans with its likelihood field)
     histogram_filter = Histogram(robot, gyro, lidar_results)
 
     #don't hide my cmd window!
     input()
 
-    #end the lidar process
+    #end the lidar process (and free the shared memory of its scans)
     lidar.terminate()
+    lidar_scans.close()
+    lidar_scans.unlink()
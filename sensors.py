@@ -3,61 +3,132 @@ __author__ = "Malte Ahrens"
 __license__ = "Attribution 3.0 Unported (CC BY 3.0)"
 
 from multiprocessing import Process, Array
-from time import clock, sleep
+from multiprocessing.shared_memory import SharedMemory
+from threading import Thread, Condition, Event
+from time import perf_counter, sleep, time
+import numpy as np
 import serial
+from replay import RecordingSerial
 
 class Gyroscope():
-    """Calibrates and provides the angular velocity from the gyroscope
+    """Calibrates and provides the angular velocity from the gyroscope, which a background thread integrates (at a fixed
+    rate) into the yaw angle - continuously while the robot streams its sensors (so sampling is just reading the stream's
+    cache), otherwise only while turn() waits on it (so the serial port isn't queried all the time)
     Designed for & tested with the Analog Devices ADXR652 - http://www.analog.com/en/mems-sensors/mems-inertial-sensors/adxrs652/products/product.html"""
 
-    def __init__(self, robot):
+    def __init__(self, robot, rate = 200):
         self.robot = robot
         self.calibrate()
 
+        #the latest [time, yaw angle, angular velocity] of the integrator, in shared memory (so other processes can read it too)
+        self.state = Array('d', [perf_counter(), 0, 0])
+
+        #notified after every sample, so turn() can wait on the yaw angle rather than polling it
+        self.updated = Condition()
+
+        #set while turn() waits on the yaw angle (waking the integrator up, if it's parked)
+        self.turning = Event()
+
+        #start integrating the angular velocity (rate is in samples per second)
+        self.running = True
+        self.integrator = Thread(target=self.integrate, args=(rate,), daemon=True)
+        self.integrator.start()
+
     def get_angular_velocity(self):
-        """Returns the current angular velocity"""
+        """Returns the current angular velocity (or None if the robot didn't reply)"""
+        reading = self.robot.getSensor('USER_ANALOG_INPUT')
+        if reading is None:
+            return None
 
         #Convert [0-1023] iRobot 4byte number to a voltage between [0-5]
         #then corrects for calibrated temperature-voltage difference
-        voltage = self.robot.getSensor('USER_ANALOG_INPUT') / 1023 * 5
+        voltage = reading / 1023 * 5
         voltage += self.voltage_difference
 
         #Convert voltage to w (typical response for ADXRS652 is 7mV/degrees/sec)
         return (voltage - 2.5) / (0.007)
 
-    yaw = 0
-    def turn(self, angle = 90, sleep_time = 0.005):
-        """turns the robot a set angle (in degrees) by integrating the angular velocity to get the yaw rate"""
+    park_time = 0.1 #how often (in sec) the parked integrator checks whether the robot has started streaming
+    bias = 0 #the drift of the gyroscope since calibrating (in degrees/sec), tracked while the robot is still
+    still_rate = 1 #below this angular velocity (in degrees/sec) the robot is taken to be still
+    bias_rate = 0.01 #how quickly (per sample) the bias follows the angular velocity while the robot is still
+    def integrate(self, rate):
+        """samples the angular velocity at a fixed rate and integrates it into the yaw angle (runs in its own thread)"""
+        period = 1 / rate
+        time_0 = next_time = perf_counter()
+        w_inital = 0
 
-        #counter for time required to stop the robot again (about 4 degrees, depending on speed)
-        angle -= 10
+        while self.running:
+            #only sample while it's just reading the stream's cache, or while turn() needs it - otherwise each sample is
+            #   a query, so park until either (checked every park_time)
+            if not (getattr(self.robot, 'streaming', False) or self.turning.is_set()):
+                self.turning.wait(self.park_time)
 
-        w_inital = 0
-        while abs(self.yaw) < angle:
-            #current time
-            time_0 = clock()
+                #(the time parked isn't integrated)
+                time_0 = next_time = perf_counter()
+                w_inital = 0
+                continue
+
+            #sleep until the next sample is due (or catch up, if the serial communication has fallen behind)
+            next_time = max(next_time + period, perf_counter() - period)
+            sleep(max(next_time - perf_counter(), 0))
 
-            #sleep a little and allow for other comms to go through the robot
-            sleep(sleep_time)
-            
             w_final = self.get_angular_velocity()
+            time_1 = perf_counter()
+            if w_final is None:
+                continue
 
-            #get the elapsed time as the serial communication takes a non-negligible amount of time
-            time_elapsed = clock() - time_0
+            #while still, any angular velocity is just the gyroscope drifting
+            if abs(w_final - self.bias) < self.still_rate:
+                self.bias += self.bias_rate * (w_final - self.bias)
+            w_final -= self.bias
 
             #update the yaw angle using the area of a trapezium
-            self.yaw += (w_inital + w_final) / 2 * time_elapsed
-            w_inital = w_final
+            yaw = self.state[1] + (w_inital + w_final) / 2 * (time_1 - time_0)
+            with self.state.get_lock():
+                self.state[:] = [time_1, yaw, w_final]
+
+            with self.updated:
+                self.updated.notify_all()
+
+            w_inital, time_0 = w_final, time_1
+
+    stop_time = 0.15 #how long the robot takes to stop (in sec) - to work out how far it will still turn once told to stop
+    def turn(self, angle = 90, timeout = 30):
+        """stops the (already turning) robot once it has turned a set angle (in degrees), by waiting on the integrated yaw angle"""
+        #(waking the integrator up, if it's parked)
+        self.turning.set()
+        yaw_0 = self.get_yaw_angle()
+        give_up = perf_counter() + timeout
+
+        with self.updated:
+            while perf_counter() < give_up:
+                time_1, yaw, w = self.state[:]
+
+                #stop early by the angle the robot will still turn while stopping (rather than a fixed 10 degrees)
+                if abs(yaw - yaw_0) + abs(w) * self.stop_time >= angle:
+                    break
+
+                self.updated.wait(0.1)
 
         #turn off the robot
         self.robot.stop()
-
-        #reset the yaw rate to 0
-        self.yaw = 0
+        self.turning.clear()
 
     def get_yaw_angle(self):
         """Returns the current yaw angle (where 0 is the angle the robot was, when this thread was started)"""
-        return self.yaw
+        return self.state[1]
+
+    def get_state(self):
+        """Returns the latest (time, yaw angle, angular velocity) of the integrator (the time is from perf_counter())"""
+        with self.state.get_lock():
+            return tuple(self.state[:])
+
+    def stop(self):
+        """stops the integrator thread"""
+        self.running = False
+        self.turning.set()
+        self.integrator.join()
 
     voltage_difference = 0 #calibrated temperature-voltage difference
     def calibrate(self):
@@ -74,17 +145,240 @@ class Gyroscope():
         self.robot.playNote(50,25,0)
 
 
+class Sectors():
+    """Reduces a lidar scan to one reading per angular sector (e.g. [left, forward, right]) in a single vectorized pass.
+    Each sector is a (start, stop) range of indices into the scan, and is reduced by one of:
+        'mean' / 'min' => the mean / closest depth of the sector is less than the threshold (in meters)
+        'percentile' => the given percentile of the sector's depths is less than the threshold
+        'count' => at least min_points of the sector's depths are less than the threshold
+    giving 1 (=> wall / obstacle there) or 0 for each sector"""
+
+    def __init__(self, sectors = ((554, 645), (296, 387), (38, 129)), reducer = 'mean', threshold = 0.9, percentile = 10, min_points = 10):
+        self.sectors = sectors #the default is looking left, forward and right (for the Histogram)
+        self.reducer = reducer
+        self.threshold = threshold
+        self.percentile = percentile
+        self.min_points = min_points
+
+        #a (sectors, longest sector) array of the indices of each sector's depths - the shorter sectors are padded with
+        #   index -1, which will point at a NaN, so that all the sectors can be reduced at once
+        length = max(stop - start for start, stop in sectors)
+        self.indices = np.full((len(sectors), length), -1)
+        for i, (start, stop) in enumerate(sectors):
+            self.indices[i, :stop - start] = np.arange(start, stop)
+
+    @staticmethod
+    def from_angles(angles, first_index = 44, **options):
+        """creates the Sectors from (start, stop) angles in degrees (0 => forward, positive => to the left), for a scan
+            starting at step first_index of the lidar (which has 1024 steps per revolution, with step 384 facing forward)"""
+        steps = lambda angle: int(round(384 + angle * 1024 / 360)) - first_index
+        return Sectors([(steps(start), steps(stop)) for start, stop in angles], **options)
+
+    def reduce(self, depths):
+        """returns the reduced value of each sector (the depth in meters, to the cm, or the number of points for 'count')"""
+        #gather every sector's depths (in meters) at once, with the padding becoming NaN
+        depths = np.append(np.asarray(depths) / 1000, np.nan)[self.indices]
+
+        if self.reducer == 'mean':
+            return np.round(np.nanmean(depths, axis=1), 2)
+        elif self.reducer == 'min':
+            return np.round(np.nanmin(depths, axis=1), 2)
+        elif self.reducer == 'percentile':
+            return np.round(np.nanpercentile(depths, self.percentile, axis=1), 2)
+        elif self.reducer == 'count':
+            return np.sum(depths < self.threshold, axis=1)
+
+        raise ValueError('unknown reducer ' + repr(self.reducer))
+
+    def obstacles(self, depths):
+        """returns whether there is something in the way (1) or not (0) in each sector"""
+        values = self.reduce(depths)
+
+        if self.reducer == 'count':
+            return (values >= self.min_points).astype(int)
+
+        return (values < self.threshold).astype(int)
+
+class SCIPParser():
+    """Incrementally picks the scans out of the stream of SCIP 2.0 responses from the lidar.
+    A response is a block of lines ending in a blank line: the echo of the command, the status and (for scans) the timestamp
+    and the data lines, where every line after the echo ends in a check sum byte. Blocks with a wrong check sum or length
+    are dropped, and parsing picks up again at the next blank line, so a lost or extra byte only costs the scan it was in.
+    Further reading: http://www.hokuyo-aut.jp/02sensor/07scanner/download/urg_programs_en/scip_capture_page.html"""
+
+    def __init__(self, readings, depth_limit = 'S'):
+        self.buffer = bytearray()
+
+        #the number of data bytes (without check sums) in each scan
+        self.data_length = readings * (2 if depth_limit == 'S' else 3)
+
+        #the longest a response can be (a generous echo, the status and timestamp, and the data lines)
+        self.max_length = 64 + 4 + 6 + self.data_length + 2 * (self.data_length // 64 + 1) + 1
+
+        #counters of how the stream is going
+        self.scans = 0 #scans parsed successfully
+        self.dropped_frames = 0 #responses thrown away (corrupted, or an error status from the lidar)
+        self.checksum_errors = 0 #lines with a wrong check sum
+        self.discarded_bytes = 0 #bytes thrown away while looking for the end of a response
+
+    def check_sum(self, line):
+        """checks a line's check sum byte (the lower 6 bits of the sum of the rest of the line, plus 0x30)"""
+        return len(line) > 1 and (sum(line[:-1]) & 0x3f) + 0x30 == line[-1]
+
+    def feed(self, data):
+        """adds the bytes read from the lidar to the buffer, and returns a list of the (timestamp, data) of the complete
+            scans found - the timestamp is the 4 encoded bytes and the data is the data lines (with their check sums)"""
+        self.buffer += data
+        scans = []
+
+        while True:
+            #a blank line marks the end of a response
+            end = self.buffer.find(b'\n\n')
+
+            if end == -1:
+                #there should have been the end of a response by now => throw the garbage away
+                #   (keeping the last max_length bytes, in case a response has started in them)
+                if len(self.buffer) > 2 * self.max_length:
+                    self.discarded_bytes += len(self.buffer) - self.max_length
+                    self.dropped_frames += 1
+                    del self.buffer[:-self.max_length]
+
+                return scans
+
+            block = bytes(self.buffer[:end + 1])
+            del self.buffer[:end + 2]
+
+            scan = self.parse(block)
+            if scan is not None:
+                scans.append(scan)
+
+    def parse(self, block):
+        """parses a single response, returning the (timestamp, data) of a scan or None if it isn't one (or is corrupted)"""
+        lines = block.split(b'\n')[:-1]
+
+        #the status line - 00 => the command was accepted (e.g. when switching the lidar on), 99 => a scan follows
+        if len(lines) < 2 or len(lines[1]) != 3 or not self.check_sum(lines[1]):
+            self.checksum_errors += 1
+            self.dropped_frames += 1
+            return None
+
+        if lines[1][:2] == b'00':
+            return None
+
+        if lines[1][:2] != b'99' or len(lines) < 4:
+            self.dropped_frames += 1
+            return None
+
+        #the timestamp and data lines (64 data bytes per line, apart from the last one)
+        if len(lines[2]) != 5 or not all(self.check_sum(line) for line in lines[2:]):
+            self.checksum_errors += 1
+            self.dropped_frames += 1
+            return None
+
+        if any(len(line) != 65 for line in lines[3:-1]) or sum(len(line) - 1 for line in lines[3:]) != self.data_length:
+            self.dropped_frames += 1
+            return None
+
+        self.scans += 1
+        return lines[2][:4], b'\n'.join(lines[3:]) + b'\n'
+
+class ScanRing():
+    """A ring buffer of the latest full lidar scans in shared memory, written by the LIDAR process and read (without any
+    copying or pickling) by the others. There is only ever one writer, so no lock is needed: each slot has a sequence number
+    that is cleared while the slot is being written, so a reader can tell if a scan it is looking at is complete and current.
+    Create it (in the main process) with ScanRing(readings), then pass it to the LIDAR"""
+
+    def __init__(self, readings = 682, slots = 16, name = None):
+        self.readings = readings
+        self.slots = slots
+
+        #the layout: the number of scans written so far, then for each slot its sequence number, its (host) time,
+        #   the lidar's timestamp and the depth values
+        size = 8 + slots * (8 + 8 + 8 + 4 * readings)
+        self.memory = SharedMemory(name, create = name is None, size = size)
+        self.name = self.memory.name
+
+        buffer = self.memory.buf
+        self.count = np.ndarray((1,), np.int64, buffer, 0)
+        self.sequences = np.ndarray((slots,), np.int64, buffer, 8)
+        self.times = np.ndarray((slots,), np.float64, buffer, 8 + 8 * slots)
+        self.lidar_times = np.ndarray((slots,), np.int64, buffer, 8 + 16 * slots)
+        self.ranges = np.ndarray((slots, readings), np.int32, buffer, 8 + 24 * slots)
+
+    def __getstate__(self):
+        #when sent to another process, attach to the same shared memory (rather than pickling the scans)
+        return self.name, self.readings, self.slots
+
+    def __setstate__(self, state):
+        name, readings, slots = state
+        self.__init__(readings, slots, name)
+
+    def write(self, lidar_time, depths):
+        """adds a scan to the ring (overwriting the oldest one) - only the LIDAR process should call this"""
+        sequence = int(self.count[0]) + 1
+        slot = (sequence - 1) % self.slots
+
+        #mark the slot as being written, fill it in, then publish it
+        self.sequences[slot] = 0
+        self.times[slot] = time()
+        self.lidar_times[slot] = lidar_time
+        self.ranges[slot, :len(depths)] = depths
+        self.sequences[slot] = sequence
+        self.count[0] = sequence
+
+    def is_current(self, sequence):
+        """whether the scan with this sequence number is still in the ring (i.e. its view hasn't been overwritten)"""
+        return sequence > 0 and self.sequences[(sequence - 1) % self.slots] == sequence
+
+    def last(self, n = 1):
+        """returns the last n scans (oldest first) as a list of (sequence number, time, lidar timestamp, depths), where
+            depths is a view straight into the shared memory - it is only valid while is_current(sequence number)"""
+        newest = int(self.count[0])
+        scans = []
+
+        for sequence in range(max(newest - min(n, self.slots) + 1, 1), newest + 1):
+            slot = (sequence - 1) % self.slots
+            scan = (sequence, float(self.times[slot]), int(self.lidar_times[slot]), self.ranges[slot])
+
+            #skip any scan that was overwritten while we were looking
+            if self.is_current(sequence):
+                scans.append(scan)
+
+        return scans
+
+    def latest(self):
+        """returns the latest scan as (sequence number, time, lidar timestamp, depths), or None if there isn't one yet"""
+        scans = self.last(1)
+        return scans[-1] if scans else None
+
+    def close(self):
+        """detaches from the shared memory (the main process should then unlink() it)"""
+        self.count = self.sequences = self.times = self.lidar_times = self.ranges = None
+        self.memory.close()
+
+    def unlink(self):
+        """frees the shared memory, once all the processes are done with it"""
+        self.memory.unlink()
+
 class LIDAR(Process):
     """Communicates with the LIDAR to give depth information. 
     It runs in a separate process (=> can run on a separate processor core) as to ensure a real-time data feed
     Designed for & tested with the Hokuyo URG-04LX-UG01 (though should work with other Hokuyo lasers as well)"""
 
-    def __init__(self, port, results):
+    def __init__(self, port, results, scans = None, sectors = None, record = None):
         #initialize the process
         Process.__init__(self)
 
-        self.port = port
-        self.results = results
+        self.port = port #the com port number (or name), or an (already open) serial-like object (e.g. a ReplaySerial)
+        self.record = record #the (optional) path of the log to record the lidar's traffic into
+        self.results = results #an Array with an int for each of the sectors
+        self.scans = scans #the (optional) ScanRing to publish the full scans to
+
+        #how to reduce the scans to the results (by default the [left, forward, right] the Histogram expects)
+        self.sectors = sectors if sectors is not None else Sectors()
+
+        #counters of the parsed stream, shared with the main process: [scans, dropped frames, check sum errors]
+        self.stats = Array('i', 3)
         
     def decode(self, byte):
         """decodes the byte value response from the lidar to something more intelligible (base 10 number).
@@ -99,13 +393,48 @@ class LIDAR(Process):
         #if the value is zero (i.e. the 'thing' is out of range of the lidar, return 4085 - the furtherest the lidar can see
         return value if not value == 0 else 4085
 
-    def average(self, list):
-        """averages a list of numbers to two decimal places (e.g. [1,2,3] => 2)"""
-        return round(sum(list) / len(list) / 1000, 2)
-        
+    def decode_timestamp(self, field):
+        """decodes the (4 byte) timestamp of a scan, in milliseconds - unlike decode(), a 0 is kept as is (it's just the
+            lidar's clock wrapping around, not a reading out of range)"""
+        value = 0
+        for byte in field:
+            value = value << 6 | (byte - 0x30)
+        return value
+
+    def decode_block(self, block, depth_limit = 'S'):
+        """decodes a whole data block of the lidar's response (the lines of up to 64 characters, each followed by a
+            check sum and '\n') into an array of depth values in one go, rather than one reading at a time.
+            depth_limit is 'S' for 2 byte readings or 'D' for 3 byte readings (as in the MS/MD command)"""
+        data = np.frombuffer(block.rstrip(b'\n'), dtype=np.uint8)
+        if len(data) == 0:
+            return np.zeros(0, dtype=np.int32)
+
+        #drop the check sum and '\n' after every 64 characters, as well as the check sum at the end of the last line
+        keep = np.arange(len(data)) % 66 < 64
+        keep[-1] = False
+        data = data[keep].astype(np.int32) - 0x30
+
+        #each reading is 2 (or 3) characters of 6 bits each, with the most significant bits first
+        size = 2 if depth_limit == 'S' else 3
+        data = data[:len(data) - len(data) % size].reshape(-1, size)
+        values = data[:, 0]
+        for i in range(1, size):
+            values = (values << 6) | data[:, i]
+
+        #if the value is zero (i.e. the 'thing' is out of range of the lidar, use 4085 - the furtherest the lidar can see
+        values[values == 0] = 4085
+
+        return values
+
     def run(self):
         #connect the serial port of the lidar (note the -1 -> it's some pyserial nuance)
-        comm = serial.Serial(self.port - 1, baudrate=19200, timeout=0.5)
+        #   (or use the port's name as is, e.g. '/dev/ttyACM0' or the simulator's pseudo terminal)
+        if hasattr(self.port, 'read'):
+            comm = self.port
+        else:
+            comm = serial.Serial(self.port if isinstance(self.port, str) else self.port - 1, baudrate=19200, timeout=0.5)
+        if self.record is not None:
+            comm = RecordingSerial(comm, self.record, 'lidar')
         
         #lidar variables for distance data
         recieve_method = 'M' #G => single, M => continuous
@@ -120,31 +449,33 @@ class LIDAR(Process):
         command = recieve_method + depth_limit + first_index + last_index + data_grouping + scan_skip_interval + scan_times + '\r'
         comm.write((bytes(command, encoding='Latin-1')))
 
-        #read the switching on response (while the laser completes a cycle till it is switched on)
-        comm.read(21) 
+        #the parser picks the scans out of the stream (skipping the switching on response, and any corrupted data)
+        parser = SCIPParser((int(last_index) - int(first_index)) // int(data_grouping) + 1, depth_limit)
 
         #with the lidar on, and continuously providing data, read and interpret the data stream
         while True == True:
-            #read the returned data
-            tempdat = comm.read(1435).decode()
-            data = str(tempdat).split('\n')
+            #read whatever the lidar has sent (or wait for at least a byte)
+            scans = parser.feed(comm.read(max(comm.inWaiting(), 1)))
+            self.stats[:] = [parser.scans, parser.dropped_frames, parser.checksum_errors]
+
+            if not scans:
+                continue
+
+            #only the latest scan matters
+            timestamp, data = scans[-1]
 
             #decode the timestamp of the cycle
-            time = self.decode(bytes(data[2], encoding='Latin-1'))
+            lidar_time = self.decode_timestamp(timestamp)
 
-            data = data[3:] #just the depth data
-            depth_data = []
+            #convert the whole block to depth values at once - there are 64 bytes per line (and a check sum byte at the end)
+            #   and each distance reading is 2 bytes (or 3 bytes for depth_limit 'D')
+            depth_data = self.decode_block(data, depth_limit)
 
-            #convert to depth values - there are 65 bytes per line and each distance reading is 2 bytes (the last byte is a check sum of that line)
-            #   further reading: http://www.hokuyo-aut.jp/02sensor/07scanner/download/urg_programs_en/scip_capture_page.html
-            for i in range(len(data) - 2):
-                for j in range(0, 63, 2):
-                    depth_data.append(self.decode(bytes(data[i][j:j + 2], encoding = 'Latin-1')))
+            #publish the full scan for anyone that wants more than the booleans below
+            if self.scans is not None:
+                self.scans.write(lidar_time, depth_data)
 
-            #average parts of the distance data for slivers of averaged depth (to simplify coding the sense() function) and 
+            #reduce parts of the distance data to slivers of (e.g. averaged) depth (to simplify coding the sense() function) and 
             #convert it to a Boolean (array - process safe) response of whether something is in the way [left, forward, right] of the lidar
             #given that it is greater than / less than the threshold (in meters) - e.g. 0.6m => 0 => DANGER! DANGER! DANGER! wall / obstacle there
-            threshold = 0.9
-            self.results[0] = int(self.average(depth_data[554:645]) < threshold) #looking left (from 190 to 200 degrees)
-            self.results[1] = int(self.average(depth_data[296:387]) < threshold) #looking forward (from 110 to 130 degrees)
-            self.results[2] = int(self.average(depth_data[38:129]) < threshold) #looking right (from 30 to 40 degrees)
\ No newline at end of file
+            self.results[:] = self.sectors.obstacles(depth_data).tolist()
\ No newline at end of file
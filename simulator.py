@@ -0,0 +1,315 @@
+"""simulator.py: simulates the robot (speaking the Create's Open Interface over the sim_mode socket) and the LIDAR (speaking
+SCIP 2.0 over a pseudo terminal) driving around the map, so the whole robot's code can run without any hardware"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import asyncio
+import math
+import os
+from multiprocessing import Process, Queue
+from threading import Thread, Lock
+from time import perf_counter, sleep
+import numpy as np
+from PIL import Image
+from create import SENSORS
+
+def encode_scan(depths, depth_limit = 'S'):
+    """encodes depth values as the lidar would send them in the data block of an MS/MD response
+        (2 or 3 characters of 6 bits per reading, split into lines of 64 characters, each with a check sum and '\\n')"""
+    size = 2 if depth_limit == 'S' else 3
+    data = bytes(((depth >> (6 * i)) & 0x3f) + 0x30 for depth in depths for i in reversed(range(size)))
+
+    block = b''
+    for i in range(0, len(data), 64):
+        line = data[i:i + 64]
+        block += line + bytes([(sum(line) & 0x3f) + 0x30]) + b'\n'
+
+    return block + b'\n'
+
+def check_summed(line):
+    """adds the check sum byte (the lower 6 bits of the sum of the line, plus 0x30) and '\\n' to a line"""
+    return line + bytes([(sum(line) & 0x3f) + 0x30]) + b'\n'
+
+class World():
+    """The robot on the map: a differential drive model (integrated at a fixed rate) that can't drive through walls, with
+    the odometry the Create reports. The map is built from an image the same way the filters build it, each pixel being a
+    1m block (black => wall). Positions are in meters (x to the east, y to the south, from the top left corner of the map)
+    and the heading (in radians) is counterclockwise from east"""
+
+    wheel_base = 0.258 #the distance between the wheels (in meters)
+    radius = 0.17 #the robot's radius (in meters)
+    def __init__(self, fp = 'hallway.png', start = None):
+        i = Image.open(fp).convert('L')
+        self.walls = np.asarray(i) == 0
+
+        #start in the middle of the first free block (or where asked to), facing the first way (of N, E, S, W) that's free
+        if start is None:
+            row, col = np.argwhere(~self.walls)[0]
+            heading = next((heading for heading, (x, y) in zip((90, 0, 270, 180), ((0, -1), (1, 0), (0, 1), (-1, 0)))
+                            if not self.is_wall(col + 0.5 + x, row + 0.5 + y)), 90)
+            start = (col + 0.5, row + 0.5, math.radians(heading))
+        self.x, self.y, self.heading = start
+
+        self.velocity = 0 #linear velocity (in m/s)
+        self.angular_velocity = 0 #angular velocity (in rad/s, counterclockwise)
+        self.requested = (0, 0, 0, 0) #the velocity, radius, right & left velocity last asked for (in mm/s and mm)
+        self.bumped = 0 #the bump bits (right => 1, left => 2)
+
+        #the odometry since the start
+        self.distance = 0.0 #in meters
+        self.angle = 0.0 #in radians
+        self.lock = Lock()
+
+    def is_wall(self, x, y):
+        """whether the point (in meters) is in a wall (or off the map)"""
+        row, col = int(math.floor(y)), int(math.floor(x))
+        return not (0 <= row < self.walls.shape[0] and 0 <= col < self.walls.shape[1]) or bool(self.walls[row, col])
+
+    def drive(self, velocity, radius):
+        """the DRIVE command: velocity in mm/s, radius in mm (32768/32767 => straight, 1/-1 => turn on the spot)"""
+        with self.lock:
+            self.requested = (velocity, radius, velocity, velocity)
+            if radius in (32767, -32768):
+                self.velocity, self.angular_velocity = velocity / 1000, 0
+            elif radius in (1, -1):
+                self.velocity, self.angular_velocity = 0, math.copysign(velocity / 1000 / (self.wheel_base / 2), radius)
+            else:
+                self.velocity, self.angular_velocity = velocity / 1000, velocity / radius
+
+    def drive_direct(self, right, left):
+        """the DRIVE_DIRECT command: the wheel velocities in mm/s"""
+        with self.lock:
+            self.requested = ((right + left) // 2, 0, right, left)
+            self.velocity = (right + left) / 2000
+            self.angular_velocity = (right - left) / 1000 / self.wheel_base
+
+    def step(self, dt):
+        """moves the robot on by dt seconds, unless it would run into a wall"""
+        with self.lock:
+            heading = self.heading + self.angular_velocity * dt
+            x = self.x + self.velocity * dt * math.cos(heading)
+            y = self.y - self.velocity * dt * math.sin(heading)
+
+            #check the edge of the robot in the direction it's moving
+            direction = math.copysign(1, self.velocity)
+            if self.velocity and self.is_wall(x + direction * self.radius * math.cos(heading), y - direction * self.radius * math.sin(heading)):
+                self.bumped = 3
+                x, y = self.x, self.y
+            else:
+                self.bumped = 0
+
+            self.distance += direction * math.hypot(x - self.x, y - self.y)
+            self.angle += heading - self.heading
+            self.x, self.y, self.heading = x, y, heading
+
+    def scan(self, steps, max_range = 4.0, resolution = 0.01):
+        """casts the lidar's rays (steps of 360/1024 degrees, step 384 facing forward and counterclockwise from there) and
+        returns their depths in mm (0 where nothing is in range, like the lidar)"""
+        with self.lock:
+            x, y, heading = self.x, self.y, self.heading
+
+        angles = heading + (np.asarray(steps) - 384) * 2 * np.pi / 1024
+        distances = np.arange(0.02, max_range, resolution)
+        xs = x + np.outer(np.cos(angles), distances)
+        ys = y - np.outer(np.sin(angles), distances)
+
+        #the first point along each ray in a wall (or off the map)
+        rows, cols = np.floor(ys).astype(int), np.floor(xs).astype(int)
+        inside = (rows >= 0) & (rows < self.walls.shape[0]) & (cols >= 0) & (cols < self.walls.shape[1])
+        hit = ~inside
+        hit[inside] = self.walls[rows[inside], cols[inside]]
+        first = hit.argmax(axis=1)
+
+        return np.where(hit.any(axis=1), (distances[first] * 1000).astype(int), 0)
+
+class SimulatedCreate():
+    """Serves the Create's Open Interface over a socket (as Create(PORT='sim') expects): DRIVE, DRIVE_DIRECT, sensor
+    queries, streaming and scripts (including the WAIT commands), with the sensors read from the world - DISTANCE,
+    ANGLE, the velocities, the bumpers and the gyroscope on USER_ANALOG_INPUT (as the ADXRS652 would read, see
+    Gyroscope). Other commands are accepted and ignored (along with their data bytes, see ignored)"""
+
+    #the number of data bytes of the commands that are accepted and ignored - every other (fixed length) command of the
+    #   Open Interface, so that none of them leaves its data bytes to be read as the next commands
+    ignored = {128: 0, 129: 1, 130: 0, 131: 0, 132: 0, 133: 0, 134: 0, 135: 0, 136: 1, 138: 1, 139: 3, 143: 0, 144: 3,
+               146: 4, 147: 1, 151: 1}
+    def __init__(self, world, rate = 100):
+        self.world = world
+        self.rate = rate #world steps per second
+        self.streamed = [] #the packet IDs being streamed
+        self.streaming = False
+        self.songs = {} #the songs defined, by number
+        self.song = 0 #the song last played
+        self.script = b''
+        self.reported = (0, 0) #the odometry (in mm and degrees) as of the last reading
+
+    def sensor(self, packet, odometry):
+        """returns the bytes of a sensor's reading"""
+        name = next(name for name, module in SENSORS.items() if ord(module.ID) == packet)
+        distance, angle = odometry
+        velocity, radius, right, left = self.world.requested
+        values = {'DISTANCE': distance, 'ANGLE': angle, 'BUMPS_AND_WHEEL_DROPS': self.world.bumped, 'VELOCITY': velocity,
+                  'RADIUS': radius, 'RIGHT_VELOCITY': right, 'LEFT_VELOCITY': left, 'SONG_NUMBER': self.song, 'OI_MODE': 2,
+                  'VOLTAGE': 16000, 'BATTERY_CHARGE': 2700, 'BATTERY_CAPACITY': 2700, 'BATTERY_TEMPERATURE': 25,
+                  'USER_ANALOG_INPUT': min(max(int(round((2.5 + 0.007 * math.degrees(self.world.angular_velocity)) / 5 * 1023)), 0), 1023)}
+        return SENSORS[name].struct.pack(values.get(name, 0))
+
+    def read_odometry(self):
+        """returns the distance (in mm) and angle (in degrees) travelled since they were last read (as the Create reports
+        the change since the last reading)"""
+        odometry = (int(round(self.world.distance * 1000)), int(round(math.degrees(self.world.angle))))
+        distance, angle = odometry[0] - self.reported[0], odometry[1] - self.reported[1]
+        self.reported = odometry
+        return distance, angle
+
+    def sensors(self, packets, ids = False):
+        """returns the bytes of the readings of several sensors (each preceded by its packet ID, if ids)"""
+        odometry = self.read_odometry()
+        return b''.join((bytes([packet]) if ids else b'') + self.sensor(packet, odometry) for packet in packets)
+
+    async def wait_for(self, done):
+        """waits (as the WAIT commands do) until done() is true"""
+        while not done():
+            await asyncio.sleep(1 / self.rate)
+
+    async def execute(self, read, writer):
+        """reads a command (with read(n) returning the next n bytes) and carries it out, replying to the writer"""
+        opcode = (await read(1))[0]
+
+        if opcode == 137 or opcode == 145:
+            first, second = np.frombuffer(await read(4), dtype='>i2').tolist()
+            self.world.drive(first, second) if opcode == 137 else self.world.drive_direct(first, second)
+        elif opcode == 142:
+            writer.write(self.sensors(await read(1)))
+        elif opcode == 149:
+            writer.write(self.sensors(await read((await read(1))[0])))
+        elif opcode == 148:
+            self.streamed = list(await read((await read(1))[0]))
+            self.streaming = True
+        elif opcode == 150:
+            self.streaming = bool((await read(1))[0])
+        elif opcode == 140:
+            number, length = await read(2)
+            self.songs[number] = await read(2 * length)
+        elif opcode == 141:
+            self.song = (await read(1))[0]
+        elif opcode == 152:
+            self.script = await read((await read(1))[0])
+        elif opcode == 153:
+            script = asyncio.StreamReader()
+            script.feed_data(self.script)
+            script.feed_eof()
+            while not script.at_eof():
+                await self.execute(script.readexactly, writer)
+        elif opcode == 154:
+            writer.write(bytes([len(self.script)]) + self.script)
+        elif opcode == 155:
+            await asyncio.sleep((await read(1))[0] / 10)
+        elif opcode in (156, 157):
+            target = int(np.frombuffer(await read(2), dtype='>i2')[0])
+            def travelled():
+                return self.world.distance * 1000 if opcode == 156 else math.degrees(self.world.angle)
+            start = travelled()
+            await self.wait_for(lambda: travelled() - start >= target if target >= 0 else travelled() - start <= target)
+        elif opcode == 158:
+            await read(1)
+        else:
+            await read(self.ignored.get(opcode, 0))
+
+    async def serve(self, reader, writer):
+        """talks to a connected Create, until it disconnects"""
+        try:
+            while True:
+                await self.execute(reader.readexactly, writer)
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    async def run_world(self):
+        """steps the world at a fixed rate, and sends the streamed sensors every 15ms"""
+        period = 1 / self.rate
+        next_stream = 0
+
+        while True:
+            await asyncio.sleep(period)
+            self.world.step(period)
+
+            next_stream -= period
+            if self.streaming and self.streamed and next_stream <= 0 and self.writer is not None:
+                data = self.sensors(self.streamed, ids=True)
+                packet = bytes([19, len(data)]) + data
+                self.writer.write(packet + bytes([-sum(packet) & 0xFF]))
+                next_stream = 0.015
+
+    async def main(self, host, port, ready):
+        self.writer = None
+
+        async def connected(reader, writer):
+            self.writer = writer
+            await self.serve(reader, writer)
+            self.writer = None
+
+        server = await asyncio.start_server(connected, host, port)
+        ready()
+        async with server:
+            await self.run_world()
+
+    def run(self, host = '127.0.0.1', port = 65000, ready = lambda: None):
+        asyncio.run(self.main(host, port, ready))
+
+class SimulatedLIDAR():
+    """Speaks SCIP 2.0 on a pseudo terminal (whose name is given by port, for LIDAR(port)): answers the MS/MD command
+    and then sends a scan of the world every 100ms, as the URG-04LX does"""
+
+    def __init__(self, world, period = 0.1):
+        self.world = world
+        self.period = period
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+
+    def run(self):
+        command = b''
+        while not command.endswith(b'\r') and not command.endswith(b'\n'):
+            command += os.read(self.master, 64)
+        command = command.strip()
+
+        #the echo and status of the command, then the scans
+        os.write(self.master, command + b'\n' + check_summed(b'00') + b'\n')
+        depth_limit = chr(command[1])
+        first, last = int(command[2:6]), int(command[6:10])
+
+        start = next_scan = perf_counter()
+        while True:
+            next_scan += self.period
+            sleep(max(next_scan - perf_counter(), 0))
+
+            timestamp = int((perf_counter() - start) * 1000) & 0xFFFFFF
+            encoded = bytes(((timestamp >> (6 * i)) & 0x3f) + 0x30 for i in reversed(range(4)))
+            depths = self.world.scan(np.arange(first, last + 1))
+            os.write(self.master, command + b'\n' + check_summed(b'99') + check_summed(encoded) + encode_scan(depths, depth_limit))
+
+class Simulator(Process):
+    """Runs the simulated robot and lidar in a separate process. Once started, lidar_port is the name of the lidar's
+    pseudo terminal and the robot can be connected to with Create('sim')"""
+
+    def __init__(self, fp = 'hallway.png', start = None, host = '127.0.0.1', port = 65000):
+        Process.__init__(self, daemon=True)
+        self.fp, self.initial, self.host, self.port = fp, start, host, port
+        self.ready = Queue()
+        self.lidar_port = None
+
+    def start(self):
+        Process.start(self)
+        self.lidar_port = self.ready.get()
+
+    def run(self):
+        world = World(self.fp, self.initial)
+
+        lidar = SimulatedLIDAR(world)
+        Thread(target=lidar.run, daemon=True).start()
+
+        SimulatedCreate(world).run(self.host, self.port, lambda: self.ready.put(lidar.port))
+
+if __name__ == '__main__':
+    simulator = Simulator()
+    simulator.start()
+    print('Simulated Create on 127.0.0.1:65000 (Create(\'sim\')), simulated LIDAR on ' + simulator.lidar_port)
+    simulator.join()
@@ -0,0 +1,104 @@
+"""test_create.py: tests of the Create's sensor decoding and the asyncio version's query handling (run with pytest)"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import asyncio
+import struct
+from contextlib import redirect_stdout
+from io import StringIO
+from threading import Thread
+from time import sleep
+from create import AsyncCreate, Create, PASSIVE_MODE, SENSORS, SensorLayout, queryLayout
+
+class FakeWriter():
+    """Stands in for the robot's side of the connection: answers each query (by its sensors' IDs) with the given reply,
+    after the given delay"""
+
+    def __init__(self, reader, replies):
+        self.reader = reader
+        self.replies = replies #{sensor IDs: (delay, reply)}
+
+    def write(self, data):
+        delay, reply = self.replies[bytes(data[2:])]
+        asyncio.get_running_loop().call_later(delay, self.reader.feed_data, reply)
+
+    async def drain(self):
+        return
+
+def test_late_reply_is_not_handed_to_the_next_query():
+    async def run():
+        reader = asyncio.StreamReader()
+        voltage, distance = queryLayout(('VOLTAGE',)), queryLayout(('DISTANCE',))
+        #the voltage's reply comes after the query has timed out, while the distance (asked for next) is on its way
+        writer = FakeWriter(reader, {voltage.IDs: (0.15, struct.pack('>H', 16000)), distance.IDs: (0.08, struct.pack('>h', -12))})
+        robot = AsyncCreate(reader, writer, timeout = 0.1, quiet = 0.1)
+
+        assert await robot.getSensor('VOLTAGE') is None
+        assert await robot.getSensor('DISTANCE') == -12
+        #and the replies stay in step after that
+        assert await robot.getSensor('DISTANCE') == -12
+        robot.replyTask.cancel()
+
+    asyncio.run(run())
+
+def test_sensor_layout_decodes_each_sensor():
+    names = ('BUMPS_AND_WHEEL_DROPS', 'DISTANCE', 'VOLTAGE', 'SONG_NUMBER')
+    reply = bytes([0b00011]) + struct.pack('>hHB', -300, 16000, 14)
+    values = dict(queryLayout(names).unpack_from(reply))
+
+    assert values == {'BUMPS_AND_WHEEL_DROPS': [0, 0, 0, 1, 1], 'DISTANCE': -300, 'VOLTAGE': 16000, 'SONG_NUMBER': 14}
+
+    #the same as decoding them one by one
+    offset = 0
+    for name in names:
+        assert SENSORS[name].unpack_from(reply, offset) == values[name]
+        offset += SENSORS[name].size
+
+def test_streamed_layout_checks_the_packet_ids():
+    layout = SensorLayout(('DISTANCE', 'ANGLE'), packetIDs = True)
+    packet = bytes([19]) + struct.pack('>h', -5) + bytes([20]) + struct.pack('>h', 90)
+
+    assert layout.unpack_from(packet) == [('DISTANCE', -5), ('ANGLE', 90)]
+    assert layout.unpack_from(bytes([20]) + packet[1:]) is None
+
+class FakePort():
+    """Stands in for the Create's serial port: answers each QUERY_LIST with the given values of its sensors, in the order
+    the queries were written (each read taking a moment, as on the wire)"""
+
+    def __init__(self, values):
+        self.values = values #{sensor name: value}
+        self.reply = b''
+
+    def isOpen(self):
+        return True
+
+    def inWaiting(self):
+        return len(self.reply)
+
+    def write(self, data):
+        if data[0] == 149:
+            self.reply += b''.join(SENSORS[name].struct.pack(self.values[name]) for name in self.values
+                                   if ord(SENSORS[name].ID) in data[2:2 + data[1]])
+
+    def read(self, n):
+        sleep(0.0005)
+        reply, self.reply = self.reply[:n], self.reply[n:]
+        return reply
+
+def test_queries_from_several_threads_get_their_own_replies():
+    values = {'VOLTAGE': 16000, 'DISTANCE': -12}
+    with redirect_stdout(StringIO()):
+        robot = Create(FakePort(values), PASSIVE_MODE)
+
+    results = {name: [] for name in values}
+    def query(name):
+        for i in range(100):
+            results[name].append(robot.getSensor(name))
+    threads = [Thread(target=query, args=(name,)) for name in values]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for name, value in values.items():
+        assert results[name] == [value] * 100
@@ -0,0 +1,231 @@
+"""test_filters.py: checks the filters against straightforward (slow) versions of them (run with pytest)"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import math
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from filters import Filter, Histogram, SparseBelief
+from sensors import ScanRing
+from simulator import World
+
+HALLWAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hallway.png')
+
+#the fake sensor data of Histogram.drive()
+FAKE_SENSOR = [[1, 0, 1], [1, 1, 0], [1, 0, 1], [1, 0, 1], [1, 0, 1], [1, 0, 1], [1, 1, 0], [0, 1, 1], [1, 1, 1], [1, 1, 0]]
+
+def save_map(path, walls):
+    """saves a map (1 => wall) as an image the filters can load, and returns its path"""
+    Image.fromarray(np.where(walls, 0, 255).astype(np.uint8)).convert('RGB').save(path)
+    return str(path)
+
+#the histogram filter as it was first written, with a list of lists for each heading (N, E, S, W)
+def list_sense_options(map):
+    sense_map = [[[[] for x in row] for row in map] for direction in range(4)]
+    for y in range(len(map)):
+        for x in range(len(map[y])):
+            if map[y][x] == 0:
+                sense_map[0][y][x] = [map[y][x - 1], map[y - 1][x], map[y][x + 1]]
+                sense_map[1][y][x] = [map[y - 1][x], map[y][x + 1], map[y + 1][x]]
+                sense_map[2][y][x] = [map[y][x + 1], map[y + 1][x], map[y][x - 1]]
+                sense_map[3][y][x] = [map[y + 1][x], map[y][x - 1], map[y - 1][x]]
+    return sense_map
+
+def list_normalize(p):
+    p_sum = sum(sum(row) for direction in p for row in direction)
+    return [[[value / p_sum for value in row] for row in direction] for direction in p]
+
+def list_sense(p, sense_map, sensor_sees, p_sense = 0.95):
+    return [[[value * (p_sense if sensor_sees == sense_map[direction][row][col] else 1 - p_sense)
+              for col, value in enumerate(values)] for row, values in enumerate(p[direction])] for direction in range(4)]
+
+def list_move(p, map, move, p_move = 0.9):
+    new_probability = []
+    for direction in range(4):
+        source = (direction - move[1]) % 4
+        row_move, col_move = ((move[0], 0), (0, move[0]), (-move[0], 0), (0, -move[0]))[direction]
+        new_probability.append([[p_move * p[source][row + row_move][col - col_move] + (1 - p_move) * p[source][row][col]
+                                 if map[row][col] == 0 else 0 for col in range(len(map[row]))] for row in range(len(map))])
+    return new_probability
+
+def test_histogram_matches_the_list_code():
+    histogram = Histogram(None, None, None, fp = HALLWAY, drive = False)
+    map = histogram.map.tolist()
+    sense_map = list_sense_options(map)
+    p = list_normalize(histogram.p.tolist())
+
+    for sensor_sees in FAKE_SENSOR:
+        histogram.p = histogram.normalize(histogram.sense(sensor_sees))
+        p = list_normalize(list_sense(p, sense_map, sensor_sees))
+        assert np.allclose(histogram.p, p, rtol = 0, atol = 1e-12)
+
+        move_command = histogram.convert_to_command(sensor_sees)
+        histogram.p = histogram.normalize(histogram.move(move_command))
+        p = list_normalize(list_move(p, map, move_command))
+        assert np.allclose(histogram.p, p, rtol = 0, atol = 1e-12)
+
+class OverwritingRing(ScanRing):
+    """a ScanRing whose LIDAR process (standing in) starts overwriting the first scan handed out while it's being looked at,
+        and has written a couple more scans by the time it's asked again"""
+
+    def __init__(self):
+        super().__init__(readings = 3, slots = 2)
+        self.calls = 0
+
+    def latest(self):
+        self.calls += 1
+        if self.calls == 2:
+            self.write(2, [4, 5, 6])
+            self.write(3, [7, 8, 9])
+        scan = super().latest()
+        if self.calls == 1:
+            self.sequences[0] = 0
+            self.ranges[0, 0] = 7
+        return scan
+
+def test_latest_depths_copies_a_scan_that_is_still_current():
+    histogram = Histogram(None, None, None, fp = HALLWAY, drive = False)
+    assert histogram.latest_depths() is None
+
+    histogram.scans = OverwritingRing()
+    try:
+        histogram.scans.write(1, [1, 2, 3])
+        #the first copy ([7, 2, 3]) was torn by the write, so it's thrown away for the newest scan
+        assert histogram.latest_depths().tolist() == [7, 8, 9]
+        assert histogram.scans.calls == 2
+    finally:
+        histogram.scans.close()
+        histogram.scans.unlink()
+
+def brute_force_distance(walls):
+    """the distance from each cell to every wall, keeping the nearest"""
+    cells = np.indices(walls.shape).reshape(2, -1).T
+    if not walls.any():
+        return np.full(walls.shape, np.inf)
+    return np.sqrt(((cells[:, np.newaxis] - np.argwhere(walls)[np.newaxis]) ** 2).sum(axis=2).min(axis=1)).reshape(walls.shape)
+
+def test_distance_transform_matches_brute_force():
+    #walls only in the first column, so the other columns have no walls of their own
+    walls = np.zeros((5, 8), dtype=bool)
+    walls[:, 0] = True
+    assert np.array_equal(Filter().distance_transform(walls), brute_force_distance(walls))
+
+    random = np.random.default_rng(0)
+    for i in range(200):
+        walls = random.random(random.integers(1, 12, 2)) < random.random() * 0.3
+        assert np.array_equal(Filter().distance_transform(walls), brute_force_distance(walls))
+
+def brute_force_move(histogram, p, move):
+    """the motion update one cell at a time: turning, then moving each cell's probability by every shift of its heading's
+        kernel (what moves off the map is lost, rather than wrapping around), and none of it ending up in a wall"""
+    turns, shifts, weights = histogram.motion_kernel(move)
+    rotated = sum(probability * np.roll(p, shift, axis=0) for shift, probability in turns)
+    new_probability = np.zeros_like(p)
+    headings, height, width = p.shape
+
+    for (row_shift, col_shift), weight in zip(shifts, weights.T):
+        for row in range(height):
+            for col in range(width):
+                if 0 <= row + row_shift < height and 0 <= col + col_shift < width:
+                    new_probability[:, row + row_shift, col + col_shift] += weight * rotated[:, row, col]
+
+    new_probability[:, histogram.map != 0] = 0
+    return new_probability
+
+@pytest.mark.parametrize('headings', [4, 8, 16])
+@pytest.mark.parametrize('noise', [False, True])
+@pytest.mark.parametrize('localized', [False, True])
+def test_dense_log_and_sparse_moves_match_brute_force(tmp_path, headings, noise, localized):
+    #an open map (without a border of walls, so things move off it) with a single wall in it
+    walls = np.zeros((12, 15), dtype=bool)
+    walls[5, 5] = True
+    fp = save_map(tmp_path / 'open.png', walls)
+    dense, log = (Histogram(None, None, None, fp = fp, drive = False, headings = headings, log_space = log_space) for log_space in (False, True))
+    if noise:
+        for histogram in (dense, log):
+            histogram.turn_noise, histogram.move_noise = 0.5, 0.1
+
+    #the probability spread over the whole map, or all of it in two of the corners (so only a window of the map moves)
+    p = np.random.default_rng(headings).random((headings,) + walls.shape)
+    if localized:
+        p[:, 2:, :] = 0
+        p[:, :, 2:-2] = 0
+    p[:, walls] = 0
+    p /= p.sum()
+    indices = np.flatnonzero(p)
+
+    for move in ([1, 0], [2, 1], [0, 2], [1, -1], [3, 0]):
+        expected = brute_force_move(dense, p, move)
+
+        dense.p = p.copy()
+        assert np.allclose(dense.move(move), expected, rtol = 0, atol = 1e-12)
+
+        with np.errstate(divide='ignore'):
+            log.p = np.log(p)
+        assert np.allclose(np.exp(log.move(move)), expected, rtol = 0, atol = 1e-12)
+
+        dense.p = SparseBelief(p.shape, indices, p.reshape(-1)[indices])
+        assert np.allclose(dense.move(move).to_dense(), expected, rtol = 0, atol = 1e-12)
+
+def test_sense_options_treat_off_the_map_as_walls():
+    walls = np.zeros((3, 4), dtype=np.uint8)
+    walls[1, 1] = 1
+    sense_map = Filter().create_sense_options(walls)
+
+    #N, E, S, W and whether there's a wall that way (off the map being one)
+    directions = [(-1, 0), (0, 1), (1, 0), (0, -1)]
+    def wall(row, col):
+        return int(not (0 <= row < 3 and 0 <= col < 4) or walls[row, col] != 0)
+
+    for heading in range(4):
+        for row in range(3):
+            for col in range(4):
+                left, forward, right = (directions[(heading + turn) % 4] for turn in (-1, 0, 1))
+                expected = 8 if walls[row, col] else \
+                    wall(row + left[0], col + left[1]) << 2 | wall(row + forward[0], col + forward[1]) << 1 | wall(row + right[0], col + right[1])
+                assert sense_map[heading, row, col] == expected
+
+def test_scan_likelihood_ranks_the_true_pose_at_the_top(tmp_path):
+    #a map with walls scattered over it (and a border of walls), scanned by the simulator's lidar from random poses
+    random = np.random.default_rng(0)
+    walls = random.random((40, 40)) < 0.3
+    walls[[0, -1], :] = walls[:, [0, -1]] = True
+    fp = save_map(tmp_path / 'scattered.png', walls)
+    histogram = Histogram(None, None, None, fp = fp, drive = False)
+    world = World(fp)
+
+    free = np.argwhere(histogram.map == 0)
+    ranks = []
+    for row, col in free[random.choice(len(free), 40, replace=False)]:
+        heading = random.integers(4)
+        world.x, world.y, world.heading = col + 0.5, row + 0.5, math.radians(90 - 90 * heading)
+        log_likelihood = histogram.scan_likelihood(world.scan(np.arange(44, 726)))
+
+        #how many of the (movable) poses score better than the true one
+        log_likelihood[:, histogram.map != 0] = -np.inf
+        ranks.append(np.count_nonzero(log_likelihood > log_likelihood[heading, row, col]))
+
+    assert np.median(ranks) == 0
+    assert np.count_nonzero(np.array(ranks) <= 5) >= 30
+
+def test_map_cache_keeps_only_the_current_version(tmp_path):
+    walls = np.zeros((6, 7), dtype=bool)
+    walls[0, :] = walls[:, 0] = True
+    fp = save_map(tmp_path / 'room.png', walls)
+    cache = tmp_path / Filter.map_cache
+
+    #a map compiled before the cache was split by version, and one of an older version
+    (cache / 'f00d').mkdir(parents=True)
+    (cache / 'v2' / 'f00d').mkdir(parents=True)
+    compiled = Filter().load_map(fp)
+    assert sorted(os.listdir(cache)) == ['v' + Filter.map_version.decode()]
+    assert np.array_equal(compiled['map'], walls)
+    assert np.array_equal(compiled['prior'], np.where(walls, 0, 1 / (4 * np.count_nonzero(~walls))))
+
+    #bumping the version compiles the map again, and throws away the last version's
+    newer = Filter()
+    newer.map_version = b'999'
+    assert np.array_equal(newer.load_map(fp)['distance'], compiled['distance'])
+    assert os.listdir(cache) == ['v999']
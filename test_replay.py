@@ -0,0 +1,144 @@
+"""test_replay.py: tests of recording the robot's & lidar's traffic and replaying it as fast as possible (run with pytest)"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import os
+import random
+from contextlib import redirect_stdout
+from io import StringIO
+from multiprocessing import Array
+from time import perf_counter, sleep
+import numpy as np
+from create import Create, PASSIVE_MODE, SENSORS
+from filters import Histogram
+from replay import ReplayClock, ReplaySerial
+from sensors import LIDAR
+from simulator import encode_scan, check_summed
+
+HALLWAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hallway.png')
+
+#what the lidar sees [left, forward, right] as the run goes on
+SIGHTS = [[1, 0, 1], [1, 1, 0], [0, 1, 1], [1, 1, 1], [1, 0, 1], [0, 0, 1]]
+
+class FakeCreatePort():
+    """Stands in for the Create's serial port: answers each QUERY_LIST with zeros (apart from SONG_NUMBER), and plays the
+    song at the end of a motion script a moment after the script is run (as if the robot had driven it)"""
+
+    def __init__(self, drive_time = 0.03):
+        self.drive_time = drive_time
+        self.reply = b''
+        self.song = 0
+        self.playing = (0, 0) #the song of the script that's running, and when it's done
+
+    def isOpen(self):
+        return True
+
+    def inWaiting(self):
+        return len(self.reply)
+
+    def write(self, data):
+        if perf_counter() >= self.playing[1]:
+            self.song = self.playing[0]
+
+        if data[0] == 149:
+            self.reply += b''.join(bytes([self.song]) if packet == ord(SENSORS['SONG_NUMBER'].ID) else bytes(size)
+                                   for packet, size in ((packet, next(sensor.size for sensor in SENSORS.values() if ord(sensor.ID) == packet))
+                                                        for packet in data[2:2 + data[1]]))
+        elif data[0] == 152 and data[-1] == 153:
+            self.playing = (data[-2], perf_counter() + self.drive_time)
+
+    def read(self, size):
+        reply, self.reply = self.reply[:size], self.reply[size:]
+        return reply
+
+    def close(self):
+        return
+
+class FakeLidarPort():
+    """Stands in for the lidar's serial port, sending a scan every period (seeing each of the SIGHTS for a few scans)"""
+
+    def __init__(self, period = 0.01):
+        self.period = period
+        self.start = None
+        self.scans = 0
+        self.pending = b''
+
+    def scan(self, number):
+        depths = np.full(682, 3000)
+        for (start, stop), wall in zip(((554, 645), (296, 387), (38, 129)), SIGHTS[number // 4 % len(SIGHTS)]):
+            depths[start:stop] = 500 if wall else 3000
+        return b'MS0044072501000\n' + check_summed(b'99') + check_summed(b'0000') + encode_scan(depths)
+
+    def inWaiting(self):
+        if self.start is None:
+            self.start = perf_counter()
+        while self.scans <= (perf_counter() - self.start) / self.period:
+            self.pending += self.scan(self.scans)
+            self.scans += 1
+        return len(self.pending)
+
+    def read(self, size = 1):
+        deadline = perf_counter() + 0.5
+        while self.inWaiting() < size and perf_counter() < deadline:
+            sleep(0.001)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def close(self):
+        return
+
+class SlowLIDAR(LIDAR):
+    """a LIDAR that takes its time over each scan, more or less at random (so how far behind it falls differs from one run
+    to the next, if nothing waits for it)"""
+
+    def decode_block(self, block, depth_limit = 'S'):
+        sleep(random.uniform(0, 0.02))
+        return super().decode_block(block, depth_limit)
+
+def drive(robot, lidar_results, steps = 6):
+    """runs the histogram filter's loop (as in its drive()), returning what it sensed and believed at each step"""
+    histogram = Histogram(robot, None, lidar_results, fp = HALLWAY, drive = False)
+    steps_taken = []
+    for step in range(steps):
+        sensor_sees = lidar_results[:]
+        histogram.update_sense(sensor_sees)
+        move_command = histogram.convert_to_command(sensor_sees)
+        histogram.move_robot(move_command)
+        histogram.update_move(move_command)
+        steps_taken.append((sensor_sees, histogram.belief(histogram.p).copy()))
+    return steps_taken
+
+def run(robot_port, lidar_port, record = None, clock = None):
+    """connects to the robot & lidar (recording them into the log, if record), and drives the filter's loop"""
+    with redirect_stdout(StringIO()):
+        robot = Create(robot_port, PASSIVE_MODE, record = record)
+    lidar_results = Array('i', 3)
+    lidar = SlowLIDAR(lidar_port, lidar_results, record = record)
+    lidar.start()
+    try:
+        if clock is not None:
+            assert clock.sync()
+        else:
+            sleep(0.05)
+        return drive(robot, lidar_results)
+    finally:
+        lidar.terminate()
+        lidar.join()
+
+def test_replaying_a_log_as_fast_as_possible_gives_the_same_filter_output(tmp_path):
+    log = str(tmp_path / 'run.log')
+    recorded = run(FakeCreatePort(), FakeLidarPort(), record = log)
+    #(the lidar saw different things as the robot went)
+    assert len(set(tuple(sensor_sees) for sensor_sees, belief in recorded)) > 1
+
+    replays = []
+    for i in range(2):
+        clock = ReplayClock()
+        replays.append(run(ReplaySerial(log, 'create', clock), ReplaySerial(log, 'lidar', clock), clock = clock))
+
+    for (first_sees, first_belief), (second_sees, second_belief) in zip(*replays):
+        assert first_sees == second_sees
+        assert np.array_equal(first_belief, second_belief)
@@ -0,0 +1,102 @@
+"""test_sensors.py: tests of picking the lidar's scans out of its (possibly corrupted) stream (run with pytest)"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+from time import sleep
+import numpy as np
+from sensors import Gyroscope, LIDAR, SCIPParser
+from simulator import encode_scan, check_summed
+
+READINGS = 682
+
+def scan_response(depths, timestamp = b'0000'):
+    """the lidar's response to an MS command, carrying a scan of the depths"""
+    return b'MS0044072501000\n' + check_summed(b'99') + check_summed(timestamp) + encode_scan(depths)
+
+def feed_in_pieces(parser, stream, size = 7):
+    """feeds the stream to the parser a few bytes at a time (as the serial port would), returning all the scans found"""
+    return [scan for i in range(0, len(stream), size) for scan in parser.feed(stream[i:i + size])]
+
+def test_parser_resyncs_after_corrupted_scans():
+    random = np.random.default_rng(0)
+    depths = [random.integers(20, 4085, READINGS) for i in range(4)]
+    responses = [scan_response(scan, b'000' + bytes([0x30 + i])) for i, scan in enumerate(depths)]
+
+    #a flipped byte in the second scan's data, a lost byte in the third one's, and garbage before the last one
+    flipped = bytearray(responses[1])
+    flipped[100] ^= 0x01
+    lost = responses[2][:200] + responses[2][201:]
+    stream = responses[0] + bytes(flipped) + lost + b'\x00junk' + responses[3]
+
+    parser = SCIPParser(READINGS)
+    scans = feed_in_pieces(parser, stream)
+
+    assert [timestamp for timestamp, data in scans] == [b'0000', b'0003']
+    lidar = LIDAR(23, None)
+    assert np.array_equal(lidar.decode_block(scans[0][1]), depths[0])
+    assert np.array_equal(lidar.decode_block(scans[1][1]), depths[3])
+    assert parser.scans == 2
+    assert parser.dropped_frames >= 2 and parser.checksum_errors >= 2
+
+def test_parser_throws_away_a_run_of_garbage():
+    depths = np.random.default_rng(1).integers(20, 4085, READINGS)
+    parser = SCIPParser(READINGS)
+
+    #far more than a response can be, without ever ending in a blank line
+    scans = feed_in_pieces(parser, bytes(range(1, 10)) * 500 + scan_response(depths), size = 64)
+
+    assert len(scans) == 1
+    assert np.array_equal(LIDAR(23, None).decode_block(scans[0][1]), depths)
+    assert parser.discarded_bytes > 0
+
+def test_timestamps_decode_without_the_out_of_range_depth():
+    lidar = LIDAR(23, None)
+    #encoded as the simulator (and the lidar) does, 6 bits per byte
+    for timestamp in (0, 1, 4085, 0xFFFFFF):
+        assert lidar.decode_timestamp(bytes(((timestamp >> (6 * i)) & 0x3f) + 0x30 for i in reversed(range(4)))) == timestamp
+
+class FakeRobot():
+    """Stands in for the Create: the gyroscope reads still (512 of 1023), and every reading is counted"""
+
+    def __init__(self):
+        self.streaming = False
+        self.readings = 0
+
+    def getSensor(self, name):
+        self.readings += 1
+        return 512
+
+    def stop(self):
+        return
+
+    def playNote(self, *note):
+        return
+
+def test_gyroscope_only_samples_while_streaming_or_turning():
+    robot = FakeRobot()
+    gyro = Gyroscope(robot)
+    calibrated = robot.readings
+
+    #not streaming => each sample would be a query, so none are taken
+    sleep(0.2)
+    assert robot.readings == calibrated
+
+    robot.streaming = True
+    sleep(0.3)
+    assert robot.readings > calibrated
+
+    #once the stream stops, the integrator parks again
+    robot.streaming = False
+    sleep(0.1)
+    parked = robot.readings
+    sleep(0.2)
+    assert robot.readings == parked
+
+    #turn() samples while it waits (the robot reads still, so it gives up after the timeout)
+    gyro.turn(timeout = 0.1)
+    assert robot.readings > parked
+    sleep(0.1)
+    parked = robot.readings
+    sleep(0.2)
+    assert robot.readings == parked
+    gyro.stop()
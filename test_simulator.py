@@ -0,0 +1,44 @@
+"""test_simulator.py: tests of the simulated Create's handling of the Open Interface's commands (run with pytest)"""
+__author__ = "Malte Ahrens"
+__license__ = "Attribution 3.0 Unported (CC BY 3.0)"
+
+import asyncio
+import os
+from create import queryLayout
+from simulator import SimulatedCreate, World
+
+HALLWAY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hallway.png')
+
+class Replies():
+    """collects what the simulated Create writes back"""
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+def run_commands(create, commands):
+    """has the simulated Create carry out the commands, returning its replies"""
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(commands)
+        reader.feed_eof()
+        replies = Replies()
+        while not reader.at_eof():
+            await create.execute(reader.readexactly, replies)
+        return replies.data
+
+    return asyncio.run(run())
+
+def test_ignored_commands_skip_their_data_bytes():
+    create = SimulatedCreate(World(HALLWAY))
+
+    #baud, demo, the leds and drive pwm - whose data bytes would otherwise be taken for commands (e.g. 142 => SENSORS)
+    commands = bytes([129, 11, 136, 255, 139, 10, 0, 128, 146, 0, 142, 255, 114])
+    assert run_commands(create, commands + queryLayout(('SONG_NUMBER', 'OI_MODE')).query) == bytes([0, 2])
+
+def test_show_script_replies_with_the_script():
+    create = SimulatedCreate(World(HALLWAY))
+    script = bytes([137, 0, 100, 128, 0, 155, 10])
+    assert run_commands(create, bytes([152, len(script)]) + script + bytes([154])) == bytes([len(script)]) + script